@@ -0,0 +1,225 @@
+import json
+
+from flask import Blueprint, abort, current_app, jsonify, request, stream_with_context, url_for
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload, selectinload
+
+from extensions import cache, db
+from models import Comment, Post, Tag, User, post_summary_options, post_tags
+from pagination import keyset_paginate
+
+
+# read-only json api, for integrations (instead of scraping the html pages).
+#
+# every list is keyset paginated like the pages are: a response carries
+# next_cursor/prev_cursor, pass one back as ?after= / ?before= for the next
+# page, ?limit= sets the page size. the /export endpoints stream a whole
+# table as ndjson (one json object per line): rows come off the database
+# cursor in batches (yield_per) and go out as they are serialized, so an
+# export of any size runs in the same memory.
+#
+# owners and tags are loaded for a whole page / batch in one query each,
+# serializing never triggers a lazy load.
+
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+
+def _limit(default):
+    limit = request.args.get("limit", default, type=int)
+    return min(max(limit, 1), current_app.config["API_MAX_PER_PAGE"])
+
+
+def _timestamp(value):
+    return value.isoformat() if value is not None else None
+
+
+def user_json(user):
+    return {
+        "username": user.username,
+        "url": url_for("api.user", username=user.username, _external=True),
+    }
+
+
+def post_json(post, full=False):
+    data = {
+        "id": post.id,
+        "title": post.title,
+        "excerpt": post.excerpt,
+        "reading_time": post.reading_time,
+        "created_at": _timestamp(post.created_at),
+        "author": user_json(post.owner),
+        "tags": [tag.name for tag in post.tags],
+        "url": url_for("api.post", post_id=post.id, _external=True),
+        "html_url": url_for("main.view_post", post_id=post.id, _external=True),
+    }
+    if full:
+        data["body"] = post.body
+        data["body_html"] = post.body_html
+    return data
+
+
+def comment_json(comment):
+    return {
+        "id": comment.id,
+        "post_id": comment.post_id,
+        "body": comment.body,
+        "created_at": _timestamp(comment.created_at),
+        "author": user_json(comment.author),
+    }
+
+
+def tag_json(tag):
+    return {
+        "name": tag.name,
+        "post_count": tag.post_count,
+        "posts_url": url_for("api.posts", tag=tag.name, _external=True),
+    }
+
+
+def page_json(page, serialize):
+    return jsonify({
+        "items": [serialize(item) for item in page.items],
+        "next_cursor": page.next_cursor,
+        "prev_cursor": page.prev_cursor,
+    })
+
+
+def _post_list_options():
+    # summary columns only, owners and tags in one query each
+    return (*post_summary_options(), selectinload(Post.owner), selectinload(Post.tags))
+
+
+@api.errorhandler(404)
+def not_found(error):
+    return jsonify({"error": "not found"}), 404
+
+
+# --- posts ---
+
+@api.route("/posts")
+@cache.cached_page(lambda: ["posts", "tags"])
+def posts():
+    # newest first, or only the posts with ?tag=
+    query = Post.query.options(*_post_list_options())
+    tag_name = request.args.get("tag")
+    if tag_name:
+        # same walk as the html tag page: ix_post_tags_tag_created, newest first
+        tag = Tag.query.filter_by(name=tag_name).first_or_404()
+        query = query.join(post_tags, post_tags.c.post_id == Post.id) \
+            .filter(post_tags.c.tag_id == tag.id)
+        sort_col, id_col = post_tags.c.created_at, post_tags.c.post_id
+    else:
+        sort_col, id_col = Post.created_at, Post.id
+    page = keyset_paginate(query, sort_col, id_col,
+                           per_page=_limit(current_app.config["POSTS_PER_PAGE"]),
+                           after=request.args.get("after"),
+                           before=request.args.get("before"))
+    return page_json(page, post_json)
+
+
+@api.route("/posts/<int:post_id>")
+@cache.cached_page(lambda post_id: [f"post:{post_id}", "tags"])
+def post(post_id):
+    post = Post.query.options(joinedload(Post.owner), selectinload(Post.tags)).get_or_404(post_id)
+    return jsonify(post_json(post, full=True))
+
+
+@api.route("/posts/<int:post_id>/comments")
+@cache.cached_page(lambda post_id: [f"post:{post_id}"])
+def post_comments(post_id):
+    # oldest first, like under the post
+    if db.session.execute(select(Post.id).where(Post.id == post_id)).first() is None:
+        abort(404)
+    page = keyset_paginate(
+        Comment.query.options(selectinload(Comment.author)).filter(Comment.post_id == post_id),
+        Comment.created_at, Comment.id,
+        per_page=_limit(current_app.config["COMMENTS_PER_PAGE"]),
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+        descending=False,
+    )
+    return page_json(page, comment_json)
+
+
+# --- tags ---
+
+@api.route("/tags")
+@cache.cached_page(lambda: ["tags"])
+def tags():
+    # most used first, like /tags
+    page = keyset_paginate(Tag.query.filter(Tag.post_count > 0), Tag.post_count, Tag.id,
+                           per_page=_limit(current_app.config["TAGS_PER_PAGE"]),
+                           after=request.args.get("after"),
+                           before=request.args.get("before"))
+    return page_json(page, tag_json)
+
+
+# --- users ---
+
+@api.route("/users/<username>")
+@cache.cached_page(lambda username: [f"user:{username}"])
+def user(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    return jsonify({
+        **user_json(user),
+        "about_me": user.about_me,
+        "created_at": _timestamp(user.created_at),
+        "post_count": user.post_count,
+        "follower_count": user.follower_count,
+        "following_count": user.following_count,
+        "posts_url": url_for("api.user_posts", username=user.username, _external=True),
+        "html_url": url_for("main.user_profile", username=user.username, _external=True),
+    })
+
+
+@api.route("/users/<username>/posts")
+@cache.cached_page(lambda username: [f"user:{username}", "tags"])
+def user_posts(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    page = keyset_paginate(user.posts.options(*_post_list_options()), Post.created_at, Post.id,
+                           per_page=_limit(current_app.config["PROFILE_LIST_PER_PAGE"]),
+                           after=request.args.get("after"),
+                           before=request.args.get("before"))
+    return page_json(page, post_json)
+
+
+# --- exports ---
+
+def _ndjson(query, serialize):
+    # one batch of rows at a time off the database cursor, the owners/tags for
+    # each batch in one query per relationship. nothing holds on to a batch
+    # once it has been written out (the session only keeps weak references).
+    batch_size = current_app.config["API_EXPORT_BATCH_SIZE"]
+
+    def generate():
+        result = db.session.execute(query.execution_options(yield_per=batch_size))
+        for batch in result.scalars().partitions():
+            yield "".join(json.dumps(serialize(row)) + "\n" for row in batch)
+
+    return current_app.response_class(stream_with_context(generate()),
+                                      mimetype="application/x-ndjson")
+
+
+@api.route("/export/posts.ndjson")
+def export_posts():
+    """Every post, oldest first, full bodies included.
+
+    ``?after_id=`` resumes an export after the last id it got.
+    """
+    after_id = request.args.get("after_id", 0, type=int)
+    query = (
+        select(Post).options(joinedload(Post.owner), selectinload(Post.tags))
+        .where(Post.id > after_id).order_by(Post.id)
+    )
+    return _ndjson(query, lambda post: post_json(post, full=True))
+
+
+@api.route("/export/comments.ndjson")
+def export_comments():
+    """Every comment, oldest first. ``?after_id=`` as for posts."""
+    after_id = request.args.get("after_id", 0, type=int)
+    query = (
+        select(Comment).options(joinedload(Comment.author))
+        .where(Comment.id > after_id).order_by(Comment.id)
+    )
+    return _ndjson(query, comment_json)
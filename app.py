@@ -1,299 +1,130 @@
-from flask import Flask, render_template, url_for, redirect, flash, request, abort
-from forms import RegisterForm, LoginForm, PostForm, CommentForm
-from extensions import db
-from models import User, Post, Tag, Comment
-from flask_login import LoginManager, login_user, logout_user, current_user, login_required
+import importlib
+
+import click
+from flask import Flask
+from sqlalchemy.orm import configure_mappers
+from config import Config
+from extensions import db, cache, csrf, instrumentation, login_manager
+from database import configure_read_bind, configure_engines
+import auth
+import timeline
+import counters
+import search
+import tags
+import rendering
+import accounts
+import migrations
+import templating
+from jobs import job_queue
+
+
+class LazyCommand(click.Command):
+    # stands in for a cli command until it is run. the modules that are only
+    # there for the cli (benchmarks, seed data, bulk import, plan checks) are
+    # then not imported by every web worker. `flask --help` lists it with
+    # the help given here, `flask <name> ...` imports "module:attribute" and
+    # hands it the arguments.
+    def __init__(self, name, import_name, help):
+        super().__init__(name, help=help, add_help_option=False,
+                         context_settings={"ignore_unknown_options": True, "allow_extra_args": True})
+        self.import_name = import_name
+
+    def load(self):
+        module, attribute = self.import_name.split(":")
+        return getattr(importlib.import_module(module), attribute)
+
+    def make_context(self, info_name, args, parent=None, **extra):
+        # the real command's context, so the real command is what runs
+        return self.load().make_context(info_name, args, parent=parent, **extra)
 
 
 # create applicaton object
-app = Flask(__name__)
+# `config` is a config class/object (see config.py) or a dict of overrides
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
+
+    # integrate db with app (with the read-only engine for GET requests, and
+    # the sqlite pragmas on every connection)
+    configure_read_bind(app)
+    db.init_app(app)
+    configure_engines(app, db)
+
+    # integrate the sql/request instrumentation with app
+    instrumentation.init_app(app)
+
+    # integrate the page cache with app
+    cache.init_app(app)
+
+    # the template bytecode cache and filters (see templating.py)
+    templating.init_app(app)
+
+    # integrate the background job queue with app (flask worker, flask jobs ...)
+    job_queue.init_app(app)
+
+    # the slim, cached logged in user (see auth.py)
+    auth.init_app(app)
+
+    # integrate login manager to app. (it loads the user, set/clear cookies, redirection for unauthenticated user)
+    login_manager.init_app(app)
+
+    # redirect unauthenticated user to this page.
+    login_manager.login_view = "main.login"
+
+    # every POST needs a csrf token, forms without a FlaskForm too (the
+    # delete buttons put csrf_token() in a hidden field)
+    csrf.init_app(app)
+
+    # all the pages
+    from views import bp
+    app.register_blueprint(bp)
+
+    # the json api (/api/v1/...)
+    from api import api
+    app.register_blueprint(api)
+
+    # flask cli commands (flask db ..., flask import ..., flask timeline ..., flask posts ..., flask bench ..., flask seed)
+    app.cli.add_command(timeline.timeline_cli)
+    app.cli.add_command(counters.counters_cli)
+    app.cli.add_command(search.search_cli)
+    app.cli.add_command(tags.tags_cli)
+    app.cli.add_command(rendering.posts_cli)
+    app.cli.add_command(accounts.accounts_cli)
+    app.cli.add_command(migrations.db_cli)
+    # only imported when they are run
+    app.cli.add_command(LazyCommand("import", "importer:import_cli",
+                                    "Bulk load users, posts, comments and follows."))
+    migrations.db_cli.add_command(LazyCommand("check-plans", "query_plans:check_plans_command",
+                                              "Fail if any statement behind a route scans a whole table."))
+    app.cli.add_command(LazyCommand("bench", "benchmarks:bench_cli",
+                                    "Benchmarks for the slow paths of the app."))
+    app.cli.add_command(LazyCommand("seed", "seed:seed_command",
+                                    "Fill the database with skewed synthetic data."))
+
+    # do now what the first request would otherwise wait for: sqlalchemy
+    # sets up the mappers on the first query, jinja compiles a template
+    # the first time it is rendered. (no connection is opened here, so a
+    # server that forks its workers after loading the app doesn't share one)
+    configure_mappers()
+    templating.precompile(app)
+
+    return app
 
-# secret key
-app.config["SECRET_KEY"] = "a-secret-key-for-flaskform"
-
-# set up database
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///my_database.db"
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-
-# integrate db with app
-db.init_app(app)
-
-# integrate login manager to app. (it loads the user, set/clear cookies, redirection for unauthenticated user)
-login_manager = LoginManager(app)
-
-# redirect unauthenticated user to this page.
-login_manager.login_view = "login"
 
 # NEW AND CORRECT WAY
 @login_manager.user_loader
 def load_user(user_id):
-    user = db.session.get(User, int(user_id))
-    return user
-
-@app.route("/")
-def home():
-    posts = Post.query.order_by(Post.created_at.desc()).all()
-    return render_template("home.html", title="New Post", posts=posts)
-
-
-@app.route("/register", methods=["GET", "POST"])
-def register():
-    # if already logged in
-    if current_user.is_authenticated:
-        return redirect(url_for("home"))
-    
-    form = RegisterForm()
-    # it checks for [post request, validators, csrf tokens]
-    if form.validate_on_submit():
-        flash(f"{form.username.data}, Successfully registered.")
-        flash(f"Now Log In, To enjoy reading other posts")
-
-        # collecting data from flaskform
-        username = form.username.data
-        email = form.email.data
-        password = form.password.data
-
-        # create a user object and store it in db.
-        new_user = User(username=username, email=email)
-        new_user.set_password(password)
-
-        # add and commit it.
-        db.session.add(new_user)
-        db.session.commit()
-
-        return redirect(url_for("login"))
-
-    return render_template("register.html", title="Register", form=form)
-
-
-
-@app.route("/login", methods=["GET", "POST"])
-def login():
-    # if already logged in
-    if current_user.is_authenticated:
-        return redirect(url_for("home"))
-    
-
-    form = LoginForm()
-    # it checks for [post request, validators, csrf tokens]
-    if form.validate_on_submit():
-        #collecting data from flaskform
-        email = form.email.data
-        password = form.password.data
-        remember_me = form.remember_me.data
-
-        # check is user exist.
-        existing_user = User.query.filter_by(email=email).first()
-
-        if existing_user and existing_user.check_password(password):
-            login_user(existing_user, remember=remember_me)
-            flash(f"Successfully Logged In as {existing_user.username}.", "success")
-            next_page = request.args.get("next")
-            if next_page:
-                return redirect(next_page)
-            else:
-                return redirect(url_for("home"))
-        else:
-            flash("Invalid email or password. Please try again.", "danger")
-        
-    return render_template("login.html", title="Log In", form=form)
-
-
-@app.route("/logout")
-@login_required
-def logout():
-    logout_user()
-    return redirect(url_for("home"))
-
-
-@app.route("/create_post", methods=["GET", "POST"])
-@login_required
-def create_post():
-    form = PostForm()
-
-    if form.validate_on_submit():
-        title = form.title.data
-        
-        # --- IMPROVEMENT 1: Better Error Handling ---
-        existing_title = Post.query.filter_by(title=title).first()
-        if existing_title:
-            flash("A post with this title already exists. Please choose a different title.", "danger")
-            # Re-render the form so the user doesn't lose their work
-            return render_template("post.html", title="Create Post", form=form)
-        # ----------------------------------------------
-
-        # If the title is unique, proceed with creating the post
-        new_post = Post(
-            title=title,
-            body=form.body.data,
-            owner=current_user
-        )
-
-        tag_string = form.tags.data
-        tag_names = [name.strip() for name in tag_string.split(',') if name.strip()]
-        
-        for name in tag_names:
-            existing_tag = Tag.query.filter_by(name=name).first()
-            if existing_tag:
-                tag = existing_tag
-            else:
-                tag = Tag(name=name)
-            new_post.tags.append(tag)
-
-        db.session.add(new_post)
-        db.session.commit()
-
-        # --- IMPROVEMENT 2: Format the Timestamp ---
-        creation_time = new_post.created_at.strftime('%I:%M %p on %B %d, %Y')
-        flash(f"Post '{new_post.title}' created successfully at {creation_time}", "success")
-        # -----------------------------------------
-
-        return redirect(url_for("home"))
-
-    return render_template("post.html", title="Create Post", form=form)
-
-# view post
-@app.route("/post/<int:post_id>", methods=["GET", "POST"])
-def view_post(post_id):
-    post = Post.query.get_or_404(post_id)
-    form = CommentForm()
-
-    # form on submit
-    if form.validate_on_submit():
-        new_comment = Comment(body=form.body.data,
-                            author=current_user,
-                            post = post,
-
-
-        )
-        db.session.add(new_comment)
-        db.session.commit()
-        flash("Your comment has been posted.", "success")
-        
-        # Redirect back to the same page to see the new comment
-        return redirect(url_for('view_post', post_id=post.id))
-
-    return render_template("view_post.html", post=post, title=post.title, form=form)
-
-
-@app.route('/tag/<string:tag_name>')
-def posts_by_tag(tag_name):
-    # Find the tag object from the database, or return a 404 error
-    tag = Tag.query.filter_by(name=tag_name).first_or_404()
-    
-    posts = tag.posts
-    
-    return render_template('home.html', posts=posts, tag_name=tag_name)
-
-
-@app.route("/post/<int:post_id>/edit", methods=["GET", "POST"])
-@login_required
-def edit_post(post_id):
-    post = Post.query.get_or_404(post_id)
-    
-    if post.owner != current_user:
-        abort(403)
-        
-    form = PostForm()
-    
-    if form.validate_on_submit():
-        # Update the post's simple fields
-        post.title = form.title.data
-        post.body = form.body.data
-        
-        # --- TAG UPDATE LOGIC ---
-        # 1. Clear the existing tags from the post
-        post.tags.clear()
-        
-        # 2. Run the same tag processing logic as in create_post
-        tag_string = form.tags.data
-        tag_names = [name.strip() for name in tag_string.split(',') if name.strip()]
-        
-        for name in tag_names:
-            existing_tag = Tag.query.filter_by(name=name).first()
-            if existing_tag:
-                tag = existing_tag
-            else:
-                tag = Tag(name=name)
-            post.tags.append(tag)
-        # --- END OF TAG UPDATE LOGIC ---
-            
-        db.session.commit()
-        flash("Your post has been updated!", "success")
-        return redirect(url_for('view_post', post_id=post.id))
-        
-    elif request.method == 'GET':
-        # Pre-populate the form with existing data
-        form.title.data = post.title
-        form.body.data = post.body
-        form.tags.data = ", ".join([tag.name for tag in post.tags])
-        
-    return render_template('post.html', title='Edit Post', form=form)
-
-     
-    
-
-# delete post
-@app.route("/post/<int:post_id>/delete", methods = ["POST"])
-@login_required
-def delete_post(post_id):
-    # get the post from the db.
-    post = Post.query.get_or_404(post_id)
-
-    # if it is not the owner
-    if post.owner != current_user:
-        abort(403)
-
-    db.session.delete(post)
-    db.session.commit()
-    
-    flash("Your post has been deleted.", "success")
-    return redirect(url_for('home'))
-
-
-@app.route('/follow/<string:username>')
-@login_required
-def follow(username):
-    user_to_follow = User.query.filter_by(username=username).first_or_404()
-
-    if user_to_follow == current_user:
-        flash("You cannot follow yourself!", "warning")
-        return redirect(url_for('home'))
-    
-    current_user.following.append(user_to_follow)
-    db.session.commit()
-    flash(f"You are now following {username}.", "success")
-    return redirect(request.referrer or url_for('home'))
-
-
-
-@app.route('/unfollow/<string:username>')
-@login_required
-def unfollow(username):
-    user_to_unfollow = User.query.filter_by(username=username).first_or_404()
-    if user_to_unfollow == current_user:
-        flash("You cannot unfollow yourself!", "warning")
-        return redirect(url_for('home'))
-        
-    current_user.following.remove(user_to_unfollow)
-    db.session.commit()
-    flash(f"You have unfollowed {username}.", "info")
-    return redirect(request.referrer or url_for('home'))
-
-
-# user profile
-@app.route("/user/<string:username>")
-def user_profile(username):
-    # get the user
-    user = User.query.filter_by(username=username).first_or_404()
-
-    return render_template("profile.html", user=user)
-
-
+    # an AuthUser (id and username), usually without touching the database
+    return auth.load_user(int(user_id))
 
 
 if __name__ == "__main__":
+    app = create_app()
+    # create the schema, or bring an existing database up to date
     with app.app_context():
-        db.create_all()
+        migrations.upgrade()
     app.run(debug=True)
-
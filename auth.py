@@ -0,0 +1,84 @@
+from flask import current_app, flash, redirect, url_for
+from flask_login import UserMixin, current_user, logout_user
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from cache import MemoryCache
+from extensions import db
+from models import User, follow_state, forget_follow_state
+
+
+# who is logged in, for every request that has someone.
+#
+# flask-login calls load_user() on every request. loading the whole users
+# row for it (about_me, the password hash ...) is mostly wasted: pages only
+# need the id and the username, and whether the user follows someone.
+# AuthUser is just that, kept in a per process cache for
+# AUTH_USER_CACHE_TIMEOUT seconds (0 turns the cache off). deleting an
+# account drops it from this process's cache straight away, other processes
+# let it expire. until then a write made there in the deleted account's name
+# fails its foreign key to users, and the user is logged out (see
+# _account_gone). the places that need the full row load it with
+# AuthUser.load().
+
+class AuthUser(UserMixin):
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+
+    def load(self):
+        # the full users row
+        return db.session.get(User, self.id)
+
+    def is_following(self, user):
+        return follow_state(self.id, user.id)
+
+    def forget_follow_state(self, user):
+        forget_follow_state(self.id, user.id)
+
+    def __repr__(self):
+        return f"<AuthUser({self.id}, {self.username})>"
+
+
+def init_app(app):
+    app.config.setdefault("AUTH_USER_CACHE_TIMEOUT", 30)
+    app.config.setdefault("AUTH_USER_CACHE_SIZE", 10000)
+    app.extensions["auth_users"] = MemoryCache(app.config["AUTH_USER_CACHE_SIZE"])
+    app.register_error_handler(IntegrityError, _account_gone)
+
+
+def load_user(user_id):
+    users = current_app.extensions["auth_users"]
+    timeout = current_app.config["AUTH_USER_CACHE_TIMEOUT"]
+    user = users.get(user_id) if timeout else None
+    if user is None:
+        row = db.session.execute(
+            select(User.id, User.username).where(User.id == user_id)
+        ).first()
+        if row is None:
+            return None
+        user = AuthUser(row.id, row.username)
+        if timeout:
+            users.set(user_id, user, timeout)
+    return user
+
+
+def forget_users(user_ids):
+    # after the accounts changed or went away
+    users = current_app.extensions["auth_users"]
+    for user_id in user_ids:
+        users.delete(user_id)
+
+
+def _account_gone(error):
+    # a write that broke a constraint. when it's because the logged in
+    # account no longer exists, log them out instead of answering 500
+    db.session.rollback()
+    if not current_user.is_authenticated or db.session.execute(
+        select(User.id).where(User.id == current_user.id)
+    ).first() is not None:
+        raise error
+    forget_users([current_user.id])
+    logout_user()
+    flash("Your account no longer exists.", "warning")
+    return redirect(url_for("main.login"))
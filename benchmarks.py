@@ -0,0 +1,732 @@
+import logging
+import statistics
+import threading
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func, insert, select, text, update
+from sqlalchemy.orm import selectinload
+
+from extensions import db
+from instrumentation import count_queries
+import counters
+from models import Comment, Post, User, follows, post_summary_options
+
+
+# rough benchmarks, run against whatever database the app is pointed at.
+# they are for comparing approaches on the same data, not absolute numbers.
+
+bench_cli = AppGroup("bench", help="Benchmarks for the slow paths of the app.")
+
+
+def timed(func, repeat):
+    # run func repeat times, return (timings in ms, queries per run)
+    timings = []
+    with count_queries() as queries:
+        for _ in range(repeat):
+            db.session.expire_all()
+            start = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - start) * 1000)
+    return timings, queries.count / max(repeat, 1)
+
+
+def report(label, timings, queries):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    click.echo(f"{label:<28} median {statistics.median(timings):8.2f} ms"
+               f"   p95 {p95:8.2f} ms   {queries:6.1f} queries")
+
+
+@bench_cli.command("timeline")
+@click.option("--users", default=20, show_default=True, help="How many readers to sample.")
+@click.option("--repeat", default=5, show_default=True)
+def timeline_command(users, repeat):
+    """Materialized timeline vs joining posts with follows at read time."""
+    from timeline import read_timeline
+
+    per_page = current_app.config["POSTS_PER_PAGE"]
+    # the readers who follow the most accounts are the interesting ones
+    readers = db.session.execute(
+        select(follows.c.follower_id)
+        .group_by(follows.c.follower_id)
+        .order_by(func.count().desc())
+        .limit(users)
+    ).scalars().all()
+    if not readers:
+        raise click.ClickException("no follow edges in the database, seed some data first.")
+
+    def naive():
+        # the same page read_timeline() returns: summary columns, owners and tags
+        for user_id in readers:
+            Post.query.options(*post_summary_options(), selectinload(Post.owner),
+                               selectinload(Post.tags)) \
+                .join(follows, follows.c.followed_id == Post.user_id) \
+                .filter(follows.c.follower_id == user_id) \
+                .order_by(Post.created_at.desc(), Post.id.desc()) \
+                .limit(per_page).all()
+
+    def materialized():
+        for user_id in readers:
+            read_timeline(user_id, per_page)
+
+    following = db.session.execute(
+        select(func.count()).select_from(follows).where(follows.c.follower_id.in_(readers))
+    ).scalar()
+    click.echo(f"{len(readers)} readers following {following} accounts in total, "
+               f"{User.query.count()} users, {Post.query.count()} posts")
+    report("join at read time", *timed(naive, repeat))
+    report("materialized timeline", *timed(materialized, repeat))
+
+
+@bench_cli.command("tags")
+@click.option("--tags", "tag_count", default=50, show_default=True, help="Tags per post.")
+@click.option("--repeat", default=20, show_default=True)
+def tags_command(tag_count, repeat):
+    """Batched tag resolution vs one query per tag name (rolled back afterwards)."""
+    from models import Tag
+    from tags import set_post_tags
+
+    owner_id = db.session.execute(select(User.id).limit(1)).scalar()
+    if owner_id is None:
+        raise click.ClickException("no users in the database, seed some data first.")
+    names = [f"bench-tag-{i}" for i in range(tag_count)]
+
+    def one_by_one(post):
+        # what create_post/edit_post used to do
+        with db.session.no_autoflush:
+            for name in names:
+                post.tags.append(Tag.query.filter_by(name=name).first() or Tag(name=name))
+
+    def create(tagger):
+        def run():
+            post = Post(title="bench post", body="-", user_id=owner_id)
+            tagger(post)
+            db.session.add(post)
+            db.session.flush()
+            db.session.rollback()
+        return run
+
+    click.echo(f"{tag_count} new tags per post")
+    report("create, query per tag", *timed(create(one_by_one), repeat))
+    report("create, batched", *timed(create(lambda post: set_post_tags(post, names)), repeat))
+
+    # re-saving a post whose tags did not change
+    post = Post(title="bench post", body="-", user_id=owner_id)
+    set_post_tags(post, names)
+    db.session.add(post)
+    db.session.flush()
+
+    def edit_old():
+        post.tags.clear()
+        one_by_one(post)
+        db.session.flush()
+
+    def edit_new():
+        set_post_tags(post, names)
+        db.session.flush()
+
+    report("edit, clear and re-add", *timed(edit_old, repeat))
+    report("edit, diff", *timed(edit_new, repeat))
+    db.session.rollback()
+
+
+@bench_cli.command("deletes")
+@click.option("--sizes", default="0,10,100,1000", show_default=True,
+              help="How many children (comments, posts) to give each deleted row.")
+def deletes_command(sizes):
+    """Statements run by deleting a post / an account, by number of children."""
+    from accounts import delete_accounts
+
+    sizes = [int(size) for size in sizes.split(",")]
+    stamp = int(time.time() * 1000)
+
+    def make_user(label):
+        user = User(username=f"bench-{label}-{stamp}", email=f"bench-{label}-{stamp}@example.com",
+                    password="-")
+        db.session.add(user)
+        db.session.flush()
+        return user.id
+
+    def make_posts(user_id, label, count, comments_each):
+        # plain inserts, the ids are read back in one query
+        if not count:
+            return []
+        db.session.execute(insert(Post), [
+            {"title": f"bench {label} {stamp} #{i}", "body": "-", "user_id": user_id}
+            for i in range(count)])
+        post_ids = db.session.execute(
+            select(Post.id).where(Post.user_id == user_id)).scalars().all()
+        comments = [{"body": "-", "user_id": user_id, "post_id": post_id}
+                    for post_id in post_ids for _ in range(comments_each)]
+        if comments:
+            db.session.execute(insert(Comment), comments)
+        return post_ids
+
+    counts = {"delete post": [], "delete account": []}
+    for size in sizes:
+        # a post with `size` comments, deleted the way delete_post does it
+        user_id = make_user(f"post-{size}")
+        post_id, = make_posts(user_id, f"post-{size}", 1, size)
+        db.session.commit()
+        db.session.expunge_all()
+        with count_queries() as queries:
+            post = db.session.get(Post, post_id)
+            db.session.delete(post)
+            db.session.commit()
+        counts["delete post"].append(queries.count)
+        delete_accounts([user_id])
+
+        # an account with `size` posts, each with a comment, and followers
+        user_id = make_user(f"account-{size}")
+        make_posts(user_id, f"account-{size}", size, 1)
+        followers = db.session.execute(
+            select(User.id).where(User.id != user_id).limit(size)).scalars().all()
+        if followers:
+            db.session.execute(insert(follows), [{"follower_id": follower, "followed_id": user_id}
+                                                 for follower in followers])
+            counters.adjust(user_id, follower_count=len(followers), post_count=size)
+            db.session.execute(update(User).where(User.id.in_(followers))
+                               .values(following_count=User.following_count + 1))
+        db.session.commit()
+        with count_queries() as queries:
+            delete_accounts([user_id])
+        counts["delete account"].append(queries.count)
+
+    click.echo("children      " + "".join(f"{size:>8}" for size in sizes))
+    for label, statements in counts.items():
+        click.echo(f"{label:<14}" + "".join(f"{count:>8}" for count in statements))
+    if any(len(set(statements)) > 1 for statements in counts.values()):
+        raise click.ClickException("statement counts grow with the number of children.")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+@bench_cli.command("routes")
+@click.option("--repeat", default=20, show_default=True, help="Requests per route.")
+@click.option("--cache/--no-cache", "use_cache", default=False, show_default=True,
+              help="Leave the anonymous page cache on.")
+@click.option("--writes/--no-writes", default=True, show_default=True,
+              help="Also drive the routes that write (their rows are removed afterwards).")
+@click.option("--save", type=click.Path(dir_okay=False), help="Save the results as json.")
+@click.option("--compare", type=click.Path(exists=True, dir_okay=False),
+              help="Fail if p95 latency or query counts regressed against a saved run.")
+@click.option("--tolerance", default=0.25, show_default=True,
+              help="Allowed p95 slowdown before --compare fails (0.25 = 25%).")
+def routes_command(repeat, use_cache, writes, save, compare, tolerance):
+    """Drive every route through the test client, anonymous and logged in."""
+    import json
+    import re
+    import tracemalloc
+    import uuid
+
+    from accounts import delete_accounts
+    from cache import NullCache
+    from extensions import cache
+    from models import Comment, Tag, post_tags
+    from seed import SEED_PASSWORD
+
+    app = current_app._get_current_object()
+    # the most popular of everything, the pages that hurt the most
+    author = User.query.order_by(User.follower_count.desc()).first()
+    reader = User.query.order_by(User.following_count.desc()).first()
+    busy_post_id = db.session.execute(
+        select(Comment.post_id).group_by(Comment.post_id).order_by(func.count().desc()).limit(1)
+    ).scalar() or db.session.execute(select(Post.id).limit(1)).scalar()
+    big_tag = db.session.execute(
+        select(Tag.name).join(post_tags).group_by(Tag.id).order_by(func.count().desc()).limit(1)
+    ).scalar()
+    if author is None or busy_post_id is None or big_tag is None:
+        raise click.ClickException("the database is nearly empty, run 'flask seed' first.")
+    own_post_id = db.session.execute(
+        select(Post.id).where(Post.user_id == reader.id).limit(1)
+    ).scalar()
+    reader_id = reader.id
+    was_following = db.session.execute(
+        select(follows).where(follows.c.follower_id == reader.id, follows.c.followed_id == author.id)
+    ).first() is not None
+
+    app.config["WTF_CSRF_ENABLED"] = False
+    saved_backend = cache.backend
+    if not use_cache:
+        cache.backend = NullCache()
+
+    def log_in(client, user_id):
+        with client.session_transaction() as session:
+            session["_user_id"] = str(user_id)
+            session["_fresh"] = True
+
+    anonymous = app.test_client()
+    logged_in = app.test_client()
+    log_in(logged_in, reader.id)
+
+    first_page = anonymous.get("/").get_data(as_text=True)
+    cursor = re.search(r"after=([\w-]+)", first_page)
+    second_page = f"/?after={cursor.group(1)}" if cursor else "/"
+    search_word = author.username
+
+    routes = [
+        ("home", anonymous, "GET", "/", None),
+        ("home page 2", anonymous, "GET", second_page, None),
+        ("view_post", anonymous, "GET", f"/post/{busy_post_id}", None),
+        ("posts_by_tag", anonymous, "GET", f"/tag/{big_tag}", None),
+        ("tag_directory", anonymous, "GET", "/tags", None),
+        ("user_profile", anonymous, "GET", f"/user/{author.username}", None),
+        ("search", anonymous, "GET", f"/search?q={search_word}", None),
+        ("login page", anonymous, "GET", "/login", None),
+        ("register page", anonymous, "GET", "/register", None),
+        # a fresh client each time, a logged in one would just be redirected
+        ("login", None, "POST", "/login",
+         lambda: {"email": reader.email, "password": SEED_PASSWORD}),
+        ("home, logged in", logged_in, "GET", "/", None),
+        ("timeline", logged_in, "GET", "/timeline", None),
+        ("view_post, logged in", logged_in, "GET", f"/post/{busy_post_id}", None),
+        ("user_profile, logged in", logged_in, "GET", f"/user/{author.username}", None),
+    ]
+    if own_post_id is not None:
+        routes.append(("edit_post page", logged_in, "GET", f"/post/{own_post_id}/edit", None))
+    # run before each request of a route, untimed: whatever makes the
+    # request do its work every time instead of only the first (a follow
+    # needs someone not followed yet, a delete a post to delete)
+    prepare = {}
+    if writes:
+        titles = []
+
+        def new_post():
+            titles.append(f"bench {uuid.uuid4().hex}")
+            return {"title": titles[-1], "body": "benchmark post", "tags": "bench, " + big_tag}
+
+        def bench_post_id(title):
+            with app.app_context():
+                return db.session.execute(select(Post.id).where(Post.title == title)).scalar_one()
+
+        registered = []
+
+        def new_user():
+            name = f"bench{uuid.uuid4().hex[:12]}"
+            registered.append(name)
+            return {"username": name, "email": f"{name}@example.com",
+                    "password": "benchmark", "confirm_password": "benchmark"}
+
+        leaving = app.test_client()
+        routes += [
+            ("create_post", logged_in, "POST", "/create_post", new_post),
+            # the first post create_post made, a new body every time
+            ("edit_post", logged_in, "POST", lambda: f"/post/{bench_post_id(titles[0])}/edit",
+             lambda: {"title": titles[0], "body": f"edited {uuid.uuid4().hex}",
+                      "tags": "bench, " + big_tag}),
+            ("delete_post", logged_in, "POST", lambda: f"/post/{bench_post_id(titles[-1])}/delete", None),
+            ("comment", logged_in, "POST", f"/post/{busy_post_id}",
+             lambda: {"body": "benchmark comment"}),
+            ("follow", logged_in, "GET", f"/follow/{author.username}", None),
+            ("unfollow", logged_in, "GET", f"/unfollow/{author.username}", None),
+            # a fresh client each time, like login
+            ("register", None, "POST", "/register", new_user),
+            ("logout", leaving, "GET", "/logout", None),
+        ]
+        prepare.update({
+            "delete_post": lambda: drive(logged_in, "POST", "/create_post", new_post()),
+            "follow": lambda: drive(logged_in, "GET", f"/unfollow/{author.username}", None),
+            "unfollow": lambda: drive(logged_in, "GET", f"/follow/{author.username}", None),
+            "logout": lambda: log_in(leaving, reader_id),
+        })
+
+    def drive(client, method, url, data):
+        client = client or app.test_client()
+        if method == "GET":
+            return client.get(url)
+        return client.post(url, data=data)
+
+    def ready(name, url, data):
+        # the route's prepare step, then its url and form data, all untimed
+        if name in prepare:
+            prepare[name]()
+        return (url() if callable(url) else url), (data() if data else None)
+
+    results = {}
+    errors = []
+
+    def run():
+        for name, client, method, url, data in routes:
+            timings, queries = [], []
+            for _ in range(repeat):
+                url_now, data_now = ready(name, url, data)
+                with count_queries() as counted:
+                    start = time.perf_counter()
+                    response = drive(client, method, url_now, data_now)
+                    timings.append((time.perf_counter() - start) * 1000)
+                if response.status_code >= 400:
+                    errors.append(f"{name}: {method} {url_now} -> {response.status_code}")
+                    return
+                queries.append(counted.count)
+
+            url_now, data_now = ready(name, url, data)
+            tracemalloc.start()
+            drive(client, method, url_now, data_now)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            results[name] = {
+                "p50": percentile(timings, 0.5), "p95": percentile(timings, 0.95),
+                "p99": percentile(timings, 0.99), "queries": max(queries),
+                "peak_kb": peak / 1024,
+            }
+
+    def restore():
+        # put the data back the way it was
+        with app.app_context():
+            bench_posts = db.session.execute(
+                select(Post.id).where(Post.title.in_(titles), Post.user_id == reader_id)
+            ).scalars().all()
+        for post_id in bench_posts:
+            logged_in.post(f"/post/{post_id}/delete")
+        if was_following:
+            logged_in.get(f"/follow/{author.username}")
+        with app.app_context():
+            for comment in Comment.query.filter_by(user_id=reader_id, body="benchmark comment"):
+                db.session.delete(comment)
+            db.session.commit()
+            delete_accounts(db.session.execute(
+                select(User.id).where(User.username.in_(registered))
+            ).scalars().all())
+
+    def in_thread(target):
+        # a request made inside the cli's app context would share its
+        # session and g (and see everything already loaded, or an old
+        # snapshot of the database), so requests are made from a thread of
+        # their own
+        worker = threading.Thread(target=target)
+        worker.start()
+        worker.join()
+
+    try:
+        in_thread(run)
+        if errors:
+            raise click.ClickException(errors[0])
+        if writes:
+            in_thread(restore)
+    finally:
+        cache.backend = saved_backend
+
+    click.echo(f"{'route':<26}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}{'peak KiB':>10}")
+    for name, result in results.items():
+        click.echo(f"{name:<26}{result['p50']:9.2f}{result['p95']:9.2f}{result['p99']:9.2f}"
+                   f"{result['queries']:9d}{result['peak_kb']:10.0f}")
+
+    if save:
+        with open(save, "w") as f:
+            json.dump(results, f, indent=2)
+    if compare:
+        with open(compare) as f:
+            baseline = json.load(f)
+        regressions = []
+        for name, result in results.items():
+            before = baseline.get(name)
+            if before is None:
+                continue
+            if result["queries"] > before["queries"]:
+                regressions.append(f"{name}: {before['queries']} -> {result['queries']} queries")
+            if result["p95"] > before["p95"] * (1 + tolerance):
+                regressions.append(f"{name}: p95 {before['p95']:.2f} -> {result['p95']:.2f} ms")
+        if regressions:
+            raise click.ClickException("regressions:\n  " + "\n  ".join(regressions))
+        click.echo("no regressions against " + compare)
+
+
+@bench_cli.command("concurrency")
+@click.option("--threads", default=8, show_default=True)
+@click.option("--seconds", default=10.0, show_default=True, help="How long to run each profile.")
+@click.option("--write-ratio", default=0.1, show_default=True,
+              help="Share of requests that post a comment.")
+def concurrency_command(threads, seconds, write_ratio):
+    """Throughput under concurrent reads/writes: default sqlite vs the engine profile."""
+    import random
+
+    from app import create_app
+    from models import Comment
+
+    readers = db.session.execute(select(User.id).limit(threads)).scalars().all()
+    post_ids = db.session.execute(
+        select(Post.id).order_by(Post.id.desc()).limit(200)
+    ).scalars().all()
+    if not readers or not post_ids:
+        raise click.ClickException("the database is nearly empty, run 'flask seed' first.")
+    usernames = db.session.execute(select(User.username).limit(50)).scalars().all()
+
+    shared = {
+        "SQLALCHEMY_DATABASE_URI": current_app.config["SQLALCHEMY_DATABASE_URI"],
+        "CACHE_BACKEND": "null",
+        "WTF_CSRF_ENABLED": False,
+    }
+    profiles = [
+        # what the app used to run with: rollback journal, library defaults,
+        # reads and writes on the same connections
+        ("default sqlite", dict(shared, SQLALCHEMY_ENGINE_OPTIONS={}, READ_SESSION_ENABLED=False,
+                                SQLITE_PRAGMAS={})),
+        ("engine profile", dict(shared)),
+    ]
+
+    def worker(app, user_id, deadline, stats, seed):
+        rng = random.Random(seed)
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(user_id)
+        while time.perf_counter() < deadline:
+            roll = rng.random()
+            start = time.perf_counter()
+            if roll < write_ratio:
+                response = client.post(f"/post/{rng.choice(post_ids)}",
+                                       data={"body": "concurrency benchmark"})
+            elif roll < 0.5:
+                response = client.get("/")
+            elif roll < 0.8:
+                response = client.get(f"/post/{rng.choice(post_ids)}")
+            else:
+                response = client.get(f"/user/{rng.choice(usernames)}")
+            stats["timings"].append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 500:
+                stats["errors"] += 1
+
+    # journal_mode sticks to the database file, put it back to the default
+    # rollback journal before the first run (the profile run switches to WAL)
+    db.session.execute(text("PRAGMA journal_mode = DELETE"))
+    db.session.commit()
+
+    for name, overrides in profiles:
+        app = create_app(overrides)
+        # failed requests are counted below, not logged one by one
+        app.logger.setLevel(logging.CRITICAL)
+        stats = {"timings": [], "errors": 0}
+        deadline = time.perf_counter() + seconds
+        workers = [threading.Thread(target=worker, args=(app, readers[i % len(readers)],
+                                                          deadline, stats, i))
+                   for i in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose()
+
+        timings = stats["timings"]
+        click.echo(f"{name:<16} {len(timings) / seconds:8.1f} req/s"
+                   f"   p50 {percentile(timings, 0.5):8.2f} ms   p95 {percentile(timings, 0.95):8.2f} ms"
+                   f"   {stats['errors']} errors")
+
+    # take the benchmark's comments back out (through the orm, so the search
+    # index and caches see it)
+    for comment in Comment.query.filter_by(body="concurrency benchmark"):
+        db.session.delete(comment)
+    db.session.commit()
+
+
+@bench_cli.command("auth")
+@click.option("--repeat", default=300, show_default=True)
+@click.option("--logins", default=10, show_default=True, help="Logins per hashing method.")
+@click.option("--methods", default="scrypt:32768:8:1,pbkdf2:sha256:600000,pbkdf2:sha256:100000",
+              show_default=True, help="Comma separated werkzeug hashing methods to compare.")
+def auth_command(repeat, logins, methods):
+    """Per request cost of loading the logged in user, and login throughput per hashing method."""
+    import auth
+    from passwords import hash_password
+    from seed import SEED_PASSWORD
+
+    app = current_app._get_current_object()
+    user = User.query.order_by(User.following_count.desc()).first()
+    if user is None:
+        raise click.ClickException("no users in the database, seed some data first.")
+    user_id, email, saved_hash = user.id, user.email, user.password
+    saved_method = app.config["PASSWORD_HASH_METHOD"]
+    saved_timeout = app.config["AUTH_USER_CACHE_TIMEOUT"]
+
+    # --- loading the user behind the session cookie ---
+    def full_row():
+        # what load_user used to do
+        db.session.get(User, user_id)
+
+    def slim_row():
+        app.config["AUTH_USER_CACHE_TIMEOUT"] = 0
+        auth.load_user(user_id)
+
+    def cached():
+        app.config["AUTH_USER_CACHE_TIMEOUT"] = saved_timeout
+        auth.load_user(user_id)
+
+    try:
+        report("full users row", *timed(full_row, repeat))
+        report("slim row", *timed(slim_row, repeat))
+        report("cached AuthUser", *timed(cached, repeat))
+    finally:
+        app.config["AUTH_USER_CACHE_TIMEOUT"] = saved_timeout
+
+    results = []
+    errors = []
+
+    def run():
+        # the smallest logged in request: /login redirects someone logged in,
+        # so it is little more than loading the user
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(user_id)
+            session["_fresh"] = True
+        for timeout in (0, saved_timeout):
+            app.config["AUTH_USER_CACHE_TIMEOUT"] = timeout
+            timings = []
+            with count_queries() as counted:
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    client.get("/login")
+                    timings.append((time.perf_counter() - start) * 1000)
+            results.append((f"request, cache {'on' if timeout else 'off'}", timings,
+                            counted.count / repeat))
+
+        # logins through the route, a fresh client each time
+        for method in methods.split(","):
+            app.config["PASSWORD_HASH_METHOD"] = method
+            with app.app_context():
+                db.session.execute(update(User).where(User.id == user_id)
+                                   .values(password=hash_password(SEED_PASSWORD)))
+                db.session.commit()
+            timings = []
+            for _ in range(logins):
+                start = time.perf_counter()
+                response = app.test_client().post("/login", data={"email": email,
+                                                                  "password": SEED_PASSWORD})
+                timings.append((time.perf_counter() - start) * 1000)
+                if response.status_code != 302:
+                    errors.append(f"login with {method} -> {response.status_code}")
+                    return
+            results.append((f"login, {method}", timings, None))
+
+        # a hash from another policy is redone on the first login
+        app.config["PASSWORD_HASH_METHOD"] = saved_method
+        app.test_client().post("/login", data={"email": email, "password": SEED_PASSWORD})
+        with app.app_context():
+            stored = db.session.get(User, user_id).password
+        results.append((f"rehashed to {saved_method}: {stored.startswith(saved_method + '$')}",
+                        None, None))
+
+    app.config["WTF_CSRF_ENABLED"] = False
+    try:
+        # requests from a thread of their own, see "flask bench routes"
+        worker = threading.Thread(target=run)
+        worker.start()
+        worker.join()
+    finally:
+        app.config["AUTH_USER_CACHE_TIMEOUT"] = saved_timeout
+        app.config["PASSWORD_HASH_METHOD"] = saved_method
+        db.session.execute(update(User).where(User.id == user_id).values(password=saved_hash))
+        db.session.commit()
+    if errors:
+        raise click.ClickException(errors[0])
+
+    for label, timings, queries in results:
+        if timings is None:
+            click.echo(label)
+        elif queries is None:
+            click.echo(f"{label:<34} median {statistics.median(timings):8.2f} ms"
+                       f"   {1000 / statistics.median(timings):8.1f} logins/s per thread")
+        else:
+            report(label, timings, queries)
+
+
+# run in a fresh interpreter by "flask bench startup", prints its timings as json
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app(json.loads(sys.argv[1]))
+created = time.perf_counter()
+client = application.test_client()
+status = client.get(sys.argv[2]).status_code
+first = time.perf_counter()
+client.get(sys.argv[2])
+second = time.perf_counter()
+print(json.dumps({
+    "import": (imported - start) * 1000, "create_app": (created - imported) * 1000,
+    "first_request": (first - created) * 1000, "second_request": (second - first) * 1000,
+    "modules": len(sys.modules), "status": status,
+}))
+"""
+
+
+@bench_cli.command("startup")
+@click.option("--repeat", default=5, show_default=True, help="Fresh processes per mode.")
+@click.option("--url", default="/", show_default=True, help="What the first request asks for.")
+@click.option("--save", type=click.Path(dir_okay=False), help="Save the results as json.")
+@click.option("--compare", type=click.Path(exists=True, dir_okay=False),
+              help="Fail if startup or first request latency regressed against a saved run.")
+@click.option("--tolerance", default=0.25, show_default=True,
+              help="Allowed slowdown before --compare fails (0.25 = 25%).")
+def startup_command(repeat, url, save, compare, tolerance):
+    """Time a cold start: imports, create_app and the first request, in new processes."""
+    import json
+    import os
+    import subprocess
+    import sys
+    import tempfile
+
+    app = current_app._get_current_object()
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        filter(None, [app.root_path, os.environ.get("PYTHONPATH")])))
+
+    def start(config):
+        begin = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, json.dumps(config), url],
+                                cwd=app.root_path, env=env, capture_output=True, text=True)
+        total = (time.perf_counter() - begin) * 1000
+        if result.returncode != 0:
+            raise click.ClickException("the app did not start:\n" + result.stderr[-2000:])
+        timings = json.loads(result.stdout.strip().splitlines()[-1])
+        if timings.pop("status") >= 400:
+            raise click.ClickException(f"GET {url} failed in the new process")
+        return {"process": total, **timings}
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        warm_dir = os.path.join(tmp, "warm")
+        # every template compiled into warm_dir once, like a previous worker did
+        start({"TEMPLATE_CACHE_DIR": warm_dir})
+        modes = {
+            # what every worker used to do
+            "no template cache": lambda run: {"TEMPLATE_BYTECODE_CACHE": False,
+                                              "TEMPLATE_PRECOMPILE": False},
+            "precompile, cold cache": lambda run: {"TEMPLATE_CACHE_DIR": os.path.join(tmp, f"cold{run}")},
+            "precompile, warm cache": lambda run: {"TEMPLATE_CACHE_DIR": warm_dir},
+        }
+        for mode, config in modes.items():
+            runs = [start(config(run)) for run in range(repeat)]
+            results[mode] = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+
+    click.echo(f"{'median of ' + str(repeat):<24}{'process':>9}{'import':>9}{'create':>9}"
+               f"{'1st req':>9}{'2nd req':>9}{'modules':>9}")
+    for mode, result in results.items():
+        click.echo(f"{mode:<24}{result['process']:9.1f}{result['import']:9.1f}"
+                   f"{result['create_app']:9.1f}{result['first_request']:9.1f}"
+                   f"{result['second_request']:9.1f}{result['modules']:9.0f}")
+    click.echo("(ms, process is the whole run including the interpreter starting)")
+
+    if save:
+        with open(save, "w") as f:
+            json.dump(results, f, indent=2)
+    if compare:
+        with open(compare) as f:
+            baseline = json.load(f)
+        regressions = []
+        for mode, result in results.items():
+            before = baseline.get(mode)
+            if before is None:
+                continue
+            for key in ("process", "first_request"):
+                if result[key] > before[key] * (1 + tolerance):
+                    regressions.append(f"{mode}: {key} {before[key]:.1f} -> {result[key]:.1f} ms")
+        if regressions:
+            raise click.ClickException("regressions:\n  " + "\n  ".join(regressions))
+        click.echo("no regressions against " + compare)
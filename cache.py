@@ -0,0 +1,323 @@
+import functools
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import click
+from flask import current_app, make_response, request, session
+from flask.cli import AppGroup
+from flask_login import current_user
+from markupsafe import Markup
+
+
+# caching for anonymous page views and for fragments of pages.
+#
+# nothing is ever looked up and deleted on a write. every cache key includes
+# the current "version" of the things it depends on ("post:12", "tag:flask",
+# "user:alice", "posts" for the post listings). a write just gives those
+# dependencies a new version, and every entry built from the old version is
+# never looked at again (it ages out of the LRU / TTL on its own).
+#
+# backends:
+#   memory - an LRU dict inside this process, bounded by entries and bytes.
+#            with several worker processes each has its own copy, and a write
+#            only invalidates the worker that handled it (the rest catch up
+#            when the TTL runs out).
+#   sqlite - a small shared cache file every worker on the machine can see,
+#            a local stand-in for memcached/redis. bounded by entries: every
+#            so many writes, expired entries and then the oldest ones over
+#            the limit are deleted.
+#   null   - caching turned off.
+
+cache_cli = AppGroup("cache", help="Manage the page cache.")
+
+
+class MemoryCache:
+    def __init__(self, max_entries=1000, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at, size = entry
+            if expires_at is not None and expires_at < time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        size = _size_of(value)
+        expires_at = time.time() + timeout if timeout else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, expires_at, size)
+            self.size += size
+            while self._entries and (
+                len(self._entries) > self.max_entries
+                or (self.max_bytes is not None and self.size > self.max_bytes)
+            ):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        self.size -= self._entries.pop(key)[2]
+
+
+def _size_of(value):
+    # roughly how much memory an entry holds, for CACHE_MAX_BYTES
+    if isinstance(value, CachedPage):
+        return len(value.body)
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    return 0
+
+
+class SQLiteCache:
+    # how many sets (in this process) between two prunes
+    PRUNE_EVERY = 100
+
+    def __init__(self, path, max_entries=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._sets = 0
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entries ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL, stored_at REAL NOT NULL)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS ix_cache_entries_expires_at ON cache_entries (expires_at)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS ix_cache_entries_stored_at ON cache_entries (stored_at)"
+        )
+
+    def _connection(self):
+        # one connection per thread, autocommit
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        row = self._connection().execute(
+            "SELECT value, expires_at FROM cache_entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if row[1] is not None and row[1] < time.time():
+            self.delete(key)
+            return None
+        return pickle.loads(row[0])
+
+    def set(self, key, value, timeout=None):
+        now = time.time()
+        expires_at = now + timeout if timeout else None
+        self._connection().execute(
+            "INSERT OR REPLACE INTO cache_entries (key, value, expires_at, stored_at) "
+            "VALUES (?, ?, ?, ?)",
+            (key, pickle.dumps(value), expires_at, now),
+        )
+        # keys carry versions (and query strings), most entries are never
+        # asked for again and wouldn't expire on a get
+        self._sets += 1
+        if self._sets >= self.PRUNE_EVERY:
+            self._sets = 0
+            self.prune()
+
+    def prune(self):
+        # expired entries, then the oldest ones over max_entries
+        connection = self._connection()
+        expired = connection.execute(
+            "DELETE FROM cache_entries WHERE expires_at < ?", (time.time(),)
+        ).rowcount
+        evicted = connection.execute(
+            "DELETE FROM cache_entries WHERE key IN ("
+            "SELECT key FROM cache_entries ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        ).rowcount
+        self.evictions += evicted
+        return expired + evicted
+
+    def delete(self, key):
+        self._connection().execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+
+    def clear(self):
+        self._connection().execute("DELETE FROM cache_entries")
+
+
+class NullCache:
+    def get(self, key):
+        return None
+
+    def set(self, key, value, timeout=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class CachedPage:
+    def __init__(self, body, content_type, etag, last_modified):
+        self.body = body
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+class PageCache:
+    def __init__(self, app=None):
+        self.backend = NullCache()
+        self.timeout = None
+        self.hits = {}
+        self.misses = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("CACHE_BACKEND", "memory")
+        app.config.setdefault("CACHE_DEFAULT_TIMEOUT", 300)
+        app.config.setdefault("CACHE_MAX_ENTRIES", 2000)
+        app.config.setdefault("CACHE_MAX_BYTES", 64 * 1024 * 1024)
+        app.config.setdefault("CACHE_SQLITE_PATH", os.path.join(app.instance_path, "cache.db"))
+
+        backend = app.config["CACHE_BACKEND"]
+        if backend == "memory":
+            self.backend = MemoryCache(app.config["CACHE_MAX_ENTRIES"], app.config["CACHE_MAX_BYTES"])
+        elif backend == "sqlite":
+            os.makedirs(os.path.dirname(app.config["CACHE_SQLITE_PATH"]), exist_ok=True)
+            self.backend = SQLiteCache(app.config["CACHE_SQLITE_PATH"], app.config["CACHE_MAX_ENTRIES"])
+        elif backend == "null":
+            self.backend = NullCache()
+        else:
+            raise ValueError(f"unknown CACHE_BACKEND {backend!r}")
+        self.timeout = app.config["CACHE_DEFAULT_TIMEOUT"]
+
+        app.extensions["page_cache"] = self
+
+        app.jinja_env.globals["cached_fragment"] = self.fragment
+        app.cli.add_command(cache_cli)
+
+    # --- versions ---
+
+    def version(self, dependency):
+        # a missing version gets a brand new token (never 0) so an entry can't
+        # come back to life because its version was evicted
+        version = self.backend.get(f"version:{dependency}")
+        if version is None:
+            version = self.invalidate(dependency)
+        return version
+
+    def invalidate(self, *dependencies):
+        version = uuid.uuid4().hex
+        for dependency in dependencies:
+            self.backend.set(f"version:{dependency}", version)
+        return version
+
+    def make_key(self, name, dependencies):
+        versions = ",".join(f"{dep}={self.version(dep)}" for dep in dependencies)
+        return f"{name}|{versions}"
+
+    # --- metrics ---
+
+    def _count(self, counter, kind):
+        counter[kind] = counter.get(kind, 0) + 1
+
+    def stats(self):
+        kinds = sorted(set(self.hits) | set(self.misses))
+        return {kind: {"hits": self.hits.get(kind, 0), "misses": self.misses.get(kind, 0)}
+                for kind in kinds}
+
+    # --- fragments ---
+
+    def fragment(self, name, dependencies, caller):
+        # {% call cached_fragment("post-summary-1", ["post:1"]) %}...{% endcall %}
+        key = self.make_key(f"fragment:{name}", dependencies)
+        html = self.backend.get(key)
+        if html is not None:
+            self._count(self.hits, "fragment")
+            return Markup(html)
+        self._count(self.misses, "fragment")
+        html = str(caller())
+        self.backend.set(key, html, self.timeout)
+        return Markup(html)
+
+    # --- whole pages ---
+
+    def cached_page(self, dependencies):
+        """Cache a view's response for anonymous visitors.
+
+        ``dependencies`` gets the view's arguments and returns the
+        dependency names the page is built from.
+        """
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(**kwargs):
+                # logged in pages (and pages showing a flashed message) are
+                # personal, those always go to the view
+                if (request.method != "GET" or current_user.is_authenticated
+                        or session.get("_flashes")):
+                    return view(**kwargs)
+
+                key = self.make_key(f"page:{request.full_path}", dependencies(**kwargs))
+                page = self.backend.get(key)
+                if page is not None:
+                    self._count(self.hits, "page")
+                else:
+                    self._count(self.misses, "page")
+                    response = make_response(view(**kwargs))
+                    if response.status_code != 200 or response.direct_passthrough:
+                        return response
+                    body = response.get_data()
+                    page = CachedPage(body, response.content_type,
+                                      hashlib.md5(body).hexdigest(), int(time.time()))
+                    self.backend.set(key, page, self.timeout)
+
+                response = current_app.response_class(page.body, content_type=page.content_type)
+                response.set_etag(page.etag)
+                response.last_modified = page.last_modified
+                # browsers should ask again each time, but can get a 304
+                response.cache_control.no_cache = True
+                response.vary.add("Cookie")
+                return response.make_conditional(request)
+            return wrapper
+        return decorator
+
+
+@cache_cli.command("clear")
+def clear_command():
+    """Drop every cached page and fragment."""
+    current_app.extensions["page_cache"].backend.clear()
+    click.echo("cache cleared.")
@@ -0,0 +1,117 @@
+class Config:
+    # secret key
+    SECRET_KEY = "a-secret-key-for-flaskform"
+
+    # set up database
+    SQLALCHEMY_DATABASE_URI = "sqlite:///my_database.db"
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # engine profile. one pool of connections per process, waiting up to 30s
+    # for the sqlite write lock instead of failing straight away.
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "pool_size": 10,
+        "max_overflow": 20,
+        "pool_timeout": 30,
+        "pool_recycle": 3600,
+        "connect_args": {"timeout": 30},
+    }
+    # run on every new sqlite connection (see database.py)
+    SQLITE_PRAGMAS = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 30000,
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,
+        "temp_store": "MEMORY",
+    }
+
+    # GET requests read through a separate read-only engine. leave the uri
+    # empty to open the primary database file read-only, or point it at a
+    # replica.
+    READ_SESSION_ENABLED = True
+    SQLALCHEMY_READ_DATABASE_URI = None
+
+    # password hashing for new hashes (any werkzeug method with its cost),
+    # stored hashes made differently are redone when their owner logs in
+    PASSWORD_HASH_METHOD = "scrypt:32768:8:1"
+    PASSWORD_SALT_LENGTH = 16
+    # how long a process may reuse the logged in user it loaded for a request
+    AUTH_USER_CACHE_TIMEOUT = 30
+    AUTH_USER_CACHE_SIZE = 10000
+
+    # how many posts to show on one page of a listing
+    POSTS_PER_PAGE = 20
+
+    # authors with more followers than this are not copied into every
+    # follower's timeline when they post, their posts are merged in at read
+    # time instead.
+    TIMELINE_FANOUT_THRESHOLD = 1000
+    # how many of an author's recent posts show up in a timeline after a follow
+    TIMELINE_BACKFILL_POSTS = 50
+
+    # how many users/posts to show per list on a profile page
+    PROFILE_LIST_PER_PAGE = 20
+
+    # how many comments to show per page under a post
+    COMMENTS_PER_PAGE = 50
+
+    # tag directory page size, and the trending widget: the most used tags
+    # on posts from the last TRENDING_TAGS_HOURS hours
+    TAGS_PER_PAGE = 50
+    TRENDING_TAGS_LIMIT = 10
+    TRENDING_TAGS_HOURS = 48
+
+    # json api (api.py): the most items a page can ask for with ?limit=, and
+    # how many rows an ndjson export reads from the database at a time
+    API_MAX_PER_PAGE = 100
+    API_EXPORT_BATCH_SIZE = 500
+
+    # search results per page, and how deep anyone can page into them
+    SEARCH_RESULTS_PER_PAGE = 20
+    SEARCH_MAX_PAGE = 50
+
+    # page cache for anonymous visitors. "memory" is per process, use
+    # "sqlite" to share one cache between the worker processes on a machine.
+    CACHE_BACKEND = "memory"
+    CACHE_DEFAULT_TIMEOUT = 300
+
+    # background jobs (jobs.py). "thread" runs them in a thread of each web
+    # process, "worker" leaves them to "flask worker" processes, "inline" runs
+    # them before the response of the request that queued them. a failed job
+    # is retried JOBS_MAX_ATTEMPTS times, JOBS_RETRY_DELAY seconds later and
+    # twice as long each time after that.
+    JOBS_MODE = "thread"
+    JOBS_POLL_INTERVAL = 1.0
+    JOBS_MAX_ATTEMPTS = 5
+    JOBS_RETRY_DELAY = 10
+    # a job still "running" after this many seconds is taken to have lost its
+    # worker and is run again
+    JOBS_LOCK_TIMEOUT = 300
+
+    # compiled templates are kept on disk (TEMPLATE_CACHE_DIR, default
+    # instance/jinja_cache) and all of them are loaded when the app is
+    # created, so no request waits for a template to compile
+    TEMPLATE_BYTECODE_CACHE = True
+    TEMPLATE_PRECOMPILE = True
+
+    # per request sql/render timings. /metrics (prometheus format) is opt-in.
+    METRICS_ENABLED = False
+    SQL_SLOW_QUERY_THRESHOLD = 0.1
+    N_PLUS_ONE_THRESHOLD = 5
+
+
+class TestingConfig(Config):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    # in memory, so there is only ever one connection
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+    READ_SESSION_ENABLED = False
+    CACHE_BACKEND = "null"
+    # side effects are done by the time the test client gets its response
+    JOBS_MODE = "inline"
+    # nothing written next to the code, templates compile as they are used
+    TEMPLATE_BYTECODE_CACHE = False
+    TEMPLATE_PRECOMPILE = False
+    # every test signs up its users, a slow hash is all the suite would time
+    PASSWORD_HASH_METHOD = "pbkdf2:sha256:1000"
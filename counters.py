@@ -0,0 +1,77 @@
+import click
+from flask.cli import AppGroup
+from sqlalchemy import bindparam, func, or_, select, update
+
+from extensions import db
+from models import Post, User, follows
+
+
+# the follower/following/post counts shown on profiles live on the users row,
+# so showing them never has to load (or count) the related rows.
+
+counters_cli = AppGroup("counters", help="Maintain the denormalized user counters.")
+
+
+def adjust(user_id, **deltas):
+    # adjust(user.id, follower_count=1) -> one UPDATE done in the database,
+    # so two requests changing the same counter can't overwrite each other
+    values = {getattr(User, name): getattr(User, name) + delta for name, delta in deltas.items()}
+    db.session.execute(update(User).where(User.id == user_id).values(values))
+
+
+def adjust_many(name, deltas):
+    # adjust_many("post_count", {user_id: delta, ...}) -> one executemany
+    # UPDATE, for bulk writes (see importer.py)
+    deltas = [{"user_id": user_id, "delta": delta} for user_id, delta in deltas.items() if delta]
+    if not deltas:
+        return
+    users = User.__table__
+    column = users.c[name]
+    db.session.execute(
+        update(users).where(users.c.id == bindparam("user_id"))
+        .values({column: column + bindparam("delta")}),
+        deltas,
+    )
+
+
+def _true_counts():
+    return {
+        User.follower_count: select(func.count()).select_from(follows)
+        .where(follows.c.followed_id == User.id).scalar_subquery(),
+        User.following_count: select(func.count()).select_from(follows)
+        .where(follows.c.follower_id == User.id).scalar_subquery(),
+        User.post_count: select(func.count()).select_from(Post)
+        .where(Post.user_id == User.id).scalar_subquery(),
+    }
+
+
+def recount_all(batch_size=1000):
+    # recount every user in batches, returns (checked, repaired)
+    counts = _true_counts()
+    drifted = or_(*[column != true_count for column, true_count in counts.items()])
+    last_id = 0
+    checked = repaired = 0
+    while True:
+        user_ids = db.session.execute(
+            select(User.id).where(User.id > last_id).order_by(User.id).limit(batch_size)
+        ).scalars().all()
+        if not user_ids:
+            break
+        result = db.session.execute(
+            update(User).where(User.id.in_(user_ids), drifted).values(counts)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        checked += len(user_ids)
+        repaired += result.rowcount
+        last_id = user_ids[-1]
+    return checked, repaired
+
+
+@counters_cli.command("recount")
+@click.option("--batch-size", default=1000, show_default=True,
+              help="How many users to recount per transaction.")
+def recount_command(batch_size):
+    """Recount followers, following and posts for every user."""
+    checked, repaired = recount_all(batch_size)
+    click.echo(f"checked {checked} users, repaired {repaired}.")
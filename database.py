@@ -0,0 +1,81 @@
+import functools
+
+from flask import g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+
+# production sqlite engine profile and the read/write session split.
+#
+# every sqlite connection gets the pragmas in SQLITE_PRAGMAS when it is
+# opened: WAL lets readers carry on while someone writes, busy_timeout makes
+# a writer wait for the lock instead of failing with "database is locked",
+# and mmap/cache_size keep hot pages in memory. foreign keys are always
+# switched on (sqlite leaves them off by default): the ON DELETE CASCADEs in
+# models.py depend on them.
+#
+# with READ_SESSION_ENABLED, GET requests run their SELECTs on a separate
+# "read" engine with a pool of its own: a replica when
+# SQLALCHEMY_READ_DATABASE_URI is set, otherwise the same database file
+# opened query_only. anything that writes (a flush, an INSERT/UPDATE/DELETE)
+# still goes to the primary engine.
+
+READ_BIND = "read"
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and _reads_go_to_replica() and not self._flushing \
+                and not getattr(clause, "is_dml", False):
+            engine = self._db.engines.get(READ_BIND)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _reads_go_to_replica():
+    return (has_request_context() and request.method in ("GET", "HEAD")
+            and not g.get("use_primary", False))
+
+
+def use_primary(view):
+    # for GET routes that write (follow/unfollow): read from the primary too,
+    # so the checks they make see the latest data
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g.use_primary = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def configure_read_bind(app):
+    # call before db.init_app(app): adds the "read" bind to the config
+    if not app.config["READ_SESSION_ENABLED"]:
+        return
+    binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+    binds.setdefault(READ_BIND, {
+        "url": app.config["SQLALCHEMY_READ_DATABASE_URI"] or app.config["SQLALCHEMY_DATABASE_URI"],
+    })
+    app.config["SQLALCHEMY_BINDS"] = binds
+
+
+def configure_engines(app, db):
+    # call after db.init_app(app): sets the pragmas on every sqlite connection
+    pragmas = app.config["SQLITE_PRAGMAS"]
+    with app.app_context():
+        for key, engine in db.engines.items():
+            if engine.dialect.name != "sqlite":
+                continue
+            read_only = key == READ_BIND
+            event.listen(engine, "connect", functools.partial(
+                _set_pragmas, pragmas=pragmas, read_only=read_only))
+
+
+def _set_pragmas(dbapi_connection, connection_record, pragmas, read_only):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys = ON")
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    if read_only:
+        cursor.execute("PRAGMA query_only = ON")
+    cursor.close()
@@ -1,2 +1,12 @@
 from flask_sqlalchemy import SQLAlchemy
-db = SQLAlchemy()
\ No newline at end of file
+from flask_login import LoginManager
+from flask_wtf.csrf import CSRFProtect
+from cache import PageCache
+from instrumentation import Instrumentation
+from database import RoutingSession
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+login_manager = LoginManager()
+csrf = CSRFProtect()
+cache = PageCache()
+instrumentation = Instrumentation()
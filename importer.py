@@ -0,0 +1,478 @@
+import csv
+import datetime
+import itertools
+import json
+import os
+import time
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import false, func, insert, select, tuple_, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from extensions import cache, db
+from models import Comment, ImportCheckpoint, Post, Tag, User, follows, post_tags
+import counters
+import search
+import timeline
+from passwords import hash_password
+from rendering import render_body
+from tags import apply_tag_changes, hour_bucket, parse_tag_names
+
+
+# bulk loading existing content: "flask import users|posts|comments|follows".
+#
+# a source is a JSONL file (one object per line) or a CSV file with a header
+# row, read as a stream, one batch of records at a time. a batch is a handful
+# of executemany inserts plus the bookkeeping a write through the site would
+# do (counters, tag counters, search index, timelines), all in one
+# transaction together with the checkpoint: how many records of the source
+# are done. an interrupted import picks up after the last batch that
+# committed when it is run again on the same, unchanged file (stdin is
+# never checkpointed).
+#
+# users, posts and tags are referred to by name (username, title, tag name),
+# the ids are this database's own. records that are invalid or already there
+# (same username/email, same post title, same follow) are skipped and
+# reported.
+#
+#   users:    username, email, password_hash (werkzeug format) or password,
+#             about_me, created_at
+#   posts:    title, body, author, tags ("a, b" or a list), created_at
+#   comments: post (its title), author, body, created_at
+#   follows:  follower, followed
+#
+# created_at is ISO 8601 (default: now), converted to naive utc.
+
+import_cli = AppGroup("import", help="Bulk load users, posts, comments and follows.")
+
+
+class InvalidRecord(Exception):
+    pass
+
+
+def read_records(stream, fmt):
+    # records as dicts, None for a line that isn't valid json (so numbering
+    # still matches the source)
+    if fmt == "csv":
+        yield from csv.DictReader(stream)
+        return
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield record if isinstance(record, dict) else None
+
+
+def _field(record, name, required=True):
+    value = record.get(name)
+    if isinstance(value, str):
+        value = value.strip()
+    if required and not value:
+        raise InvalidRecord(f"missing {name}")
+    return value or None
+
+
+def _username(record, name):
+    # "alice", or {"username": "alice", ...} as in the api's output
+    value = record.get(name)
+    if isinstance(value, dict):
+        value = value.get("username")
+    if not isinstance(value, str) or not value.strip():
+        raise InvalidRecord(f"missing {name}")
+    return value.strip()
+
+
+def _created_at(record):
+    value = _field(record, "created_at", required=False)
+    if value is None:
+        return datetime.datetime.utcnow()
+    try:
+        moment = datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise InvalidRecord(f"bad created_at {value!r}")
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def _tag_names(record):
+    value = record.get("tags")
+    if isinstance(value, list):
+        value = ",".join(str(name) for name in value)
+    return parse_tag_names(value)
+
+
+def _new_ids(model, count):
+    # ids for rows about to be inserted, so related rows can point at them
+    # without reading anything back. safe because the batch already holds
+    # the write lock (see import_records).
+    first = (db.session.execute(select(func.max(model.id))).scalar() or 0) + 1
+    return list(range(first, first + count))
+
+
+def _user_ids(usernames):
+    # {username: id} for the ones that exist
+    if not usernames:
+        return {}
+    return dict(db.session.execute(
+        select(User.username, User.id).where(User.username.in_(set(usernames)))
+    ).all())
+
+
+class Loader:
+    # one import of `kind`: load(loader, numbered_records) (see LOADERS)
+    # inserts what it can of a batch and returns the cache dependencies it
+    # touched, the loader keeps the totals and the skipped records.
+
+    # how many skipped records are kept to be reported
+    REPORT_SKIPPED = 20
+
+    def __init__(self, kind, load):
+        self.kind = kind
+        self._load = load
+        self.inserted = 0
+        self.skipped = 0
+        self.skip_reasons = []
+        # every tag name seen so far -> its id, so each name is looked up (or
+        # created) once per import, not once per post
+        self.tag_ids = {}
+
+    def skip(self, number, reason):
+        self.skipped += 1
+        if len(self.skip_reasons) < self.REPORT_SKIPPED:
+            self.skip_reasons.append((number, reason))
+
+    def parse(self, numbered_records, parse_one):
+        # [(number, parsed)] for the records parse_one() accepts
+        parsed = []
+        for number, record in numbered_records:
+            if record is None:
+                self.skip(number, "not a json object")
+                continue
+            try:
+                parsed.append((number, parse_one(record)))
+            except InvalidRecord as error:
+                self.skip(number, str(error))
+        return parsed
+
+    def load(self, numbered_records):
+        return self._load(self, numbered_records)
+
+
+# --- users ---
+
+def _parse_user(record):
+    username = _field(record, "username")
+    email = _field(record, "email")
+    password_hash = _field(record, "password_hash", required=False)
+    if password_hash is None:
+        # hashing is slow on purpose, prefer exporting the hashes (any
+        # werkzeug format, they are redone under our policy on login)
+        password_hash = hash_password(_field(record, "password"))
+    return {"username": username, "email": email, "password": password_hash,
+            "about_me": _field(record, "about_me", required=False),
+            "created_at": _created_at(record)}
+
+
+def load_users(loader, numbered_records):
+    parsed = loader.parse(numbered_records, _parse_user)
+    usernames = {row["username"] for _, row in parsed}
+    emails = {row["email"] for _, row in parsed}
+    taken = set(db.session.execute(
+        select(User.username).where(User.username.in_(usernames))
+    ).scalars())
+    taken |= set(db.session.execute(
+        select(User.email).where(User.email.in_(emails))
+    ).scalars())
+
+    rows = []
+    for number, row in parsed:
+        if row["username"] in taken or row["email"] in taken:
+            loader.skip(number, f"user {row['username']} or email {row['email']} exists")
+            continue
+        taken.update((row["username"], row["email"]))
+        rows.append(row)
+    if rows:
+        db.session.execute(insert(User.__table__), rows)
+    loader.inserted += len(rows)
+    return [f"user:{row['username']}" for row in rows]
+
+
+# --- posts ---
+
+def _parse_post(record):
+    body = _field(record, "body")
+    return {"title": _field(record, "title"), "body": body, "author": _username(record, "author"),
+            "tags": _tag_names(record), "created_at": _created_at(record)}
+
+
+def _resolve_tags(tag_ids, names):
+    missing = [name for name in set(names) if name not in tag_ids]
+    if not missing:
+        return
+    db.session.execute(insert(Tag).prefix_with("OR IGNORE"), [{"name": name} for name in missing])
+    tag_ids.update(db.session.execute(
+        select(Tag.name, Tag.id).where(Tag.name.in_(missing))
+    ).all())
+
+
+def load_posts(loader, numbered_records):
+    parsed = loader.parse(numbered_records, _parse_post)
+    authors = _user_ids(post["author"] for _, post in parsed)
+    titles = set(db.session.execute(
+        select(Post.title).where(Post.title.in_({post["title"] for _, post in parsed}))
+    ).scalars())
+
+    posts = []
+    for number, post in parsed:
+        if post["author"] not in authors:
+            loader.skip(number, f"no user {post['author']}")
+        elif post["title"] in titles:
+            loader.skip(number, f"a post titled {post['title']!r} exists")
+        else:
+            titles.add(post["title"])
+            posts.append(post)
+    if not posts:
+        return []
+
+    post_ids = _new_ids(Post, len(posts))
+    db.session.execute(insert(Post.__table__), [
+        {"id": post_id, "title": post["title"], "body": post["body"], **render_body(post["body"]),
+         "created_at": post["created_at"], "user_id": authors[post["author"]]}
+        for post_id, post in zip(post_ids, posts)
+    ])
+
+    _resolve_tags(loader.tag_ids, (name for post in posts for name in post["tags"]))
+    tag_rows = []
+    tag_changes = {}
+    post_counts = {}
+    for post_id, post in zip(post_ids, posts):
+        bucket = hour_bucket(post["created_at"])
+        for name in post["tags"]:
+            tag_rows.append({"post_id": post_id, "tag_id": loader.tag_ids[name],
+                             "created_at": post["created_at"]})
+            key = (loader.tag_ids[name], bucket)
+            tag_changes[key] = tag_changes.get(key, 0) + 1
+        user_id = authors[post["author"]]
+        post_counts[user_id] = post_counts.get(user_id, 0) + 1
+    if tag_rows:
+        db.session.execute(insert(post_tags), tag_rows)
+
+    # what create_post would have done, for the whole batch at once
+    apply_tag_changes(tag_changes)
+    counters.adjust_many("post_count", post_counts)
+    search.add_rows([search.post_index_row(post_id, post["title"], post["body"])
+                     for post_id, post in zip(post_ids, posts)])
+    timeline.fan_out_posts(post_ids)
+
+    loader.inserted += len(posts)
+    return (["posts", "tags"] + [f"user:{name}" for name in {post["author"] for post in posts}]
+            + [f"tag:{name}" for name in {name for post in posts for name in post["tags"]}])
+
+
+# --- comments ---
+
+def _parse_comment(record):
+    return {"post": _field(record, "post"), "author": _username(record, "author"),
+            "body": _field(record, "body"), "created_at": _created_at(record)}
+
+
+def load_comments(loader, numbered_records):
+    parsed = loader.parse(numbered_records, _parse_comment)
+    authors = _user_ids(comment["author"] for _, comment in parsed)
+    post_ids = dict(db.session.execute(
+        select(Post.title, Post.id).where(Post.title.in_({comment["post"] for _, comment in parsed}))
+    ).all())
+
+    comments = []
+    for number, comment in parsed:
+        if comment["author"] not in authors:
+            loader.skip(number, f"no user {comment['author']}")
+        elif comment["post"] not in post_ids:
+            loader.skip(number, f"no post titled {comment['post']!r}")
+        else:
+            comments.append({"body": comment["body"], "created_at": comment["created_at"],
+                             "user_id": authors[comment["author"]],
+                             "post_id": post_ids[comment["post"]]})
+    if not comments:
+        return []
+
+    comment_ids = _new_ids(Comment, len(comments))
+    db.session.execute(insert(Comment.__table__), [
+        {"id": comment_id, **comment} for comment_id, comment in zip(comment_ids, comments)
+    ])
+    search.add_rows([search.comment_index_row(comment_id, comment["post_id"], comment["body"])
+                     for comment_id, comment in zip(comment_ids, comments)])
+
+    loader.inserted += len(comments)
+    return [f"post:{post_id}" for post_id in {comment["post_id"] for comment in comments}]
+
+
+# --- follows ---
+
+def _parse_follow(record):
+    edge = (_username(record, "follower"), _username(record, "followed"))
+    if edge[0] == edge[1]:
+        raise InvalidRecord(f"{edge[0]} can't follow themselves")
+    return edge
+
+
+def load_follows(loader, numbered_records):
+    parsed = loader.parse(numbered_records, _parse_follow)
+    ids = _user_ids(name for _, edge in parsed for name in edge)
+
+    edges = {}
+    for number, (follower, followed) in parsed:
+        missing = [name for name in (follower, followed) if name not in ids]
+        if missing:
+            loader.skip(number, f"no user {missing[0]}")
+            continue
+        edge = (ids[follower], ids[followed])
+        if edge in edges:
+            loader.skip(number, f"{follower} follows {followed} twice in the source")
+            continue
+        edges[edge] = (number, follower, followed)
+    existing = set(db.session.execute(
+        select(follows.c.follower_id, follows.c.followed_id)
+        .where(tuple_(follows.c.follower_id, follows.c.followed_id).in_(list(edges)))
+    ).all()) if edges else set()
+    for edge in existing:
+        number, follower, followed = edges.pop(edge)
+        loader.skip(number, f"{follower} already follows {followed}")
+    if not edges:
+        return []
+
+    db.session.execute(insert(follows), [{"follower_id": follower_id, "followed_id": followed_id}
+                                         for follower_id, followed_id in edges])
+    following = {}
+    followers = {}
+    for follower_id, followed_id in edges:
+        following[follower_id] = following.get(follower_id, 0) + 1
+        followers[followed_id] = followers.get(followed_id, 0) + 1
+    counters.adjust_many("following_count", following)
+    counters.adjust_many("follower_count", followers)
+    timeline.backfill_follows(list(edges))
+
+    loader.inserted += len(edges)
+    return [f"user:{name}" for _, follower, followed in edges.values()
+            for name in (follower, followed)]
+
+
+# --- checkpoints ---
+
+def checkpoint(source):
+    return db.session.execute(
+        select(ImportCheckpoint.records).where(ImportCheckpoint.source == source)
+    ).scalar() or 0
+
+
+def _save_checkpoint(source, records):
+    stmt = sqlite_insert(ImportCheckpoint.__table__)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=["source"],
+        set_={"records": stmt.excluded.records, "updated_at": datetime.datetime.utcnow()},
+    ), {"source": source, "records": records, "updated_at": datetime.datetime.utcnow()})
+
+
+def _lock_for_writing():
+    # a write that changes nothing, for the write lock without a checkpoint
+    db.session.execute(
+        update(ImportCheckpoint).where(false()).values(records=0)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def import_records(loader, records, source, batch_size=1000, start=0):
+    # load `records` in batches, skipping the first `start` (done by an
+    # earlier run). yields the number of records done after each batch.
+    # with source None nothing is checkpointed.
+    numbered = enumerate(records, start=1)
+    for _ in itertools.islice(numbered, start):
+        pass
+    while True:
+        batch = list(itertools.islice(numbered, batch_size))
+        if not batch:
+            return
+        try:
+            # the checkpoint goes first: writing it takes sqlite's write lock
+            # for the rest of the batch
+            if source is not None:
+                _save_checkpoint(source, batch[-1][0])
+            else:
+                _lock_for_writing()
+            dependencies = loader.load(batch)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        cache.invalidate(*dependencies)
+        yield batch[-1][0]
+
+
+def _open(path):
+    if path == "-":
+        return click.get_text_stream("stdin")
+    # newline="" so quoted csv fields can hold line breaks
+    return open(path, encoding="utf-8", newline="")
+
+
+def _source_key(kind, path):
+    # what the checkpoint is saved under: the file as it is now, so a file
+    # replaced by another with the same name starts from the beginning
+    stat = os.stat(path)
+    return f"{kind}:{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def _import_command(kind, load):
+    @import_cli.command(kind, help=f"Load {kind} from a JSONL or CSV file ('-' for stdin, which "
+                                   "is never resumed).")
+    @click.argument("path", type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+    @click.option("--format", "fmt", type=click.Choice(["jsonl", "csv"]),
+                  help="Default: from the file extension (.csv or anything else as jsonl).")
+    @click.option("--batch-size", default=1000, show_default=True,
+                  help="How many records to load per transaction.")
+    @click.option("--restart", is_flag=True,
+                  help="Start from the first record instead of the checkpoint.")
+    def command(path, fmt, batch_size, restart):
+        if fmt is None:
+            fmt = "csv" if path.lower().endswith(".csv") else "jsonl"
+        # stdin can't be told apart from an earlier stream, it has no checkpoint
+        source = None if path == "-" else _source_key(kind, path)
+        start = 0 if restart or source is None else checkpoint(source)
+        if start:
+            click.echo(f"resuming after record {start} (--restart to start over)")
+
+        loader = Loader(kind, load)
+        started = time.perf_counter()
+        done = start
+        with _open(path) as stream:
+            for done in import_records(loader, read_records(stream, fmt), source,
+                                       batch_size, start):
+                elapsed = time.perf_counter() - started
+                click.echo(f"{kind}: {done} records, {(done - start) / elapsed:,.0f} records/s")
+
+        elapsed = time.perf_counter() - started
+        for number, reason in loader.skip_reasons:
+            click.echo(f"skipped record {number}: {reason}")
+        if loader.skipped > len(loader.skip_reasons):
+            click.echo(f"... and {loader.skipped - len(loader.skip_reasons)} more skipped")
+        click.echo(f"done: {loader.inserted} {kind} imported, {loader.skipped} skipped, "
+                   f"{done - start} records in {elapsed:.1f}s "
+                   f"({loader.inserted / elapsed if elapsed else 0:,.0f} rows/s).")
+
+    return command
+
+
+LOADERS = {
+    "users": load_users,
+    "posts": load_posts,
+    "comments": load_comments,
+    "follows": load_follows,
+}
+
+for _kind, _load in LOADERS.items():
+    _import_command(_kind, _load)
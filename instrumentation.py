@@ -0,0 +1,265 @@
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from flask import (Response, before_render_template, current_app, g, has_request_context,
+                   request, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# per request sql/render instrumentation.
+#
+# every statement any engine runs is timed and handed to whoever is
+# collecting right now: the current request, and/or a count_queries() block.
+# at the end of a request the numbers go into histograms per endpoint, which
+# /metrics serves in prometheus text format (only when METRICS_ENABLED).
+#
+# the same statement running over and over within one request is almost
+# always a lazy load inside a loop (post.owner, comment.author ...), so those
+# get logged as probable N+1s.
+#
+# numbers are per process: with several workers each one reports its own.
+
+_local = threading.local()
+
+
+def _collectors():
+    if not hasattr(_local, "collectors"):
+        _local.collectors = []
+    return _local.collectors
+
+
+class QueryCollector:
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.statements = {}
+        self.slow = []
+
+    def record(self, statement, duration, slow_threshold):
+        self.count += 1
+        self.total_time += duration
+        self.statements[statement] = self.statements.get(statement, 0) + 1
+        if slow_threshold is not None and duration >= slow_threshold:
+            self.slow.append((statement, duration))
+
+    def repeated(self, threshold):
+        # statements that ran at least `threshold` times
+        return {statement: count for statement, count in self.statements.items()
+                if count >= threshold}
+
+
+@contextmanager
+def count_queries():
+    """Count the statements run inside the block.
+
+        with count_queries() as queries:
+            client.get("/")
+        assert queries.count <= 5
+    """
+    collector = QueryCollector()
+    _collectors().append(collector)
+    try:
+        yield collector
+    finally:
+        _collectors().remove(collector)
+
+
+@contextmanager
+def query_budget(max_queries):
+    # fail if the block runs more than max_queries statements
+    with count_queries() as collector:
+        yield collector
+    if collector.count > max_queries:
+        statements = "\n".join(f"  {count}x {statement}"
+                               for statement, count in collector.statements.items())
+        raise AssertionError(
+            f"expected at most {max_queries} queries, ran {collector.count}:\n{statements}"
+        )
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # popped whether or not anything is collecting, or every statement run
+    # outside a request would leave its start time on the pooled connection
+    starts = conn.info.get("query_start")
+    if not starts:
+        return
+    duration = time.perf_counter() - starts.pop()
+    collectors = _collectors()
+    if not collectors:
+        return
+    slow_threshold = None
+    if has_request_context():
+        slow_threshold = current_app.config.get("SQL_SLOW_QUERY_THRESHOLD")
+    for collector in collectors:
+        collector.record(statement, duration, slow_threshold)
+
+
+def _handle_error(context):
+    # a statement that failed never gets to after_cursor_execute
+    if context.connection is not None and context.execution_context is not None:
+        starts = context.connection.info.get("query_start")
+        if starts:
+            starts.pop()
+
+
+event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+event.listen(Engine, "handle_error", _handle_error)
+
+
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label, value):
+        with self._lock:
+            counts, total = self.series.get(label, ([0] * len(self.buckets), 0.0))
+            counts = [count + (value <= bound) for count, bound in zip(counts, self.buckets)]
+            self.series[label] = (counts, total + value)
+
+    def count(self, label):
+        return self.series[label][0][-1] if label in self.series else 0
+
+    def exposition(self, label_name):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label, (counts, total) in sorted(self.series.items()):
+            for bound, count in zip(self.buckets, counts):
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{self.name}_bucket{{{label_name}="{label}",le="{le}"}} {count}')
+            lines.append(f'{self.name}_sum{{{label_name}="{label}"}} {total}')
+            lines.append(f'{self.name}_count{{{label_name}="{label}"}} {counts[-1]}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label, amount=1):
+        with self._lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def exposition(self, label_name, values=None):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label, value in sorted((values if values is not None else self.values).items()):
+            lines.append(f'{self.name}{{{label_name}="{label}"}} {value}')
+        return lines
+
+
+SECONDS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float("inf"))
+QUERY_COUNTS = (1, 2, 5, 10, 20, 50, 100, 200, 500, float("inf"))
+
+
+class Instrumentation:
+    def __init__(self, app=None):
+        self.request_time = Histogram("blog_request_duration_seconds",
+                                      "Time spent handling a request.", SECONDS)
+        self.db_queries = Histogram("blog_db_queries_per_request",
+                                    "SQL statements run per request.", QUERY_COUNTS)
+        self.db_time = Histogram("blog_db_time_seconds",
+                                 "Time spent in the database per request.", SECONDS)
+        self.render_time = Histogram("blog_render_time_seconds",
+                                     "Time spent rendering templates per request.", SECONDS)
+        self.slow_queries = Counter("blog_db_slow_queries_total",
+                                    "Statements slower than SQL_SLOW_QUERY_THRESHOLD.")
+        self.n_plus_one = Counter("blog_n_plus_one_total",
+                                  "Requests that repeated one statement N_PLUS_ONE_THRESHOLD times or more.")
+        self.recent_slow = deque(maxlen=50)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("METRICS_ENABLED", False)
+        app.config.setdefault("SQL_SLOW_QUERY_THRESHOLD", 0.1)
+        app.config.setdefault("N_PLUS_ONE_THRESHOLD", 5)
+
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+
+        app.extensions["instrumentation"] = self
+        if app.config["METRICS_ENABLED"]:
+            app.add_url_rule("/metrics", "metrics", self.metrics_view)
+
+    def _before_request(self):
+        g.request_started = time.perf_counter()
+        g.render_time = 0.0
+        g.queries = QueryCollector()
+        _collectors().append(g.queries)
+
+    def _before_render(self, app, template, context):
+        if "render_started" not in g:
+            g.render_started = time.perf_counter()
+
+    def _after_render(self, app, template, context):
+        # a render_template called while another template renders is
+        # already inside the outer timing
+        started = g.pop("render_started", None)
+        if started is not None:
+            g.render_time += time.perf_counter() - started
+
+    def _teardown_request(self, exc):
+        queries = g.pop("queries", None)
+        if queries is None:
+            return
+        _collectors().remove(queries)
+        endpoint = request.endpoint or "unknown"
+        if endpoint in ("static", "metrics"):
+            return
+
+        self.request_time.observe(endpoint, time.perf_counter() - g.request_started)
+        self.db_queries.observe(endpoint, queries.count)
+        self.db_time.observe(endpoint, queries.total_time)
+        self.render_time.observe(endpoint, g.render_time)
+
+        for statement, duration in queries.slow:
+            self.slow_queries.inc(endpoint)
+            self.recent_slow.append((endpoint, statement, duration))
+            current_app.logger.warning("slow query (%.1f ms) in %s: %s",
+                                       duration * 1000, endpoint, statement)
+
+        repeated = queries.repeated(current_app.config["N_PLUS_ONE_THRESHOLD"])
+        if repeated:
+            self.n_plus_one.inc(endpoint)
+            for statement, count in repeated.items():
+                current_app.logger.warning("probable N+1 in %s, ran %d times: %s",
+                                           endpoint, count, _one_line(statement))
+
+    def exposition(self):
+        lines = []
+        for histogram in (self.request_time, self.db_queries, self.db_time, self.render_time):
+            lines += histogram.exposition("endpoint")
+        lines += self.slow_queries.exposition("endpoint")
+        lines += self.n_plus_one.exposition("endpoint")
+
+        page_cache = current_app.extensions.get("page_cache")
+        if page_cache is not None:
+            stats = page_cache.stats()
+            lines += Counter("blog_cache_hits_total", "Page cache hits.").exposition(
+                "kind", {kind: counts["hits"] for kind, counts in stats.items()})
+            lines += Counter("blog_cache_misses_total", "Page cache misses.").exposition(
+                "kind", {kind: counts["misses"] for kind, counts in stats.items()})
+        return "\n".join(lines) + "\n"
+
+    def metrics_view(self):
+        return Response(self.exposition(), mimetype="text/plain; version=0.0.4")
+
+
+def _one_line(statement):
+    return re.sub(r"\s+", " ", statement).strip()
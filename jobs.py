@@ -0,0 +1,300 @@
+import json
+import threading
+import time
+import traceback
+
+import click
+from flask import current_app, g, has_request_context
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import delete, func, insert, select, update
+
+from extensions import db
+from models import Job
+
+
+# background jobs for the side effects of a write.
+#
+# a route writes its row and enqueues an event ("post_created", {"post_id": 7})
+# in the same transaction, then returns. the job rows commit together with
+# the write or not at all, so a side effect is never lost after a commit and
+# never runs for a write that rolled back. every handler registered for the
+# event gets a job of its own, retried on its own (with a growing delay) until
+# it succeeds or runs out of attempts. an idempotency key makes enqueueing the
+# same thing twice a no-op, and handlers are written so running one twice
+# does no harm (a worker can die after the work but before marking it done).
+#
+# JOBS_MODE says who runs them:
+#   thread - a worker thread inside each web process (nothing extra to run)
+#   worker - web processes only enqueue, "flask worker" runs the jobs
+#   inline - right after the request that enqueued them, before its response
+#            goes out (for tests)
+
+# a deleted post needs no job: its rows go by ON DELETE CASCADE and its search
+# rows with the flush (see search.py)
+EVENTS = ("post_created", "post_edited", "comment_added", "user_followed")
+
+jobs_cli = AppGroup("jobs", help="Inspect and manage the background job queue.")
+
+
+def _handler_name(handler):
+    return f"{handler.__module__}.{handler.__qualname__}"
+
+
+class JobQueue:
+    def __init__(self, app=None):
+        self.handlers = {}
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._last_requeue = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("JOBS_MODE", "thread")
+        app.config.setdefault("JOBS_POLL_INTERVAL", 1.0)
+        app.config.setdefault("JOBS_MAX_ATTEMPTS", 5)
+        app.config.setdefault("JOBS_RETRY_DELAY", 10)
+        app.config.setdefault("JOBS_LOCK_TIMEOUT", 300)
+        if app.config["JOBS_MODE"] not in ("thread", "worker", "inline"):
+            raise ValueError(f"unknown JOBS_MODE {app.config['JOBS_MODE']!r}")
+
+        app.after_request(self._after_request)
+        app.extensions["jobs"] = self
+        app.cli.add_command(worker_command)
+        app.cli.add_command(jobs_cli)
+
+    # --- enqueueing ---
+
+    def handler(self, event):
+        # register handler(**payload) to run for every `event`
+        if event not in EVENTS:
+            raise ValueError(f"unknown event {event!r}")
+
+        def decorator(handler):
+            self.handlers.setdefault(event, []).append(handler)
+            return handler
+        return decorator
+
+    def enqueue(self, event, payload, key=None):
+        # queue the handlers for `event` in the current transaction, the caller
+        # commits. `key` (e.g. the new row's id) makes a second enqueue of the
+        # same event a no-op.
+        if event not in EVENTS:
+            raise ValueError(f"unknown event {event!r}")
+        handlers = self.handlers.get(event, [])
+        if not handlers:
+            return
+        now = time.time()
+        data = json.dumps(payload, sort_keys=True)
+        rows = [{
+            "event": event,
+            "handler": _handler_name(handler),
+            "payload": data,
+            "idempotency_key": None if key is None else f"{event}:{key}:{_handler_name(handler)}",
+            "status": "pending",
+            "attempts": 0,
+            "max_attempts": current_app.config["JOBS_MAX_ATTEMPTS"],
+            "run_at": now,
+            "created_at": now,
+        } for handler in handlers]
+        db.session.execute(insert(Job).prefix_with("OR IGNORE"), rows)
+        if has_request_context():
+            g.jobs_enqueued = True
+
+    def _after_request(self, response):
+        mode = current_app.config["JOBS_MODE"]
+        if mode == "thread":
+            # started by the first request, so a forking server starts one
+            # per worker process, after the fork
+            self._start_thread(current_app._get_current_object())
+            if g.pop("jobs_enqueued", False):
+                self._wakeup.set()
+        elif mode == "inline" and g.pop("jobs_enqueued", False):
+            g.use_primary = True
+            self.run_pending()
+        return response
+
+    # --- running ---
+
+    def _find_handler(self, name):
+        for handlers in self.handlers.values():
+            for handler in handlers:
+                if _handler_name(handler) == name:
+                    return handler
+        return None
+
+    def requeue_stale(self):
+        # jobs left "running" by a worker that died. a job only goes stale
+        # after JOBS_LOCK_TIMEOUT, so looking more often than that (every
+        # poll, in every process) would only take the write lock for nothing
+        timeout = current_app.config["JOBS_LOCK_TIMEOUT"]
+        now = time.monotonic()
+        if self._last_requeue is not None and now - self._last_requeue < timeout:
+            return
+        self._last_requeue = now
+        stale = time.time() - timeout
+        db.session.execute(
+            update(Job).where(Job.status == "running", Job.locked_at < stale)
+            .values(status="pending", locked_at=None)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+    def claim(self):
+        # take the next due job, atomically: two workers can't get the same one
+        now = time.time()
+        # an idle queue is the usual case, find that out with a read instead
+        # of an UPDATE (which takes sqlite's write lock even when it changes
+        # nothing)
+        due_job = db.session.execute(
+            select(Job.id).where(Job.status == "pending", Job.run_at <= now).limit(1)
+        ).first()
+        if due_job is None:
+            db.session.commit()
+            return None
+        due = (
+            select(Job.id).where(Job.status == "pending", Job.run_at <= now)
+            .order_by(Job.run_at, Job.id).limit(1).scalar_subquery()
+        )
+        job = db.session.execute(
+            update(Job).where(Job.id == due, Job.status == "pending")
+            .values(status="running", locked_at=now, attempts=Job.attempts + 1)
+            .returning(Job.id, Job.event, Job.handler, Job.payload, Job.attempts, Job.max_attempts)
+            .execution_options(synchronize_session=False)
+        ).first()
+        db.session.commit()
+        return job
+
+    def run_job(self, job):
+        # the handler's writes and the "done" mark commit together. returns
+        # whether it succeeded.
+        try:
+            handler = self._find_handler(job.handler)
+            if handler is None:
+                raise LookupError(f"no handler {job.handler} is registered")
+            handler(**json.loads(job.payload))
+            db.session.execute(
+                update(Job).where(Job.id == job.id)
+                .values(status="done", finished_at=time.time(), locked_at=None, last_error=None)
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+            return True
+        except Exception:
+            db.session.rollback()
+            error = traceback.format_exc()
+            if job.attempts >= job.max_attempts:
+                values = {"status": "failed", "finished_at": time.time()}
+            else:
+                # 10s, 20s, 40s, ...
+                delay = current_app.config["JOBS_RETRY_DELAY"] * 2 ** (job.attempts - 1)
+                values = {"status": "pending", "run_at": time.time() + delay}
+            db.session.execute(
+                update(Job).where(Job.id == job.id)
+                .values(locked_at=None, last_error=error[-4000:], **values)
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+            current_app.logger.warning("job %s (%s, attempt %s of %s) failed:\n%s", job.id,
+                                       job.handler, job.attempts, job.max_attempts, error)
+            return False
+
+    def run_pending(self, limit=None):
+        # run due jobs until none is left (or `limit` ran), returns how many ran
+        self.requeue_stale()
+        ran = 0
+        while limit is None or ran < limit:
+            job = self.claim()
+            if job is None:
+                break
+            self.run_job(job)
+            ran += 1
+        return ran
+
+    def work(self, app, poll_interval=None, burst=False, wakeup=None):
+        # the worker loop: run whatever is due, then wait for the next poll (or
+        # for a request to say it enqueued something)
+        poll_interval = poll_interval or app.config["JOBS_POLL_INTERVAL"]
+        while True:
+            try:
+                # a fresh app context (and session) per round
+                with app.app_context():
+                    ran = self.run_pending()
+            except Exception:
+                app.logger.exception("the job worker hit an error, retrying")
+                ran = None
+            if burst and ran == 0:
+                return
+            if wakeup is not None:
+                wakeup.wait(poll_interval)
+                wakeup.clear()
+            else:
+                time.sleep(poll_interval)
+
+    def _start_thread(self, app):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self.work, args=(app,), kwargs={"wakeup": self._wakeup},
+                    name="jobs", daemon=True,
+                )
+                self._thread.start()
+
+
+job_queue = JobQueue()
+
+
+@click.command("worker")
+@click.option("--burst", is_flag=True, help="Exit once no job is due instead of waiting for more.")
+@click.option("--poll", type=float, help="Seconds between polls (default: JOBS_POLL_INTERVAL).")
+@with_appcontext
+def worker_command(burst, poll):
+    """Run background jobs."""
+    app = current_app._get_current_object()
+    click.echo(f"worker started, {sum(map(len, job_queue.handlers.values()))} handlers registered.")
+    try:
+        job_queue.work(app, poll_interval=poll, burst=burst)
+    except KeyboardInterrupt:
+        pass
+    click.echo("worker stopped.")
+
+
+@jobs_cli.command("status")
+@click.option("--failed", "show_failed", is_flag=True, help="List the failed jobs and their errors.")
+def status_command(show_failed):
+    """Count the jobs by status."""
+    counts = dict(db.session.execute(select(Job.status, func.count()).group_by(Job.status)).all())
+    for status in ("pending", "running", "failed", "done"):
+        click.echo(f"{status:>8}: {counts.get(status, 0)}")
+    if show_failed:
+        for job in db.session.execute(select(Job).where(Job.status == "failed").order_by(Job.id)).scalars():
+            last_line = (job.last_error or "").strip().splitlines()[-1:] or [""]
+            click.echo(f"#{job.id} {job.handler} {job.payload}: {last_line[0]}")
+
+
+@jobs_cli.command("retry")
+def retry_command():
+    """Queue the failed jobs again, with fresh attempts."""
+    result = db.session.execute(
+        update(Job).where(Job.status == "failed")
+        .values(status="pending", attempts=0, run_at=time.time(), finished_at=None)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    click.echo(f"requeued {result.rowcount} jobs.")
+
+
+@jobs_cli.command("prune")
+@click.option("--keep-days", default=7, show_default=True, help="How long to keep finished jobs.")
+def prune_command(keep_days):
+    """Delete finished jobs older than --keep-days."""
+    cutoff = time.time() - keep_days * 86400
+    result = db.session.execute(
+        delete(Job).where(Job.status == "done", Job.finished_at < cutoff)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    click.echo(f"deleted {result.rowcount} finished jobs.")
@@ -0,0 +1,318 @@
+import time
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import inspect
+
+from extensions import db
+
+
+# versioned schema changes.
+#
+# a brand new database gets the whole current schema from the models
+# (create_all) and is stamped with the latest version. an existing database
+# gets every migration it hasn't had yet, in order, and schema_migrations
+# records which ones ran.
+#
+# each migration is a function taking a connection. it runs inside its own
+# transaction (ddl included) with foreign keys switched off, which is what
+# sqlite needs for rebuilding a table, and it fails if it leaves behind any
+# foreign key violation that wasn't there before. a migration that shipped is never edited, changes go in
+# a new one at the end.
+
+db_cli = AppGroup("db", help="Manage the database schema.")
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+    return decorator
+
+
+def _columns(connection, table):
+    return {row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info({table})")}
+
+
+def _add_column(connection, table, column, ddl):
+    if column not in _columns(connection, table):
+        connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+
+def _rebuild_table(connection, name, create):
+    # sqlite can't alter a constraint: create the table again under a
+    # temporary name, copy the rows over, swap it in and put its indexes back
+    indexes = connection.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+        (name,),
+    ).scalars().all()
+    connection.exec_driver_sql(create.format(name=f"_new_{name}"))
+    columns = ", ".join(sorted(_columns(connection, name) & _columns(connection, f"_new_{name}")))
+    connection.exec_driver_sql(f"INSERT INTO _new_{name} ({columns}) SELECT {columns} FROM {name}")
+    connection.exec_driver_sql(f"DROP TABLE {name}")
+    connection.exec_driver_sql(f"ALTER TABLE _new_{name} RENAME TO {name}")
+    for index in indexes:
+        connection.exec_driver_sql(index)
+
+
+# --- migrations, oldest first ---
+
+@migration(1, "tables added since the original schema")
+def create_missing_tables(connection):
+    for statement in (
+        "CREATE TABLE IF NOT EXISTS timeline_entries ("
+        "user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE, "
+        "post_id INTEGER NOT NULL REFERENCES posts (id) ON DELETE CASCADE, "
+        "author_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE, "
+        "created_at DATETIME NOT NULL, "
+        "PRIMARY KEY (user_id, post_id))",
+        "CREATE INDEX IF NOT EXISTS ix_timeline_user_created ON timeline_entries (user_id, created_at, post_id)",
+        "CREATE INDEX IF NOT EXISTS ix_timeline_user_author ON timeline_entries (user_id, author_id)",
+        "CREATE INDEX IF NOT EXISTS ix_timeline_post ON timeline_entries (post_id)",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+        "title, body, kind UNINDEXED, post_id UNINDEXED, "
+        "tokenize = 'unicode61 remove_diacritics 2')",
+    ):
+        connection.exec_driver_sql(statement)
+
+
+@migration(2, "user counters and rendered post columns")
+def add_counter_and_rendering_columns(connection):
+    for column in ("follower_count", "following_count", "post_count"):
+        _add_column(connection, "users", column, "INTEGER NOT NULL DEFAULT 0")
+    connection.exec_driver_sql("""
+        UPDATE users SET
+            follower_count = (SELECT count(*) FROM follows WHERE followed_id = users.id),
+            following_count = (SELECT count(*) FROM follows WHERE follower_id = users.id),
+            post_count = (SELECT count(*) FROM posts WHERE user_id = users.id)
+    """)
+    # filled in by "flask posts render"
+    _add_column(connection, "posts", "body_html", "TEXT")
+    _add_column(connection, "posts", "excerpt", "VARCHAR(255)")
+    _add_column(connection, "posts", "reading_time", "INTEGER")
+
+
+# the tables as of migration 3, {name} is the table being created
+CASCADE_TABLES = (
+    ("posts",
+     "CREATE TABLE {name} ("
+     "id INTEGER NOT NULL PRIMARY KEY, title VARCHAR(255) NOT NULL UNIQUE, body TEXT NOT NULL, "
+     "body_html TEXT, excerpt VARCHAR(255), reading_time INTEGER, "
+     "created_at DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL, is_published BOOLEAN, "
+     "slug VARCHAR(255), "
+     "user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE)"),
+    ("comments",
+     "CREATE TABLE {name} ("
+     "id INTEGER NOT NULL PRIMARY KEY, body TEXT NOT NULL, "
+     "created_at DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL, "
+     "user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE, "
+     "post_id INTEGER NOT NULL REFERENCES posts (id) ON DELETE CASCADE)"),
+    ("post_tags",
+     "CREATE TABLE {name} ("
+     "post_id INTEGER NOT NULL REFERENCES posts (id) ON DELETE CASCADE, "
+     "tag_id INTEGER NOT NULL REFERENCES tags (id) ON DELETE CASCADE, "
+     "PRIMARY KEY (post_id, tag_id))"),
+    ("follows",
+     "CREATE TABLE {name} ("
+     "follower_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE, "
+     "followed_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE, "
+     "PRIMARY KEY (follower_id, followed_id))"),
+    ("timeline_entries",
+     "CREATE TABLE {name} ("
+     "user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE, "
+     "post_id INTEGER NOT NULL REFERENCES posts (id) ON DELETE CASCADE, "
+     "author_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE, "
+     "created_at DATETIME NOT NULL, "
+     "PRIMARY KEY (user_id, post_id))"),
+)
+
+
+@migration(3, "ON DELETE CASCADE foreign keys")
+def cascade_foreign_keys(connection):
+    for name, create in CASCADE_TABLES:
+        foreign_keys = connection.exec_driver_sql(f"PRAGMA foreign_key_list({name})").all()
+        if any(row.on_delete != "CASCADE" for row in foreign_keys):
+            _rebuild_table(connection, name, create)
+    # rows whose parent was deleted back when foreign keys weren't enforced,
+    # the cascade would have removed them
+    for table, rowid, parent, _ in connection.exec_driver_sql("PRAGMA foreign_key_check").all():
+        connection.exec_driver_sql(f"DELETE FROM {table} WHERE rowid = ?", (rowid,))
+
+
+@migration(4, "indexes for foreign keys and feed ordering")
+def add_hot_path_indexes(connection):
+    # tag pages are in post date order: post_tags gets a copy of the post's
+    # created_at, filled by a trigger when a row comes in without one
+    _add_column(connection, "post_tags", "created_at", "DATETIME")
+    connection.exec_driver_sql(
+        "UPDATE post_tags SET created_at = (SELECT created_at FROM posts WHERE id = post_tags.post_id)"
+    )
+    connection.exec_driver_sql("""
+        CREATE TRIGGER IF NOT EXISTS post_tags_created_at AFTER INSERT ON post_tags
+        WHEN NEW.created_at IS NULL
+        BEGIN
+            UPDATE post_tags SET created_at = (SELECT created_at FROM posts WHERE id = NEW.post_id)
+            WHERE post_id = NEW.post_id AND tag_id = NEW.tag_id;
+        END
+    """)
+    for statement in (
+        "CREATE INDEX IF NOT EXISTS ix_posts_created_at_id ON posts (created_at, id)",
+        "CREATE INDEX IF NOT EXISTS ix_posts_user_created ON posts (user_id, created_at, id)",
+        "CREATE INDEX IF NOT EXISTS ix_comments_post_created ON comments (post_id, created_at, id)",
+        "CREATE INDEX IF NOT EXISTS ix_comments_user_id ON comments (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_follows_followed_follower ON follows (followed_id, follower_id)",
+        "CREATE INDEX IF NOT EXISTS ix_post_tags_tag_created ON post_tags (tag_id, created_at, post_id)",
+        "CREATE INDEX IF NOT EXISTS ix_timeline_author ON timeline_entries (author_id)",
+    ):
+        connection.exec_driver_sql(statement)
+
+
+@migration(5, "tag post counts and hourly tag usage")
+def add_tag_counters(connection):
+    _add_column(connection, "tags", "post_count", "INTEGER NOT NULL DEFAULT 0")
+    connection.exec_driver_sql(
+        "UPDATE tags SET post_count = (SELECT count(*) FROM post_tags WHERE tag_id = tags.id)"
+    )
+    connection.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_tags_post_count_id ON tags (post_count, id)")
+    connection.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS tag_usage ("
+        "tag_id INTEGER NOT NULL REFERENCES tags (id) ON DELETE CASCADE, "
+        "bucket INTEGER NOT NULL, uses INTEGER NOT NULL, "
+        "PRIMARY KEY (tag_id, bucket))"
+    )
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_tag_usage_bucket ON tag_usage (bucket, tag_id, uses)"
+    )
+    connection.exec_driver_sql("DELETE FROM tag_usage")
+    connection.exec_driver_sql(
+        "INSERT INTO tag_usage (tag_id, bucket, uses) "
+        "SELECT post_tags.tag_id, CAST(strftime('%s', posts.created_at) AS INTEGER) / 3600, count(*) "
+        "FROM post_tags JOIN posts ON posts.id = post_tags.post_id GROUP BY 1, 2"
+    )
+
+
+@migration(6, "background job queue")
+def add_jobs_table(connection):
+    connection.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        "id INTEGER NOT NULL PRIMARY KEY, event VARCHAR(50) NOT NULL, "
+        "handler VARCHAR(255) NOT NULL, payload TEXT NOT NULL, "
+        "idempotency_key VARCHAR(255) UNIQUE, status VARCHAR(10) NOT NULL, "
+        "attempts INTEGER NOT NULL, max_attempts INTEGER NOT NULL, run_at FLOAT NOT NULL, "
+        "locked_at FLOAT, finished_at FLOAT, last_error TEXT, created_at FLOAT NOT NULL)"
+    )
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_jobs_status_run_at ON jobs (status, run_at, id)"
+    )
+
+
+@migration(7, "bulk import checkpoints")
+def add_import_checkpoints_table(connection):
+    connection.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS import_checkpoints ("
+        "source VARCHAR(1000) NOT NULL PRIMARY KEY, records INTEGER NOT NULL, "
+        "updated_at DATETIME DEFAULT (CURRENT_TIMESTAMP) NOT NULL)"
+    )
+
+
+# --- runner ---
+
+def _ensure_version_table(connection):
+    connection.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, description VARCHAR(255) NOT NULL, "
+        "applied_at FLOAT NOT NULL)"
+    )
+
+
+def applied_versions(engine=None):
+    engine = engine or db.engine
+    if not inspect(engine).has_table("schema_migrations"):
+        return set()
+    with engine.connect() as connection:
+        return set(connection.exec_driver_sql("SELECT version FROM schema_migrations").scalars())
+
+
+def pending(engine=None):
+    applied = applied_versions(engine)
+    return [entry for entry in MIGRATIONS if entry[0] not in applied]
+
+
+def _run_in_transaction(engine, work):
+    with engine.connect() as connection:
+        dbapi_connection = connection.connection.dbapi_connection
+        # the sqlite3 module commits before ddl on its own, take over the
+        # transaction so a migration that fails halfway leaves nothing behind
+        isolation_level = dbapi_connection.isolation_level
+        dbapi_connection.isolation_level = None
+        try:
+            connection.exec_driver_sql("PRAGMA foreign_keys = OFF")
+            connection.exec_driver_sql("BEGIN")
+            try:
+                before = set(connection.exec_driver_sql("PRAGMA foreign_key_check").all())
+                work(connection)
+                after = connection.exec_driver_sql("PRAGMA foreign_key_check").all()
+                problems = [row for row in after if row not in before]
+                if problems:
+                    raise RuntimeError(f"foreign key violations: {problems[:10]}")
+                connection.exec_driver_sql("COMMIT")
+            except Exception:
+                connection.exec_driver_sql("ROLLBACK")
+                raise
+        finally:
+            connection.exec_driver_sql("PRAGMA foreign_keys = ON")
+            dbapi_connection.isolation_level = isolation_level
+
+
+def _record(connection, version, description):
+    connection.exec_driver_sql(
+        "INSERT INTO schema_migrations (version, description, applied_at) VALUES (?, ?, ?)",
+        (version, description, time.time()),
+    )
+
+
+def upgrade(engine=None):
+    """Bring the schema up to date, returns the migrations that ran."""
+    engine = engine or db.engine
+    if not inspect(engine).get_table_names():
+        # empty database: the models are the latest schema
+        def create(connection):
+            db.metadata.create_all(connection)
+            _ensure_version_table(connection)
+            for version, description, _ in MIGRATIONS:
+                _record(connection, version, description)
+        _run_in_transaction(engine, create)
+        return []
+
+    ran = []
+    for version, description, func in pending(engine):
+        def apply(connection):
+            _ensure_version_table(connection)
+            func(connection)
+            _record(connection, version, description)
+        _run_in_transaction(engine, apply)
+        ran.append((version, description))
+    return ran
+
+
+@db_cli.command("upgrade")
+def upgrade_command():
+    """Apply every migration the database hasn't had yet."""
+    if not inspect(db.engine).get_table_names():
+        upgrade()
+        click.echo(f"created the schema at version {MIGRATIONS[-1][0]:04d}.")
+        return
+    for version, description in upgrade():
+        click.echo(f"applied {version:04d} {description}")
+    click.echo("schema is up to date.")
+
+
+@db_cli.command("status")
+def status_command():
+    """Show which migrations have been applied."""
+    applied = applied_versions()
+    for version, description, _ in MIGRATIONS:
+        mark = "x" if version in applied else " "
+        click.echo(f"[{mark}] {version:04d} {description}")
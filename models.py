@@ -1,20 +1,73 @@
+from flask import g, has_app_context
 from extensions import db
-from werkzeug.security import check_password_hash, generate_password_hash
 from flask_login import UserMixin
+from sqlalchemy import DDL, event
+from sqlalchemy.orm import defer
+import passwords
+
+# request-scoped cache for User.is_following, lives on flask.g
+def _follow_state_cache():
+    if not has_app_context():
+        return {}
+    if "follow_state" not in g:
+        g.follow_state = {}
+    return g.follow_state
+
+
+# does follower_id follow followed_id? (an EXISTS on the follows primary key)
+# answers are remembered for the rest of the request, so a page asking about
+# the same author many times only hits the database once.
+def follow_state(follower_id, followed_id):
+    cache = _follow_state_cache()
+    key = (follower_id, followed_id)
+    if key not in cache:
+        query = db.select(follows.c.follower_id).where(
+            follows.c.follower_id == follower_id, follows.c.followed_id == followed_id
+        )
+        cache[key] = db.session.execute(db.select(query.exists())).scalar()
+    return cache[key]
+
+
+# forget cached follow state after following/unfollowing
+def forget_follow_state(follower_id, followed_id):
+    _follow_state_cache().pop((follower_id, followed_id), None)
+
+
+# every foreign key below is ON DELETE CASCADE (sqlite enforces them, see
+# database.py), and the relationships say passive_deletes: deleting a user or
+# a post is one DELETE, the database removes the rows hanging off it instead
+# of the ORM loading and deleting them one by one.
 
 # associaton table for posts and tags table to connect
 post_tags = db.Table(
     "post_tags",
-    db.Column("post_id", db.Integer, db.ForeignKey("posts.id"), primary_key=True),
-    db.Column("tag_id", db.Integer, db.ForeignKey("tags.id"), primary_key=True),
+    db.Column("post_id", db.Integer, db.ForeignKey("posts.id", ondelete="CASCADE"), primary_key=True),
+    db.Column("tag_id", db.Integer, db.ForeignKey("tags.id", ondelete="CASCADE"), primary_key=True),
+    # a copy of the post's created_at, so a tag's posts can be paged newest
+    # first straight off an index, in the same order as the home feed. the
+    # trigger below fills it in when a row is inserted without one.
+    db.Column("created_at", db.DateTime),
+    # the primary key covers post -> tags, this covers tag -> posts
+    db.Index("ix_post_tags_tag_created", "tag_id", "created_at", "post_id"),
 )
 
+event.listen(post_tags, "after_create", DDL("""
+CREATE TRIGGER IF NOT EXISTS post_tags_created_at AFTER INSERT ON post_tags
+WHEN NEW.created_at IS NULL
+BEGIN
+    UPDATE post_tags SET created_at = (SELECT created_at FROM posts WHERE id = NEW.post_id)
+    WHERE post_id = NEW.post_id AND tag_id = NEW.tag_id;
+END
+"""))
+
 
 # association table for self referential many to many (a user can follow other user)
 follows = db.Table(
     "follows",
-    db.Column("follower_id", db.Integer, db.ForeignKey("users.id"), primary_key=True),
-    db.Column("followed_id", db.Integer, db.ForeignKey("users.id"), primary_key=True),
+    db.Column("follower_id", db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), primary_key=True),
+    db.Column("followed_id", db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), primary_key=True),
+    # the primary key covers "who do I follow", this covers "who follows me"
+    db.Index("ix_follows_followed_follower", "followed_id", "follower_id"),
 )
 
 
@@ -28,14 +81,24 @@ class User(db.Model, UserMixin):
     about_me = db.Column(db.Text)
     created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
 
+    # denormalized counters, kept in step by the follow/unfollow and
+    # create/delete post routes (see counters.py, "flask counters recount"
+    # fixes them if they ever drift).
+    follower_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    following_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
     # create a new attribute (posts) -> one to many
-    posts = db.relationship("Post", back_populates="owner", cascade="all, delete-orphan")
+    # dynamic: user.posts is a query, so a profile can page through it
+    # instead of loading every post the user ever wrote.
+    posts = db.relationship("Post", back_populates="owner", cascade="all, delete-orphan",
+                            passive_deletes=True, lazy="dynamic")
 
     # comments new attribute
     comments = db.relationship("Comment", back_populates="")
 
      # Get all comments written by this user
-    comments = db.relationship('Comment', back_populates='author')
+    comments = db.relationship('Comment', back_populates='author', passive_deletes=True)
 
     # create a new attribute (followers) -> self-referential many to many
     followers = db.relationship(
@@ -43,7 +106,9 @@ class User(db.Model, UserMixin):
         secondary="follows",
         primaryjoin = (follows.c.followed_id == id),
         secondaryjoin = (follows.c.follower_id == id),
-        back_populates = "following"
+        back_populates = "following",
+        passive_deletes = True,
+        lazy = "dynamic"
 
     )
 
@@ -53,17 +118,30 @@ class User(db.Model, UserMixin):
         secondary="follows",
         primaryjoin = (follows.c.follower_id == id),
         secondaryjoin = (follows.c.followed_id == id),
-        back_populates = "followers"
+        back_populates = "followers",
+        passive_deletes = True,
+        lazy = "dynamic"
     )
 
 
-    # generate password hash
+    # generate password hash (with the hashing policy from the config, see passwords.py)
     def set_password(self, password):
-        self.password = generate_password_hash(password)
+        self.password = passwords.hash_password(password)
 
-    # check password
+    # check password. a hash made under an older hashing policy is replaced
+    # by one made under the current policy, the caller commits.
     def check_password(self, password):
-        return check_password_hash(self.password, password)
+        if not passwords.check_password(self.password, password):
+            return False
+        if passwords.needs_rehash(self.password):
+            self.set_password(password)
+        return True
+
+    def is_following(self, user):
+        return follow_state(self.id, user.id)
+
+    def forget_follow_state(self, user):
+        forget_follow_state(self.id, user.id)
 
 
 
@@ -73,38 +151,64 @@ class User(db.Model, UserMixin):
 
 class Post(db.Model):
     __tablename__ = "posts"
+    # the home feed is ordered by (created_at, id), this index lets it page
+    # through the table without sorting it. the same per author for profiles.
+    __table_args__ = (
+        db.Index("ix_posts_created_at_id", "created_at", "id"),
+        db.Index("ix_posts_user_created", "user_id", "created_at", "id"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255), nullable=False, unique=True)
     body = db.Column(db.Text, nullable=False)
+    # rendered from body when the post is written (see rendering.py)
+    body_html = db.Column(db.Text)
+    excerpt = db.Column(db.String(255))
+    reading_time = db.Column(db.Integer)
     created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
     is_published = db.Column(db.Boolean())
     slug = db.Column(db.String(255))
-    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False) #FK
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False) #FK
 
     # creating a new attribute (owner)
     owner = db.relationship("User", back_populates="posts")
 
     #creating a new attribute (tags)
-    tags = db.relationship("Tag", secondary="post_tags", back_populates="posts")
+    tags = db.relationship("Tag", secondary="post_tags", back_populates="posts",
+                           passive_deletes=True)
 
 
     # Get all comments for this post.
     # When a post is deleted, all its comments will be deleted too.
-    comments = db.relationship('Comment', back_populates='post', cascade='all, delete-orphan')
+    comments = db.relationship('Comment', back_populates='post', cascade='all, delete-orphan',
+                               passive_deletes=True)
 
 
 
     def __repr__(self):
         return f"<Post({self.title}, {self.created_at})"
+
+
+# for queries that list posts: leave the big text columns out, a list only
+# shows the title, excerpt and reading time
+def post_summary_options():
+    return (defer(Post.body), defer(Post.body_html))
     
 
 class Tag(db.Model):
     __tablename__ = "tags"
+    # the tag directory lists the most used tags first
+    __table_args__ = (
+        db.Index("ix_tags_post_count_id", "post_count", "id"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), nullable=False, unique=True)
+    # how many posts carry the tag, kept in step by tags.set_post_tags (see
+    # tags.py, "flask tags recount" fixes it if it ever drifts)
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
     # creating a new attribute (posts)
-    posts = db.relationship("Post", secondary="post_tags", back_populates="tags")
+    posts = db.relationship("Post", secondary="post_tags", back_populates="tags",
+                            passive_deletes=True)
 
     
     def __repr__(self):
@@ -112,11 +216,16 @@ class Tag(db.Model):
     
 class Comment(db.Model):
     __tablename__ = "comments"
+    # comments are paged per post in (created_at, id) order
+    __table_args__ = (
+        db.Index("ix_comments_post_created", "post_id", "created_at", "id"),
+        db.Index("ix_comments_user_id", "user_id"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
-    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False) #FK
-    post_id = db.Column(db.Integer, db.ForeignKey("posts.id"), nullable=False) #FK
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False) #FK
+    post_id = db.Column(db.Integer, db.ForeignKey("posts.id", ondelete="CASCADE"), nullable=False) #FK
 
 
     # ADD THESE TWO RELATIONSHIPS:
@@ -129,5 +238,77 @@ class Comment(db.Model):
         return f"<Comment({self.body})"
 
 
-    
+class TagUsage(db.Model):
+    # how many posts got a tag, per hour (hours since the epoch of the post's
+    # created_at). "trending" sums the last few hours.
+    __tablename__ = "tag_usage"
+    __table_args__ = (
+        db.Index("ix_tag_usage_bucket", "bucket", "tag_id", "uses"),
+    )
+    tag_id = db.Column(db.Integer, db.ForeignKey("tags.id", ondelete="CASCADE"), primary_key=True)
+    bucket = db.Column(db.Integer, primary_key=True)
+    uses = db.Column(db.Integer, nullable=False, default=0)
 
+    def __repr__(self):
+        return f"<TagUsage({self.tag_id}, {self.bucket}, {self.uses})"
+
+
+class TimelineEntry(db.Model):
+    # one row per (reader, post): the materialized "following" feed.
+    # filled when a post is written (fan-out-on-write), so reading a
+    # timeline is a single range scan on (user_id, created_at, post_id).
+    __tablename__ = "timeline_entries"
+    __table_args__ = (
+        db.Index("ix_timeline_user_created", "user_id", "created_at", "post_id"),
+        db.Index("ix_timeline_user_author", "user_id", "author_id"),
+        db.Index("ix_timeline_post", "post_id"),
+        db.Index("ix_timeline_author", "author_id"),
+    )
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey("posts.id", ondelete="CASCADE"), primary_key=True)
+    author_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    # copied from the post so the feed can be ordered without touching posts
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<TimelineEntry({self.user_id}, {self.post_id})"
+
+
+class Job(db.Model):
+    # one background job: run `handler` with the json `payload` of an `event`
+    # (see jobs.py). times are unix timestamps.
+    __tablename__ = "jobs"
+    __table_args__ = (
+        # the worker's "next due job" lookup
+        db.Index("ix_jobs_status_run_at", "status", "run_at", "id"),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    event = db.Column(db.String(50), nullable=False)
+    handler = db.Column(db.String(255), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    idempotency_key = db.Column(db.String(255), unique=True)
+    # pending -> running -> done, or back to pending for a retry, or failed
+    status = db.Column(db.String(10), nullable=False, default="pending")
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    run_at = db.Column(db.Float, nullable=False)
+    locked_at = db.Column(db.Float)
+    finished_at = db.Column(db.Float)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return f"<Job({self.id}, {self.handler}, {self.status})"
+
+
+class ImportCheckpoint(db.Model):
+    # how far "flask import" got through a source file, saved in the same
+    # transaction as each batch (see importer.py)
+    __tablename__ = "import_checkpoints"
+    # "<kind>:<absolute path>", e.g. "posts:/data/posts.jsonl"
+    source = db.Column(db.String(1000), primary_key=True)
+    records = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+
+    def __repr__(self):
+        return f"<ImportCheckpoint({self.source}, {self.records})"
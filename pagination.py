@@ -0,0 +1,148 @@
+import base64
+import binascii
+
+from sqlalchemy import and_, or_, type_coerce
+from sqlalchemy.sql.elements import BindParameter
+
+from extensions import db
+
+
+# keyset (cursor) pagination.
+# instead of OFFSET (which has to walk every skipped row) we remember the
+# sort key of the last row we showed and ask for the rows after it. with an
+# index on (sort column, id) every page is a short index range scan, no
+# matter how deep into the table it is.
+
+
+class Page:
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(sort_key, row_id):
+    raw = f"{sort_key}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    # a broken or tampered cursor just means "start from the beginning"
+    if not cursor:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        sort_key, row_id = base64.urlsafe_b64decode(padded).decode().rsplit("|", 1)
+        return sort_key, int(row_id)
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        return None
+
+
+def sort_key_column(column):
+    # the raw value exactly as sqlite stores it.
+    # DateTime columns hold text, and rows written by server_default
+    # ("2024-01-01 10:00:00") are formatted differently from rows written by
+    # python ("2024-01-01 10:00:00.000000"). comparing against the stored text
+    # keeps ties on the same second from repeating or disappearing.
+    return type_coerce(column, db.String)
+
+
+def keyset_filter(sort_col, id_col, key, after=True, descending=True):
+    sort_key, row_id = key
+    # "after" means further along in the listing order
+    forward = after == descending
+    if sort_col is None:
+        # listings ordered by id alone
+        return id_col < row_id if forward else id_col > row_id
+    # a bindparam() when the statement is built once and run with different keys
+    sort_value = sort_key if isinstance(sort_key, BindParameter) else db.literal(sort_key, db.String)
+    if forward:
+        return or_(sort_col < sort_value, and_(sort_col == sort_value, id_col < row_id))
+    return or_(sort_col > sort_value, and_(sort_col == sort_value, id_col > row_id))
+
+
+def keyset_query(query, sort_col, id_col, limit, after_key=None, before_key=None,
+                 descending=True):
+    # what fetch_keyset_rows() runs, for using it as a subquery. the sort key
+    # is the last column, labelled sort_key.
+    sort_key = id_col if sort_col is None else sort_key_column(sort_col)
+    query = query.add_columns(sort_key.label("sort_key"))
+    if before_key is not None:
+        query = query.filter(keyset_filter(sort_col, id_col, before_key, after=False,
+                                           descending=descending))
+        backwards = True
+    else:
+        if after_key is not None:
+            query = query.filter(keyset_filter(sort_col, id_col, after_key, after=True,
+                                               descending=descending))
+        backwards = False
+    columns = (id_col,) if sort_col is None else (sort_col, id_col)
+    if backwards == descending:
+        order = [column.asc() for column in columns]
+    else:
+        order = [column.desc() for column in columns]
+    return query.order_by(*order).limit(limit)
+
+
+def fetch_keyset_rows(query, sort_col, id_col, limit, after_key=None, before_key=None,
+                      descending=True):
+    # rows come back as (item, sort_key), in the order we walked away from the
+    # cursor. for a "before" cursor that is the reverse of the listing order.
+    # sort_col can be None to order by id_col alone.
+    query = keyset_query(query, sort_col, id_col, limit, after_key, before_key, descending)
+    return [tuple(row) for row in query.all()]
+
+
+def page_from_rows(rows, per_page, after_key=None, before_key=None, id_of=lambda item: item.id):
+    # turn per_page + 1 rows from fetch_keyset_rows into a Page
+    if before_key is not None:
+        has_more = len(rows) > per_page
+        rows = list(reversed(rows[:per_page]))
+        has_prev, has_next = has_more, True
+    else:
+        has_next = len(rows) > per_page
+        rows = rows[:per_page]
+        has_prev = after_key is not None
+
+    items = [row[0] for row in rows]
+    next_cursor = prev_cursor = None
+    if rows:
+        if has_next:
+            next_cursor = encode_cursor(rows[-1][1], id_of(items[-1]))
+        if has_prev:
+            prev_cursor = encode_cursor(rows[0][1], id_of(items[0]))
+
+    return Page(items, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+
+def cursor_keys(after=None, before=None):
+    # "after" wins if someone passes both
+    after_key = decode_cursor(after)
+    before_key = decode_cursor(before) if after_key is None else None
+    return after_key, before_key
+
+
+def keyset_paginate(query, sort_col, id_col, per_page, after=None, before=None,
+                    descending=True, id_of=lambda item: item.id):
+    """Paginate ``query`` on (sort_col, id_col).
+
+    ``after`` / ``before`` are cursors taken from a previous page.
+    """
+    after_key, before_key = cursor_keys(after, before)
+    rows = fetch_keyset_rows(query, sort_col, id_col, per_page + 1,
+                             after_key, before_key, descending)
+    return page_from_rows(rows, per_page, after_key, before_key, id_of)
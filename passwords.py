@@ -0,0 +1,44 @@
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+# password hashing policy.
+#
+# PASSWORD_HASH_METHOD (any werkzeug method with its cost parameters,
+# "scrypt:32768:8:1", "pbkdf2:sha256:600000" ...) and PASSWORD_SALT_LENGTH
+# decide how new hashes are made. a stored hash says which method made it,
+# so changing the policy locks nobody out: an old hash still checks, and is
+# swapped for one made under the current policy the next time its owner logs
+# in (see User.check_password).
+
+# the method as werkzeug writes it into a hash ("pbkdf2" -> "pbkdf2:sha256:1000000")
+_stored_methods = {}
+
+
+def _policy():
+    return current_app.config["PASSWORD_HASH_METHOD"], current_app.config["PASSWORD_SALT_LENGTH"]
+
+
+def _stored_method(method):
+    if method not in _stored_methods:
+        # werkzeug fills in the parameters left out, hashing once shows which
+        _stored_methods[method] = generate_password_hash("", method, salt_length=1).split("$", 1)[0]
+    return _stored_methods[method]
+
+
+def hash_password(password):
+    method, salt_length = _policy()
+    return generate_password_hash(password, method=method, salt_length=salt_length)
+
+
+def check_password(stored_hash, password):
+    return check_password_hash(stored_hash, password)
+
+
+def needs_rehash(stored_hash):
+    # was stored_hash made under a different policy than the current one?
+    method, salt_length = _policy()
+    parts = stored_hash.split("$")
+    if len(parts) != 3:
+        return True
+    return parts[0] != _stored_method(method) or len(parts[1]) != salt_length
@@ -0,0 +1,163 @@
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+import click
+
+from extensions import db
+from instrumentation import count_queries
+
+
+# EXPLAIN QUERY PLAN for the statements behind every route.
+#
+# a scratch database gets the current schema and a little data, every route
+# is driven through the test client (anonymous and logged in, reads and
+# writes), and sqlite is asked how it would run each statement they issued.
+# a plan step reading a whole table ("SCAN posts") fails the check, on real
+# volumes that is the query that falls over. walking an index in order
+# ("SCAN posts USING INDEX ...", what keyset pagination does with a LIMIT)
+# is fine.
+
+FULL_SCAN = re.compile(r"^SCAN (\w+)(?: AS \w+)?$")
+
+
+def explain(connection, statement):
+    # the plan doesn't depend on the values, every parameter is bound to NULL
+    parameters = (None,) * statement.count("?")
+    rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+    return [row[-1] for row in rows]
+
+
+def full_scans(plan, tables):
+    # aliased tables show up as users_1, users_2 ...
+    return [step for step in plan
+            if (match := FULL_SCAN.match(step))
+            and re.sub(r"_\d+$", "", match.group(1)) in tables]
+
+
+def _drive_routes(app):
+    # every route with enough data behind it to take its real code path,
+    # returns the statements they ran
+    anonymous = app.test_client()
+    alice = app.test_client()
+    bob = app.test_client()
+    with count_queries() as queries:
+        for client, name in ((alice, "alice"), (bob, "bobby")):
+            client.post("/register", data={"username": name, "email": f"{name}@example.com",
+                                           "password": "secret", "confirm_password": "secret"})
+            client.post("/login", data={"email": f"{name}@example.com", "password": "secret"})
+        bob.get("/follow/alice")
+        for number in range(3):
+            alice.post("/create_post", data={"title": f"plan post {number}",
+                                             "body": "some *words*", "tags": "flask, python"})
+        for _ in range(3):
+            bob.post("/post/1", data={"body": "a comment"})
+
+        home = anonymous.get("/").get_data(as_text=True)
+        cursor = re.search(r"after=([\w-]+)", home)
+        tag_page = anonymous.get("/tag/flask").get_data(as_text=True)
+        tag_cursor = re.search(r"after=([\w-]+)", tag_page)
+        comments = anonymous.get("/post/1").get_data(as_text=True)
+        comments_cursor = re.search(r"comments_after=([\w-]+)", comments)
+        urls = [
+            "/", "/post/1", "/tag/flask", "/tags", "/user/alice", "/user/bobby", "/search?q=words",
+            "/login", "/register",
+            "/api/v1/posts", "/api/v1/posts?tag=flask", "/api/v1/posts/1", "/api/v1/posts/1/comments",
+            "/api/v1/tags", "/api/v1/users/alice", "/api/v1/users/alice/posts",
+            "/api/v1/export/posts.ndjson", "/api/v1/export/comments.ndjson",
+        ]
+        if cursor:
+            urls.append(f"/?after={cursor.group(1)}")
+        if tag_cursor:
+            urls.append(f"/tag/flask?after={tag_cursor.group(1)}")
+        if comments_cursor:
+            urls.append(f"/post/1?comments_after={comments_cursor.group(1)}")
+        for url in ("/api/v1/posts", "/api/v1/posts?tag=flask", "/api/v1/posts/1/comments"):
+            api_cursor = anonymous.get(url).get_json()["next_cursor"]
+            if api_cursor:
+                urls.append(f"{url}{'&' if '?' in url else '?'}after={api_cursor}")
+        for url in urls:
+            anonymous.get(url)
+            bob.get(url)
+        bob.get("/timeline")
+        alice.get("/post/1/edit")
+        alice.post("/post/1/edit", data={"title": "plan post 0", "body": "other words",
+                                         "tags": "flask, sqlite"})
+        bob.get("/unfollow/alice")
+        bob.get("/follow/alice")
+        alice.post("/post/3/delete")
+        bob.post("/account/delete")
+    return list(queries.statements)
+
+
+@click.command("check-plans")
+@click.option("--verbose", is_flag=True, help="Print every plan, not only the failing ones.")
+def check_plans_command(verbose):
+    """Fail if any statement behind a route scans a whole table."""
+    from app import create_app
+    from migrations import upgrade
+
+    directory = tempfile.mkdtemp()
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(directory, 'plans.db')}",
+        "READ_SESSION_ENABLED": False,
+        "CACHE_BACKEND": "null",
+        # the job queue's statements are checked with the rest
+        "JOBS_MODE": "inline",
+        "WTF_CSRF_ENABLED": False,
+        "POSTS_PER_PAGE": 2,
+        "PROFILE_LIST_PER_PAGE": 2,
+        "COMMENTS_PER_PAGE": 2,
+    })
+    statements = []
+    failures = []
+    errors = []
+
+    def run():
+        # not inside the cli's app context, so the scratch app gets a session
+        # (and a g) of its own
+        try:
+            check()
+        except Exception as error:
+            errors.append(error)
+
+    def check():
+        with app.app_context():
+            upgrade()
+        # outside the app context: a request pushes its own only when none is
+        # active, and sharing one would share g (and the logged in user)
+        # between the clients
+        statements.extend(_drive_routes(app))
+        with app.app_context():
+            tables = set(db.metadata.tables) | {"search_index"}
+            with db.engine.connect() as connection:
+                for statement in statements:
+                    if not statement.lstrip().upper().startswith(
+                            ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")):
+                        continue
+                    plan = explain(connection, statement)
+                    scans = full_scans(plan, tables)
+                    if scans:
+                        failures.append((statement, scans))
+                    if verbose:
+                        click.echo(" ".join(statement.split()))
+                        for step in plan:
+                            click.echo(f"    {step}")
+            db.engine.dispose()
+
+    try:
+        worker = threading.Thread(target=run)
+        worker.start()
+        worker.join()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    if errors:
+        raise errors[0]
+
+    for statement, scans in failures:
+        click.echo(f"full table scan ({', '.join(scans)}):\n    {' '.join(statement.split())}\n")
+    if failures:
+        raise click.ClickException(f"{len(failures)} of {len(statements)} statements scan a whole table.")
+    click.echo(f"{len(statements)} statements checked, none scans a whole table.")
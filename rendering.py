@@ -0,0 +1,184 @@
+import html
+import math
+import re
+import threading
+from html.parser import HTMLParser
+
+import click
+from flask.cli import AppGroup
+import markdown
+from sqlalchemy import select, update
+
+from extensions import db
+from models import Post
+
+
+# post bodies are rendered once, when the post is written, not on every view.
+#
+# the markdown the author typed stays in posts.body (the edit form and the
+# search index use it). next to it go body_html (markdown -> html, then
+# cleaned down to an allowlist of tags and attributes, so it is safe to
+# output as is), a plain text excerpt for the list pages and a reading time.
+# list pages defer body/body_html and only read the small columns.
+
+posts_cli = AppGroup("posts", help="Maintain the rendered post bodies.")
+
+EXCERPT_LENGTH = 200
+WORDS_PER_MINUTE = 200
+
+ALLOWED_TAGS = {
+    "a", "abbr", "b", "blockquote", "br", "code", "em", "h1", "h2", "h3", "h4", "h5", "h6",
+    "hr", "i", "li", "ol", "p", "pre", "strong", "ul",
+}
+ALLOWED_ATTRIBUTES = {"a": {"href", "title"}, "abbr": {"title"}}
+ALLOWED_SCHEMES = {"http", "https", "mailto"}
+VOID_TAGS = {"br", "hr"}
+# dropped together with everything inside them
+DROP_CONTENT_TAGS = {"script", "style", "iframe", "object", "embed", "template"}
+
+
+class _Sanitizer(HTMLParser):
+    # rebuilds the document keeping only allowed tags/attributes, and
+    # collects the text on the way (for the excerpt)
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.out = []
+        self.text = []
+        self.open_tags = []
+        self.dropping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROP_CONTENT_TAGS:
+            self.dropping += 1
+            return
+        if self.dropping or tag not in ALLOWED_TAGS:
+            return
+        allowed = ALLOWED_ATTRIBUTES.get(tag, set())
+        kept = "".join(f' {name}="{html.escape(value, quote=True)}"'
+                       for name, value in attrs
+                       if name in allowed and value is not None and _safe_value(name, value))
+        self.out.append(f"<{tag}{kept}>")
+        if tag not in VOID_TAGS:
+            self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag in DROP_CONTENT_TAGS:
+            self.dropping -= 1
+
+    def handle_endtag(self, tag):
+        if tag in DROP_CONTENT_TAGS:
+            self.dropping = max(self.dropping - 1, 0)
+            return
+        if self.dropping or tag not in self.open_tags:
+            return
+        # close anything left open inside it too
+        while self.open_tags:
+            open_tag = self.open_tags.pop()
+            self.out.append(f"</{open_tag}>")
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if self.dropping:
+            return
+        self.out.append(html.escape(data, quote=False))
+        self.text.append(data)
+
+    def result(self):
+        self.close()
+        return "".join(self.out + [f"</{tag}>" for tag in reversed(self.open_tags)])
+
+
+# browsers drop tabs and newlines anywhere in a url (and control characters
+# and spaces around it), "java&#9;script:" is "javascript:" to them
+_URL_IGNORED = re.compile(r"[\x00-\x20\x7f]+")
+RELATIVE_URL_STARTS = ("/", "#", "?")
+
+
+def _safe_value(name, value):
+    if name != "href":
+        return True
+    url = _URL_IGNORED.sub("", value)
+    if url.startswith(RELATIVE_URL_STARTS):
+        return True
+    # anything else needs one of the allowed schemes, spelled out
+    scheme = re.match(r"([a-zA-Z][a-zA-Z0-9+.-]*):", url)
+    return scheme is not None and scheme.group(1).lower() in ALLOWED_SCHEMES
+
+
+def sanitize(dirty_html):
+    # -> (clean html, its text content)
+    sanitizer = _Sanitizer()
+    sanitizer.feed(dirty_html)
+    return sanitizer.result(), "".join(sanitizer.text)
+
+
+_converters = threading.local()
+
+
+def markdown_to_html(text):
+    # setting up a Markdown instance costs about as much as converting a
+    # post, keep one per thread (they aren't thread safe) and reset it
+    converter = getattr(_converters, "markdown", None)
+    if converter is None:
+        converter = _converters.markdown = markdown.Markdown(extensions=["fenced_code", "sane_lists"])
+    return converter.reset().convert(text)
+
+
+def make_excerpt(text, length=EXCERPT_LENGTH):
+    text = " ".join(text.split())
+    if len(text) <= length:
+        return text
+    cut = text[:length].rsplit(" ", 1)[0] or text[:length]
+    return cut.rstrip(".,;:!?") + "…"
+
+
+def reading_time(text):
+    # whole minutes, never less than one
+    return max(1, math.ceil(len(text.split()) / WORDS_PER_MINUTE))
+
+
+def render_body(body):
+    # markdown source -> the values of (body_html, excerpt, reading_time)
+    body_html, text = sanitize(markdown_to_html(body or ""))
+    return {"body_html": body_html, "excerpt": make_excerpt(text),
+            "reading_time": reading_time(text)}
+
+
+def render_post(post):
+    # call whenever post.body is set
+    for name, value in render_body(post.body).items():
+        setattr(post, name, value)
+
+
+def render_all(batch_size=500, only_missing=True):
+    # re-render stored posts in batches of ids, yields the running total
+    last_id = 0
+    total = 0
+    while True:
+        query = select(Post.id, Post.body).where(Post.id > last_id).order_by(Post.id).limit(batch_size)
+        if only_missing:
+            query = query.where(Post.body_html.is_(None))
+        rows = db.session.execute(query).all()
+        if not rows:
+            return
+        db.session.execute(update(Post), [{"id": post_id, **render_body(body)}
+                                          for post_id, body in rows])
+        db.session.commit()
+        total += len(rows)
+        last_id = rows[-1].id
+        yield total
+
+
+@posts_cli.command("render")
+@click.option("--all", "render_every_post", is_flag=True,
+              help="Re-render every post, not only the ones never rendered.")
+@click.option("--batch-size", default=500, show_default=True,
+              help="How many posts to render per transaction.")
+def render_command(render_every_post, batch_size):
+    """Fill body_html, excerpt and reading_time for existing posts."""
+    total = 0
+    for total in render_all(batch_size, only_missing=not render_every_post):
+        click.echo(f"rendered {total} posts...")
+    click.echo(f"done, {total} posts rendered.")
@@ -0,0 +1,240 @@
+import re
+
+import click
+from flask.cli import AppGroup
+from markupsafe import Markup, escape
+from sqlalchemy import DDL, column, delete, event, select, table, text, union
+
+from extensions import db
+from jobs import job_queue
+from models import Comment, Post
+
+
+# full text search over posts and comments, using an sqlite FTS5 table.
+#
+# posts and comments share one index. a post is stored at rowid 2 * id and a
+# comment at 2 * id + 1, so both can be updated or removed by rowid (a b-tree
+# lookup) instead of searching the index for them.
+#
+# new and edited posts and comments are indexed by background jobs (see
+# jobs.py), so writing one doesn't wait on the fts insert. deletes are applied
+# from the session, in the same transaction: whatever a flush deletes is gone
+# from search_index when it commits.
+
+search_cli = AppGroup("search", help="Maintain the full text search index.")
+
+CREATE_INDEX = """
+CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+    title,
+    body,
+    kind UNINDEXED,
+    post_id UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2'
+)
+"""
+
+# markers snippet()/highlight() put around matches, swapped for <mark> after
+# the text has been escaped
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+event.listen(db.metadata, "after_create", DDL(CREATE_INDEX))
+event.listen(db.metadata, "before_drop", DDL("DROP TABLE IF EXISTS search_index"))
+
+
+def post_rowid(post_id):
+    return post_id * 2
+
+
+def comment_rowid(comment_id):
+    return comment_id * 2 + 1
+
+
+def post_index_row(post_id, title, body):
+    return {"rowid": post_rowid(post_id), "title": title, "body": body,
+            "kind": "post", "post_id": post_id}
+
+
+def comment_index_row(comment_id, post_id, body):
+    return {"rowid": comment_rowid(comment_id), "title": "", "body": body,
+            "kind": "comment", "post_id": post_id}
+
+
+def _post_row(post):
+    return post_index_row(post.id, post.title, post.body)
+
+
+def _comment_row(comment):
+    return comment_index_row(comment.id, comment.post_id, comment.body)
+
+
+def add_rows(rows):
+    # index rows written without the orm (bulk imports), in the current
+    # transaction. rows come from post_index_row()/comment_index_row().
+    if rows:
+        db.session.execute(INSERT_ROWS, rows)
+
+
+INSERT_ROWS = text(
+    "INSERT INTO search_index (rowid, title, body, kind, post_id) "
+    "VALUES (:rowid, :title, :body, :kind, :post_id)"
+)
+DELETE_ROWS = text("DELETE FROM search_index WHERE rowid = :rowid")
+# for bulk deletes that bypass the session (see accounts.py)
+search_index = table("search_index", column("rowid"))
+
+
+def remove_rows(*rowid_queries):
+    # one DELETE for every rowid the given SELECTs return
+    db.session.execute(delete(search_index).where(search_index.c.rowid.in_(union(*rowid_queries))))
+
+
+def _before_flush(session, flush_context, instances):
+    # a deleted post takes its comments with it, remember their ids now while
+    # they are still in the database
+    post_ids = [obj.id for obj in session.deleted if isinstance(obj, Post)]
+    if not post_ids:
+        return
+    with session.no_autoflush:
+        comment_ids = session.execute(
+            select(Comment.id).where(Comment.post_id.in_(post_ids))
+        ).scalars().all()
+    session.info.setdefault("search_deleted_rowids", set()).update(
+        comment_rowid(comment_id) for comment_id in comment_ids
+    )
+
+
+def _after_flush(session, flush_context):
+    deleted = session.info.pop("search_deleted_rowids", set())
+
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            deleted.add(post_rowid(obj.id))
+        elif isinstance(obj, Comment):
+            deleted.add(comment_rowid(obj.id))
+
+    if deleted:
+        session.connection().execute(DELETE_ROWS, [{"rowid": rowid} for rowid in deleted])
+
+
+def _reindex(rowid, obj, to_row):
+    # replace whatever is indexed at rowid with obj's current text (nothing,
+    # if obj was deleted since). safe to run twice.
+    db.session.execute(DELETE_ROWS, {"rowid": rowid})
+    if obj is not None:
+        db.session.execute(INSERT_ROWS, to_row(obj))
+
+
+@job_queue.handler("post_created")
+@job_queue.handler("post_edited")
+def index_post(post_id):
+    _reindex(post_rowid(post_id), db.session.get(Post, post_id), _post_row)
+
+
+@job_queue.handler("comment_added")
+def index_comment(comment_id, post_id=None):
+    _reindex(comment_rowid(comment_id), db.session.get(Comment, comment_id), _comment_row)
+
+
+event.listen(db.session, "before_flush", _before_flush)
+event.listen(db.session, "after_flush", _after_flush)
+
+
+def build_match_query(query):
+    # user input -> an FTS5 query. every word has to match, the last one as a
+    # prefix so results show up while someone is still typing. quoting the
+    # words keeps FTS5 syntax (AND, NEAR, "*", ...) in the input from leaking
+    # through.
+    words = re.findall(r"\w+", query or "")
+    if not words:
+        return None
+    terms = ['"%s"' % word for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def _marked(fragment):
+    return Markup(
+        str(escape(fragment or ""))
+        .replace(MATCH_START, "<mark>")
+        .replace(MATCH_END, "</mark>")
+    )
+
+
+class SearchResult:
+    def __init__(self, kind, post, title, snippet):
+        self.kind = kind
+        self.post = post
+        self.title = title
+        self.snippet = snippet
+
+
+def search(query, per_page, page=1):
+    # returns (results, has_more), best matches first.
+    # title matches count ten times as much as body matches.
+    match = build_match_query(query)
+    if match is None:
+        return [], False
+
+    rows = db.session.execute(
+        text(
+            "SELECT kind, post_id, "
+            "highlight(search_index, 0, :start, :end) AS title, "
+            "snippet(search_index, 1, :start, :end, '…', 24) AS snippet "
+            "FROM search_index WHERE search_index MATCH :match "
+            "ORDER BY bm25(search_index, 10.0, 1.0) "
+            "LIMIT :limit OFFSET :offset"
+        ),
+        {"match": match, "start": MATCH_START, "end": MATCH_END,
+         "limit": per_page + 1, "offset": (page - 1) * per_page},
+    ).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    # the posts for all results (comments link to their post) in one query
+    post_ids = {row.post_id for row in rows}
+    posts = {post.id: post for post in Post.query.filter(Post.id.in_(post_ids))}
+
+    results = []
+    for row in rows:
+        post = posts.get(row.post_id)
+        if post is None:
+            continue
+        title = _marked(row.title) if row.kind == "post" else escape(post.title)
+        results.append(SearchResult(row.kind, post, title, _marked(row.snippet)))
+    return results, has_more
+
+
+def rebuild_index(batch_size=1000):
+    # re-index everything in batches, yields (table name, rows indexed) per table
+    db.session.execute(text(CREATE_INDEX))
+    db.session.execute(text("DELETE FROM search_index"))
+    db.session.commit()
+
+    for model, to_row in ((Post, _post_row), (Comment, _comment_row)):
+        last_id = 0
+        total = 0
+        while True:
+            batch = model.query.filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+            if not batch:
+                break
+            db.session.execute(INSERT_ROWS, [to_row(obj) for obj in batch])
+            total += len(batch)
+            last_id = batch[-1].id
+            db.session.commit()
+            db.session.expunge_all()
+        yield model.__tablename__, total
+
+    # merge the b-trees the batches left behind
+    db.session.execute(text("INSERT INTO search_index (search_index) VALUES ('optimize')"))
+    db.session.commit()
+
+
+@search_cli.command("rebuild")
+@click.option("--batch-size", default=1000, show_default=True,
+              help="How many rows to index per transaction.")
+def rebuild_command(batch_size):
+    """Rebuild the search index from the posts and comments tables."""
+    for name, total in rebuild_index(batch_size):
+        click.echo(f"indexed {total} {name}")
+    click.echo("done.")
@@ -0,0 +1,194 @@
+import bisect
+import datetime
+import itertools
+import random
+import time
+
+import click
+from sqlalchemy import func, insert, select
+
+from extensions import db
+from models import Comment, Post, Tag, User, follows, post_tags
+from passwords import hash_password
+
+
+# synthetic data at production-like volumes, for benchmarking.
+#
+# real data is skewed, so this is too: a few tags are on most posts (zipf),
+# a few users write most of the posts and have most of the followers
+# (power law), and a few posts get most of the comments.
+#
+# everything goes in with executemany inserts in batches. ids are assigned
+# here (after the current max id) so rows can point at each other without
+# reading anything back.
+
+SEED_PASSWORD = "password"
+
+WORDS = (
+    "flask python database query index cache latency request template session "
+    "cursor page feed follow tag comment post user write read batch stream "
+    "sqlite table column row join scan plan engine pool worker queue job "
+    "render html markdown search rank token bench seed metric trace profile"
+).split()
+
+
+class ZipfChooser:
+    # picks items where the one at rank k is chosen ~ 1 / k**s as often
+    def __init__(self, items, s, rng):
+        self.items = list(items)
+        self.rng = rng
+        total = 0.0
+        self.cumulative = []
+        for rank in range(1, len(self.items) + 1):
+            total += 1.0 / rank ** s
+            self.cumulative.append(total)
+
+    def choose(self):
+        point = self.rng.random() * self.cumulative[-1]
+        return self.items[bisect.bisect_left(self.cumulative, point)]
+
+
+def _next_id(model):
+    return (db.session.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+
+def _insert_batches(table, rows, batch_size):
+    # rows is any iterable, only one batch is in memory at a time
+    total = 0
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return total
+        db.session.execute(insert(table), batch)
+        db.session.commit()
+        total += len(batch)
+
+
+def _words(rng, count):
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+
+def _timestamps(rng, count, start, end):
+    # `count` sorted random moments between start and end, so ids and
+    # created_at go up together like they do for real rows
+    span = (end - start).total_seconds()
+    offsets = sorted(rng.random() * span for _ in range(count))
+    return [start + datetime.timedelta(seconds=offset) for offset in offsets]
+
+
+@click.command("seed")
+@click.option("--users", default=1000, show_default=True)
+@click.option("--posts", default=20000, show_default=True)
+@click.option("--tags", default=500, show_default=True)
+@click.option("--comments", default=50000, show_default=True)
+@click.option("--follows", "follow_count", default=20000, show_default=True)
+@click.option("--max-tags-per-post", default=5, show_default=True)
+@click.option("--skew", default=1.1, show_default=True,
+              help="Zipf exponent for tag, author, follower and comment popularity.")
+@click.option("--days", default=365, show_default=True, help="How far back the data goes.")
+@click.option("--batch-size", default=5000, show_default=True)
+@click.option("--random-seed", default=42, show_default=True)
+def seed_command(users, posts, tags, comments, follow_count, max_tags_per_post, skew,
+                 days, batch_size, random_seed):
+    """Fill the database with skewed synthetic data."""
+    from counters import recount_all
+    from rendering import render_body
+    from search import rebuild_index
+    from tags import recount_all as recount_tags
+    from timeline import backfill_all
+
+    rng = random.Random(random_seed)
+    started = time.perf_counter()
+    end = datetime.datetime.utcnow()
+    start = end - datetime.timedelta(days=days)
+
+    # --- users: one password hash shared by all, hashing is slow ---
+    first_user = _next_id(User)
+    password = hash_password(SEED_PASSWORD)
+    user_ids = list(range(first_user, first_user + users))
+    joined = _timestamps(rng, users, start, end)
+    _insert_batches(User.__table__, (
+        {"id": user_id, "username": f"user{user_id}", "email": f"user{user_id}@example.com",
+         "password": password, "about_me": _words(rng, 20), "created_at": created_at}
+        for user_id, created_at in zip(user_ids, joined)
+    ), batch_size)
+    click.echo(f"{users} users (password: {SEED_PASSWORD!r})")
+
+    # popularity order is random, not by id
+    authors = ZipfChooser(rng.sample(user_ids, len(user_ids)), skew, rng)
+    celebrities = ZipfChooser(rng.sample(user_ids, len(user_ids)), skew, rng)
+
+    # --- tags ---
+    first_tag = _next_id(Tag)
+    tag_ids = list(range(first_tag, first_tag + tags))
+    _insert_batches(Tag.__table__, (
+        {"id": tag_id, "name": f"{rng.choice(WORDS)}-{tag_id}"} for tag_id in tag_ids
+    ), batch_size)
+    popular_tags = ZipfChooser(tag_ids, skew, rng)
+    click.echo(f"{tags} tags")
+
+    # --- posts and their tags ---
+    first_post = _next_id(Post)
+    post_ids = list(range(first_post, first_post + posts))
+    posted = _timestamps(rng, posts, start, end)
+
+    def post_rows():
+        for post_id, created_at in zip(post_ids, posted):
+            paragraphs = [_words(rng, rng.randint(30, 120)) for _ in range(rng.randint(1, 6))]
+            body = "\n\n".join(paragraphs)
+            yield {"id": post_id, "title": f"{_words(rng, 5).capitalize()} #{post_id}",
+                   "body": body, **render_body(body), "created_at": created_at,
+                   "user_id": authors.choose()}
+
+    def post_tag_rows():
+        for post_id, created_at in zip(post_ids, posted):
+            chosen = {popular_tags.choose() for _ in range(rng.randint(0, max_tags_per_post))}
+            for tag_id in chosen:
+                yield {"post_id": post_id, "tag_id": tag_id, "created_at": created_at}
+
+    _insert_batches(Post.__table__, post_rows(), batch_size)
+    tagged = _insert_batches(post_tags, post_tag_rows(), batch_size)
+    click.echo(f"{posts} posts, {tagged} post tags")
+
+    # --- comments, piling up on a few viral posts ---
+    viral = ZipfChooser(rng.sample(post_ids, len(post_ids)), skew, rng) if post_ids else None
+
+    def comment_rows():
+        for _ in range(comments if viral else 0):
+            post_id = viral.choose()
+            created_at = posted[post_id - first_post] + datetime.timedelta(
+                minutes=rng.randint(1, 60 * 24 * 7))
+            yield {"body": _words(rng, rng.randint(5, 40)), "created_at": created_at,
+                   "user_id": rng.choice(user_ids), "post_id": post_id}
+
+    _insert_batches(Comment.__table__, comment_rows(), batch_size)
+    click.echo(f"{comments if viral else 0} comments")
+
+    # --- follows: anyone may follow anyone, the followed are power-law ---
+    def follow_rows():
+        seen = set()
+        attempts = 0
+        while len(seen) < follow_count and attempts < follow_count * 10:
+            attempts += 1
+            edge = (rng.choice(user_ids), celebrities.choose())
+            if edge[0] == edge[1] or edge in seen:
+                continue
+            seen.add(edge)
+            yield {"follower_id": edge[0], "followed_id": edge[1]}
+
+    followed = _insert_batches(follows, follow_rows(), batch_size)
+    click.echo(f"{followed} follows")
+
+    # --- everything derived from the rows above ---
+    recount_all(batch_size)
+    click.echo("recounted user counters")
+    recount_tags()
+    click.echo("recounted tag counters")
+    for _ in backfill_all(batch_size):
+        pass
+    click.echo("backfilled timelines")
+    for table, total in rebuild_index(batch_size):
+        click.echo(f"indexed {total} {table}")
+
+    click.echo(f"done in {time.perf_counter() - started:.1f}s.")
@@ -0,0 +1,172 @@
+import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import Integer, bindparam, cast, delete, func, insert, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from extensions import db
+from models import Post, Tag, TagUsage, post_tags
+
+
+# turning the "tags" text box into Tag rows.
+# all names are looked up with one IN query, the missing ones are created
+# with one INSERT OR IGNORE (so two posts introducing the same new tag at the
+# same time don't trip the unique constraint), and edits only touch the
+# post_tags rows that actually changed.
+#
+# every change to a post's tags is also counted: tags.post_count for the
+# tag directory, and tag_usage (uses per tag per hour of the post's
+# created_at) for trending. both are adjusted by the delta, with one
+# statement each however many tags changed, never recounted on the way.
+
+tags_cli = AppGroup("tags", help="Maintain the tag counters.")
+
+
+def parse_tag_names(tag_string):
+    # "flask, python,  flask" -> ["flask", "python"]
+    names = []
+    for name in (tag_string or "").split(","):
+        name = name.strip()
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+def resolve_tags(names):
+    # Tag objects for `names`, in the same order, creating any that are missing
+    if not names:
+        return []
+    with db.session.no_autoflush:
+        found = {tag.name: tag for tag in Tag.query.filter(Tag.name.in_(names))}
+        missing = [name for name in names if name not in found]
+        if missing:
+            db.session.execute(
+                insert(Tag).prefix_with("OR IGNORE"),
+                [{"name": name} for name in missing],
+            )
+            found.update({tag.name: tag for tag in Tag.query.filter(Tag.name.in_(missing))})
+    return [found[name] for name in names]
+
+
+def set_post_tags(post, names):
+    # make post.tags match `names`, returns the (added, removed) tags
+    tags = resolve_tags(names)
+    wanted = {tag.id for tag in tags}
+    current = {tag.id for tag in post.tags}
+
+    removed = [tag for tag in post.tags if tag.id not in wanted]
+    added = [tag for tag in tags if tag.id not in current]
+    for tag in removed:
+        post.tags.remove(tag)
+    for tag in added:
+        post.tags.append(tag)
+    record_tag_changes(post, added, removed)
+    return added, removed
+
+
+def hour_bucket(moment):
+    # naive datetimes here are utc, like CURRENT_TIMESTAMP
+    return int(moment.replace(tzinfo=datetime.timezone.utc).timestamp()) // 3600
+
+
+def hour_bucket_sql(column):
+    # hour_bucket() done by sqlite
+    return cast(func.strftime("%s", column), Integer) // 3600
+
+
+def record_tag_changes(post, added=(), removed=()):
+    # `added`/`removed` tags were attached to / detached from `post`
+    bucket = hour_bucket(post.created_at or datetime.datetime.utcnow())
+    changes = {}
+    for tag, delta in [(tag, 1) for tag in added] + [(tag, -1) for tag in removed]:
+        changes[(tag.id, bucket)] = changes.get((tag.id, bucket), 0) + delta
+    apply_tag_changes(changes)
+
+
+def apply_tag_changes(changes):
+    # {(tag_id, bucket): delta} -> one UPDATE for post_count and one upsert
+    # for tag_usage (both executemany)
+    changes = {key: delta for key, delta in changes.items() if delta}
+    if not changes:
+        return
+    per_tag = {}
+    for (tag_id, _), delta in changes.items():
+        per_tag[tag_id] = per_tag.get(tag_id, 0) + delta
+
+    # the counters don't depend on anything pending in the session (a new
+    # post may not even be in it yet)
+    with db.session.no_autoflush:
+        tags = Tag.__table__
+        db.session.execute(
+            update(tags).where(tags.c.id == bindparam("tag_id"))
+            .values(post_count=tags.c.post_count + bindparam("delta")),
+            [{"tag_id": tag_id, "delta": delta} for tag_id, delta in per_tag.items()],
+        )
+        usage = sqlite_insert(TagUsage.__table__)
+        db.session.execute(
+            usage.on_conflict_do_update(
+                index_elements=["tag_id", "bucket"],
+                set_={"uses": TagUsage.__table__.c.uses + usage.excluded.uses},
+            ),
+            [{"tag_id": tag_id, "bucket": bucket, "uses": delta}
+             for (tag_id, bucket), delta in changes.items()],
+        )
+
+
+def trending_tags(limit, hours):
+    # [(tag, uses)] for the tags put on the most posts in the last `hours`
+    since = hour_bucket(datetime.datetime.utcnow()) - hours + 1
+    uses = func.sum(TagUsage.uses).label("uses")
+    rows = db.session.execute(
+        select(TagUsage.tag_id, uses).where(TagUsage.bucket >= since)
+        .group_by(TagUsage.tag_id).having(uses > 0)
+        .order_by(uses.desc(), TagUsage.tag_id).limit(limit)
+    ).all()
+    by_id = {tag.id: tag for tag in Tag.query.filter(Tag.id.in_([row.tag_id for row in rows]))}
+    return [(by_id[row.tag_id], row.uses) for row in rows if row.tag_id in by_id]
+
+
+def recount_all():
+    # rebuild post_count and tag_usage from post_tags, returns how many tags
+    # had a wrong post_count
+    true_count = select(func.count()).select_from(post_tags) \
+        .where(post_tags.c.tag_id == Tag.id).scalar_subquery()
+    repaired = db.session.execute(
+        update(Tag).where(Tag.post_count != true_count).values(post_count=true_count)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.execute(delete(TagUsage))
+    bucket = hour_bucket_sql(Post.created_at)
+    db.session.execute(insert(TagUsage).from_select(
+        ["tag_id", "bucket", "uses"],
+        select(post_tags.c.tag_id, bucket, func.count())
+        .join(Post, Post.id == post_tags.c.post_id)
+        .group_by(post_tags.c.tag_id, bucket),
+    ))
+    db.session.commit()
+    return repaired
+
+
+def prune_usage(keep_hours):
+    # drop usage buckets older than anything trending looks at
+    since = hour_bucket(datetime.datetime.utcnow()) - keep_hours + 1
+    deleted = db.session.execute(delete(TagUsage).where(TagUsage.bucket < since)).rowcount
+    db.session.commit()
+    return deleted
+
+
+@tags_cli.command("recount")
+def recount_command():
+    """Recount posts per tag and rebuild the hourly usage counters."""
+    repaired = recount_all()
+    click.echo(f"recounted tags, repaired {repaired} post counts.")
+
+
+@tags_cli.command("prune")
+@click.option("--keep-hours", type=int, help="Defaults to TRENDING_TAGS_HOURS.")
+def prune_command(keep_hours):
+    """Delete hourly usage counters too old to count for trending."""
+    deleted = prune_usage(keep_hours or current_app.config["TRENDING_TAGS_HOURS"])
+    click.echo(f"deleted {deleted} old usage buckets.")
@@ -0,0 +1,49 @@
+import os
+from functools import lru_cache
+
+from jinja2 import FileSystemBytecodeCache
+
+
+# templates are ready before the first request.
+#
+# jinja compiles a template to python the first time it is rendered, which
+# made the first hit on every page of every new worker slow. with
+# TEMPLATE_BYTECODE_CACHE the compiled code is kept on disk (in
+# TEMPLATE_CACHE_DIR, keyed by the template source, so an edited template is
+# recompiled), and with TEMPLATE_PRECOMPILE every template is loaded when
+# the app is created: a new worker only unmarshals the code another one
+# compiled.
+
+DATE_FORMAT = "%I:%M %p on %B %d, %Y"
+
+
+@lru_cache(maxsize=4096)
+def format_datetime(value):
+    # "09:15 AM on March 02, 2025". the same timestamps show up on page
+    # after page (a post in every list it is in, its comments ...)
+    if value is None:
+        return ""
+    return value.strftime(DATE_FORMAT)
+
+
+def init_app(app):
+    app.config.setdefault("TEMPLATE_BYTECODE_CACHE", True)
+    app.config.setdefault("TEMPLATE_CACHE_DIR", os.path.join(app.instance_path, "jinja_cache"))
+    app.config.setdefault("TEMPLATE_PRECOMPILE", True)
+
+    if app.config["TEMPLATE_BYTECODE_CACHE"]:
+        os.makedirs(app.config["TEMPLATE_CACHE_DIR"], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config["TEMPLATE_CACHE_DIR"])
+
+    app.add_template_filter(format_datetime, "datetime")
+
+
+def precompile(app):
+    # load every template (the app's and the blueprints'), once they are all
+    # registered. returns how many there were.
+    if not app.config["TEMPLATE_PRECOMPILE"]:
+        return 0
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
@@ -0,0 +1,30 @@
+import pytest
+
+from app import create_app
+from config import TestingConfig
+from extensions import db
+
+
+# every test gets an app on a fresh in-memory database (TestingConfig), never
+# the one next to the code. no app context stays pushed: a request only
+# pushes its own when none is active, and sharing one would share g (and the
+# logged in user) between test clients.
+
+
+@pytest.fixture
+def app():
+    app = create_app(TestingConfig)
+    with app.app_context():
+        db.create_all()
+    yield app
+    with app.app_context():
+        db.engine.dispose()
+
+
+def sign_up(app, name):
+    # a test client logged in as a new user
+    client = app.test_client()
+    client.post("/register", data={"username": name, "email": f"{name}@example.com",
+                                   "password": "secret", "confirm_password": "secret"})
+    client.post("/login", data={"email": f"{name}@example.com", "password": "secret"})
+    return client
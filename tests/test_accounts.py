@@ -0,0 +1,144 @@
+import pytest
+from sqlalchemy import func, insert, select
+
+from accounts import delete_accounts
+from extensions import db
+from instrumentation import count_queries, query_budget
+from models import Comment, Post, Tag, TagUsage, TimelineEntry, User, follows, post_tags
+from tags import hour_bucket_sql
+from tests.conftest import sign_up
+
+
+def _community(app):
+    # alice follows carol, bobby and carol follow alice, dave follows bobby.
+    # alice and carol post, bobby comments on alice's post and alice on
+    # carol's
+    clients = {name: sign_up(app, name) for name in ("alice", "bobby", "carol", "dave")}
+    clients["bobby"].get("/follow/alice")
+    clients["alice"].get("/follow/carol")
+    clients["carol"].get("/follow/alice")
+    clients["dave"].get("/follow/bobby")
+    for number in range(2):
+        clients["alice"].post("/create_post", data={"title": f"alice {number}", "body": "words",
+                                                    "tags": "flask, python"})
+    clients["carol"].post("/create_post", data={"title": "carol 0", "body": "words", "tags": "flask"})
+    clients["bobby"].post("/post/1", data={"body": "on alice's post"})
+    clients["alice"].post("/post/3", data={"body": "on carol's post"})
+
+
+def _user(name):
+    return db.session.execute(select(User).where(User.username == name)).scalar_one()
+
+
+def _count(statement):
+    return db.session.execute(statement).scalar_one()
+
+
+def _add_user(name):
+    return db.session.execute(
+        insert(User).values(username=name, email=f"{name}@example.com", password="-")
+    ).inserted_primary_key[0]
+
+
+def _add_post(user_id, title, tag_id, commenter_id, comments):
+    post_id = db.session.execute(
+        insert(Post).values(title=title, body="words", user_id=user_id)
+    ).inserted_primary_key[0]
+    db.session.execute(insert(post_tags).values(post_id=post_id, tag_id=tag_id))
+    if comments:
+        db.session.execute(insert(Comment), [
+            {"body": "a comment", "user_id": commenter_id, "post_id": post_id}
+        ] * comments)
+    return post_id
+
+
+def test_delete_accounts_removes_everything_they_own(app):
+    _community(app)
+    with app.app_context():
+        alice = _user("alice").id
+        with query_budget(10):
+            assert delete_accounts([alice]) == 1
+
+        assert _count(select(func.count()).select_from(User).where(User.username == "alice")) == 0
+        assert _count(select(func.count()).select_from(Post).where(Post.user_id == alice)) == 0
+        assert _count(select(func.count()).select_from(Comment).where(
+            (Comment.user_id == alice) | Comment.post_id.in_([1, 2]))) == 0
+        assert _count(select(func.count()).select_from(post_tags).where(
+            post_tags.c.post_id.in_([1, 2]))) == 0
+        assert _count(select(func.count()).select_from(follows).where(
+            (follows.c.follower_id == alice) | (follows.c.followed_id == alice))) == 0
+        assert _count(select(func.count()).select_from(TimelineEntry).where(
+            (TimelineEntry.user_id == alice) | (TimelineEntry.author_id == alice))) == 0
+
+        # the counters on the other side
+        bobby, carol, dave = _user("bobby"), _user("carol"), _user("dave")
+        assert (bobby.follower_count, bobby.following_count) == (1, 0)
+        assert (carol.follower_count, carol.following_count) == (0, 0)
+        assert (dave.follower_count, dave.following_count) == (0, 1)
+        tags = dict(db.session.execute(select(Tag.name, Tag.post_count)).all())
+        assert tags == {"flask": 1, "python": 0}
+        # carol's post and the comments left on it
+        assert _count(select(func.count()).select_from(Post)) == 1
+        assert _count(select(func.count()).select_from(Comment)) == 0
+
+
+@pytest.mark.parametrize("posts, comments", [(1, 0), (1, 50), (20, 1), (20, 50)])
+def test_delete_accounts_runs_the_same_statements_whatever_they_own(app, posts, comments):
+    # an account with one post and one comment against one with `posts`
+    # posts and `comments` comments under each, followed by a reader who
+    # wrote the comments
+    with app.app_context():
+        tag = db.session.execute(insert(Tag).values(name="flask")).inserted_primary_key[0]
+        reader = _add_user("reader")
+        reference = _add_user("reference")
+        _add_post(reference, "reference", tag, reader, 1)
+        author = _add_user("author")
+        for number in range(posts):
+            _add_post(author, f"post {number}", tag, reader, comments)
+        db.session.execute(insert(follows), [{"follower_id": reader, "followed_id": reference},
+                                             {"follower_id": reader, "followed_id": author}])
+        db.session.commit()
+
+        with count_queries() as one:
+            delete_accounts([reference])
+        with count_queries() as many:
+            delete_accounts([author])
+        assert many.count == one.count
+        assert _count(select(func.count()).select_from(Post)) == 0
+        assert _count(select(func.count()).select_from(Comment)) == 0
+
+
+@pytest.mark.parametrize("comments", [0, 1, 50, 500])
+def test_delete_post_runs_the_same_statements_whatever_is_under_it(app, comments):
+    client = sign_up(app, "alice")
+    with app.app_context():
+        alice = _user("alice").id
+        tag = db.session.execute(insert(Tag).values(name="flask")).inserted_primary_key[0]
+        reader = _add_user("reader")
+        reference = _add_post(alice, "reference", tag, reader, 1)
+        post = _add_post(alice, "post", tag, reader, comments)
+        db.session.commit()
+
+    # the logged in user is loaded (and cached) before anything is counted
+    client.get("/")
+    with count_queries() as one:
+        client.post(f"/post/{reference}/delete")
+    with count_queries() as many:
+        client.post(f"/post/{post}/delete")
+    assert many.count == one.count
+    with app.app_context():
+        assert _count(select(func.count()).select_from(Post)) == 0
+        assert _count(select(func.count()).select_from(Comment)) == 0
+        assert _count(select(func.count()).select_from(post_tags)) == 0
+
+
+def test_a_post_is_counted_and_uncounted_in_the_same_hour(app):
+    client = sign_up(app, "alice")
+    client.post("/create_post", data={"title": "tagged", "body": "words", "tags": "flask"})
+    with app.app_context():
+        created = db.session.execute(select(hour_bucket_sql(Post.created_at))).scalar_one()
+        assert db.session.execute(select(TagUsage.bucket, TagUsage.uses)).all() == [(created, 1)]
+
+    client.post("/post/1/delete")
+    with app.app_context():
+        assert db.session.execute(select(TagUsage.bucket, TagUsage.uses)).all() == [(created, 0)]
@@ -0,0 +1,99 @@
+import json
+
+from sqlalchemy import insert
+
+from extensions import db
+from instrumentation import count_queries
+from models import Post
+from tests.conftest import sign_up
+
+
+def _post(client, title, tags="flask"):
+    client.post("/create_post", data={"title": title, "body": f"*{title}* words", "tags": tags})
+
+
+def _pages(client, url):
+    # every page of a list, following next_cursor
+    pages = []
+    cursor = None
+    while True:
+        page = client.get(url + (f"&after={cursor}" if cursor else "")).get_json()
+        pages.append(page)
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return pages
+
+
+def test_a_post_and_its_comments(app):
+    alice = sign_up(app, "alice")
+    _post(alice, "hello", tags="flask, python")
+    alice.post("/post/1", data={"body": "first!"})
+
+    listed = alice.get("/api/v1/posts").get_json()
+    assert set(listed) == {"items", "next_cursor", "prev_cursor"}
+    assert (listed["next_cursor"], listed["prev_cursor"]) == (None, None)
+    [summary] = listed["items"]
+    assert summary["title"] == "hello"
+    assert summary["author"] == {"username": "alice", "url": "http://localhost/api/v1/users/alice"}
+    assert sorted(summary["tags"]) == ["flask", "python"]
+    assert summary["url"] == "http://localhost/api/v1/posts/1"
+    assert summary["html_url"] == "http://localhost/post/1"
+    assert "body" not in summary
+
+    full = alice.get("/api/v1/posts/1").get_json()
+    assert full["body"] == "*hello* words"
+    assert "<em>hello</em>" in full["body_html"]
+    assert {key: full[key] for key in summary} == summary
+
+    [comment] = alice.get("/api/v1/posts/1/comments").get_json()["items"]
+    assert (comment["post_id"], comment["body"], comment["author"]["username"]) == (1, "first!", "alice")
+
+    missing = alice.get("/api/v1/posts/2")
+    assert (missing.status_code, missing.get_json()) == (404, {"error": "not found"})
+    assert alice.get("/api/v1/posts/2/comments").status_code == 404
+
+
+def test_cursors_walk_every_post_once_both_ways(app):
+    alice = sign_up(app, "alice")
+    # created in the same second: the ids break the ties
+    for number in range(7):
+        _post(alice, f"post {number}", tags="flask" if number % 2 else "python")
+
+    pages = _pages(alice, "/api/v1/posts?limit=3")
+    assert [[item["title"] for item in page["items"]] for page in pages] == [
+        ["post 6", "post 5", "post 4"], ["post 3", "post 2", "post 1"], ["post 0"]]
+    assert pages[0]["prev_cursor"] is None
+
+    back = alice.get(f"/api/v1/posts?limit=3&before={pages[2]['prev_cursor']}").get_json()
+    assert back["items"] == pages[1]["items"]
+
+    tagged = _pages(alice, "/api/v1/posts?limit=2&tag=flask")
+    assert [item["title"] for page in tagged for item in page["items"]] == ["post 5", "post 3", "post 1"]
+
+    assert [tag["name"] for tag in alice.get("/api/v1/tags").get_json()["items"]] == ["python", "flask"]
+
+
+def test_an_export_streams_every_row_in_batches(app):
+    alice = sign_up(app, "alice")
+    _post(alice, "tagged")
+    with app.app_context():
+        db.session.execute(insert(Post), [{"title": f"post {number}", "body": "words", "user_id": 1}
+                                          for number in range(24)])
+        db.session.commit()
+    app.config["API_EXPORT_BATCH_SIZE"] = 10
+
+    with count_queries() as queries:
+        response = alice.get("/api/v1/export/posts.ndjson", buffered=False)
+        assert response.is_streamed
+        assert response.mimetype == "application/x-ndjson"
+        chunks = [chunk.decode() for chunk in response.response]
+    # 25 posts, 10 to a chunk, one line each
+    assert [chunk.count("\n") for chunk in chunks] == [10, 10, 5]
+    rows = [json.loads(line) for chunk in chunks for line in chunk.splitlines()]
+    assert [row["id"] for row in rows] == list(range(1, 26))
+    assert rows[0]["tags"] == ["flask"] and rows[0]["author"]["username"] == "alice"
+    # the tags are loaded once per batch, not once per post
+    assert queries.count < 10
+
+    resumed = alice.get("/api/v1/export/posts.ndjson?after_id=20").get_data(as_text=True)
+    assert [json.loads(line)["id"] for line in resumed.splitlines()] == [21, 22, 23, 24, 25]
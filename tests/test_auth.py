@@ -0,0 +1,26 @@
+from sqlalchemy import delete, func, select
+
+from extensions import db
+from models import Post, User
+from tests.conftest import sign_up
+
+
+def test_a_write_by_an_account_deleted_elsewhere_logs_out(app):
+    alice = sign_up(app, "alice")
+    # alice is in this process's user cache
+    assert alice.get("/create_post").status_code == 200
+
+    # another process deletes the account: this one's cache still has it
+    with app.app_context():
+        db.session.execute(delete(User).where(User.username == "alice"))
+        db.session.commit()
+
+    response = alice.post("/create_post", data={"title": "hello", "body": "words", "tags": "flask"})
+    assert response.status_code == 302
+    assert response.location == "/login"
+    assert "Your account no longer exists." in alice.get("/login").get_data(as_text=True)
+    # logged out, and not in the cache any more
+    assert alice.get("/create_post").location.startswith("/login")
+    with app.app_context():
+        assert db.session.execute(select(func.count()).select_from(Post)).scalar_one() == 0
+        assert app.extensions["auth_users"].get(1) is None
@@ -0,0 +1,42 @@
+import sqlite3
+import time
+
+from cache import MemoryCache, SQLiteCache
+
+
+def _rows(path):
+    with sqlite3.connect(path) as connection:
+        return connection.execute("SELECT count(*) FROM cache_entries").fetchone()[0]
+
+
+def test_sqlite_cache_keeps_the_newest_max_entries(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = SQLiteCache(path, max_entries=50)
+    for i in range(1000):
+        cache.set(f"page:{i}", i, timeout=300)
+    assert _rows(path) <= 50 + SQLiteCache.PRUNE_EVERY
+    cache.prune()
+    assert _rows(path) == 50
+    assert cache.get("page:999") == 999
+    assert cache.get("page:0") is None
+
+
+def test_sqlite_cache_sweeps_expired_entries_nobody_reads(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = SQLiteCache(path, max_entries=1000)
+    for i in range(10):
+        cache.set(f"old:{i}", i, timeout=0.01)
+    time.sleep(0.02)
+    cache.set("fresh", 1, timeout=300)
+    assert cache.prune() == 10
+    assert _rows(path) == 1
+
+
+def test_memory_cache_evicts_least_recently_used():
+    cache = MemoryCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
@@ -0,0 +1,120 @@
+import json
+import os
+
+from sqlalchemy import select
+
+from extensions import db
+from importer import LOADERS, Loader, _source_key, checkpoint, import_records, read_records
+from models import User, follows
+
+
+def _write(path, records):
+    # records are dicts, or strings written as they are
+    path.write_text("".join((line if isinstance(line, str) else json.dumps(line)) + "\n"
+                            for line in records))
+    return path
+
+
+def _users(names):
+    return [{"username": name, "email": f"{name}@example.com", "password_hash": "-"} for name in names]
+
+
+def _import(app, kind, path, *options):
+    result = app.test_cli_runner().invoke(args=["import", kind, str(path), *options])
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def _usernames():
+    return db.session.execute(select(User.username).order_by(User.id)).scalars().all()
+
+
+def test_an_interrupted_import_resumes_after_the_last_batch(app, tmp_path):
+    path = _write(tmp_path / "users.jsonl", _users(["alice", "bobby", "carol", "dave", "erin"]))
+    with app.app_context():
+        # the first run dies after one batch of two
+        with open(path, encoding="utf-8") as stream:
+            batches = import_records(Loader("users", LOADERS["users"]), read_records(stream, "jsonl"),
+                                     _source_key("users", path), batch_size=2)
+            assert next(batches) == 2
+            batches.close()
+        assert checkpoint(_source_key("users", path)) == 2
+
+    output = _import(app, "users", path, "--batch-size", "2")
+    assert "resuming after record 2" in output
+    assert "done: 3 users imported, 0 skipped" in output
+    with app.app_context():
+        assert _usernames() == ["alice", "bobby", "carol", "dave", "erin"]
+        assert checkpoint(_source_key("users", path)) == 5
+
+
+def test_a_changed_file_is_read_from_the_start(app, tmp_path):
+    path = _write(tmp_path / "users.jsonl", _users(["alice", "bobby"]))
+    _import(app, "users", path)
+
+    # same content, newer mtime: every record is read again (and is there)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    output = _import(app, "users", path)
+    assert "resuming" not in output
+    assert "done: 0 users imported, 2 skipped" in output
+
+    # another size
+    _write(path, _users(["alice", "bobby", "carol"]))
+    output = _import(app, "users", path)
+    assert "resuming" not in output
+    assert "done: 1 users imported, 2 skipped" in output
+
+    # --restart starts over on an unchanged file too
+    output = _import(app, "users", path, "--restart")
+    assert "done: 0 users imported, 3 skipped" in output
+    with app.app_context():
+        assert _usernames() == ["alice", "bobby", "carol"]
+
+
+def test_bad_records_are_skipped_and_counted(app, tmp_path):
+    path = _write(tmp_path / "users.jsonl", [
+        _users(["alice"])[0],
+        "{not json",
+        "[1, 2]",
+        {"username": "bobby"},
+        {**_users(["carol"])[0], "created_at": "yesterday"},
+        _users(["dave"])[0],
+    ])
+    output = _import(app, "users", path, "--batch-size", "4")
+    assert "done: 2 users imported, 4 skipped" in output
+    assert "skipped record 2: not a json object" in output
+    assert "skipped record 3: not a json object" in output
+    assert "skipped record 4: missing email" in output
+    assert "skipped record 5: bad created_at 'yesterday'" in output
+    with app.app_context():
+        assert _usernames() == ["alice", "dave"]
+
+
+def test_duplicate_follows_and_self_follows_are_ignored(app, tmp_path):
+    _import(app, "users", _write(tmp_path / "users.jsonl", _users(["alice", "bobby", "carol"])))
+    path = _write(tmp_path / "follows.jsonl", [
+        {"follower": "alice", "followed": "bobby"},
+        {"follower": "alice", "followed": "bobby"},
+        {"follower": "carol", "followed": "carol"},
+        {"follower": "bobby", "followed": "nobody"},
+        {"follower": "bobby", "followed": "alice"},
+    ])
+    output = _import(app, "follows", path)
+    assert "done: 2 follows imported, 3 skipped" in output
+    assert "skipped record 2: alice follows bobby twice in the source" in output
+    assert "skipped record 3: carol can't follow themselves" in output
+    assert "skipped record 4: no user nobody" in output
+
+    # the same edges again, from another file: all there already
+    again = _write(tmp_path / "again.jsonl", [{"follower": "alice", "followed": "bobby"}])
+    output = _import(app, "follows", again)
+    assert "done: 0 follows imported, 1 skipped" in output
+    assert "skipped record 1: alice already follows bobby" in output
+
+    with app.app_context():
+        assert db.session.execute(select(follows).order_by(follows.c.follower_id)).all() == [(1, 2), (2, 1)]
+        counts = db.session.execute(
+            select(User.username, User.follower_count, User.following_count).order_by(User.id)
+        ).all()
+        assert counts == [("alice", 1, 1), ("bobby", 1, 1), ("carol", 0, 0)]
@@ -0,0 +1,32 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+
+from instrumentation import count_queries, query_budget
+
+
+def test_start_times_do_not_pile_up_on_the_connection():
+    engine = create_engine("sqlite://")
+    with engine.connect() as connection:
+        # nothing collecting
+        for _ in range(100):
+            connection.exec_driver_sql("SELECT 1")
+        # a statement that fails
+        with pytest.raises(OperationalError):
+            connection.exec_driver_sql("SELECT no_such_column")
+        with count_queries() as queries:
+            connection.exec_driver_sql("SELECT 1")
+        assert queries.count == 1
+        assert connection.info.get("query_start", []) == []
+
+
+def test_query_budget():
+    engine = create_engine("sqlite://")
+    with engine.connect() as connection:
+        with query_budget(2):
+            connection.exec_driver_sql("SELECT 1")
+            connection.exec_driver_sql("SELECT 2")
+        with pytest.raises(AssertionError, match="at most 1 queries, ran 2"):
+            with query_budget(1):
+                connection.exec_driver_sql("SELECT 1")
+                connection.exec_driver_sql("SELECT 2")
@@ -0,0 +1,118 @@
+import time
+
+import pytest
+from sqlalchemy import insert, select, update
+
+from extensions import db
+from jobs import JobQueue
+from models import Job, TimelineEntry
+from tests.conftest import sign_up
+
+
+# a queue of its own per test, so the handlers registered here don't run for
+# the app's events. it shares the jobs table (and JOBS_* config) with the
+# app's queue.
+
+
+def _jobs():
+    return db.session.execute(
+        select(Job.event, Job.handler, Job.status, Job.attempts).order_by(Job.id)
+    ).all()
+
+
+def test_enqueue_adds_a_job_per_handler_once_per_key(app):
+    queue = JobQueue()
+    ran = []
+
+    @queue.handler("post_created")
+    def first(post_id):
+        ran.append(("first", post_id))
+
+    @queue.handler("post_created")
+    def second(post_id):
+        ran.append(("second", post_id))
+
+    with app.app_context():
+        queue.enqueue("post_created", {"post_id": 7}, key=7)
+        queue.enqueue("post_created", {"post_id": 7}, key=7)
+        # nothing is registered for it, nothing is queued
+        queue.enqueue("user_followed", {"follower_id": 1, "followed_id": 2})
+        db.session.commit()
+        assert [(event, status) for event, _, status, _ in _jobs()] == [
+            ("post_created", "pending"), ("post_created", "pending")]
+
+        assert queue.run_pending() == 2
+        assert sorted(ran) == [("first", 7), ("second", 7)]
+        # a job that ran keeps its key: enqueueing it again is still a no-op
+        queue.enqueue("post_created", {"post_id": 7}, key=7)
+        db.session.commit()
+        assert queue.run_pending() == 0
+        assert [status for _, _, status, _ in _jobs()] == ["done", "done"]
+
+        with pytest.raises(ValueError):
+            queue.enqueue("post_liked", {"post_id": 7})
+
+
+def test_a_failing_job_is_retried_with_a_growing_delay_until_it_runs_out(app):
+    queue = JobQueue()
+    calls = []
+
+    @queue.handler("post_edited")
+    def flaky(post_id):
+        calls.append(post_id)
+        raise RuntimeError("the index is down")
+
+    with app.app_context():
+        retry_delay = app.config["JOBS_RETRY_DELAY"]
+        max_attempts = app.config["JOBS_MAX_ATTEMPTS"]
+        queue.enqueue("post_edited", {"post_id": 7})
+        db.session.commit()
+
+        for attempt in range(1, max_attempts + 1):
+            job = queue.claim()
+            assert job.attempts == attempt
+            failed_at = time.time()
+            assert not queue.run_job(job)
+
+            row = db.session.get(Job, job.id)
+            assert "the index is down" in row.last_error
+            assert row.locked_at is None
+            if attempt < max_attempts:
+                assert row.status == "pending"
+                assert row.run_at - failed_at == pytest.approx(retry_delay * 2 ** (attempt - 1), abs=1)
+                # not due until then
+                assert queue.claim() is None
+                db.session.execute(update(Job).where(Job.id == job.id).values(run_at=0))
+                db.session.commit()
+
+        assert row.status == "failed"
+        assert calls == [7] * max_attempts
+        assert queue.claim() is None
+
+
+def test_requeue_stale_only_takes_back_jobs_past_the_lock_timeout(app):
+    queue = JobQueue()
+    with app.app_context():
+        now = time.time()
+        timeout = app.config["JOBS_LOCK_TIMEOUT"]
+        rows = [{"event": "post_created", "handler": name, "payload": "{}", "status": "running",
+                 "attempts": 1, "max_attempts": 5, "run_at": now, "created_at": now, "locked_at": locked_at}
+                for name, locked_at in (("stale", now - timeout - 1), ("busy", now - 1))]
+        db.session.execute(insert(Job), rows)
+        db.session.commit()
+
+        queue.requeue_stale()
+        statuses = dict(db.session.execute(select(Job.handler, Job.status)).all())
+        assert statuses == {"stale": "pending", "busy": "running"}
+
+
+def test_inline_jobs_have_run_when_the_request_returns(app):
+    alice, bobby = sign_up(app, "alice"), sign_up(app, "bobby")
+    bobby.get("/follow/alice")
+    response = alice.post("/create_post", data={"title": "hello", "body": "words", "tags": "flask"})
+    assert response.status_code == 302
+
+    with app.app_context():
+        assert {status for _, _, status, _ in _jobs()} == {"done"}
+        # the fan-out job wrote bobby's timeline
+        assert db.session.execute(select(TimelineEntry.post_id)).scalars().all() == [1]
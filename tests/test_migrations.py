@@ -0,0 +1,91 @@
+import sqlite3
+
+from sqlalchemy import create_engine
+
+from extensions import db
+from migrations import MIGRATIONS, applied_versions, upgrade
+
+
+# the schema the app shipped with, before there were migrations
+ORIGINAL_SCHEMA = """
+CREATE TABLE users (
+    id INTEGER NOT NULL, username VARCHAR(50) NOT NULL, email VARCHAR(100) NOT NULL,
+    password VARCHAR(255) NOT NULL, profile_picture VARCHAR(255), about_me TEXT,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    PRIMARY KEY (id), UNIQUE (username), UNIQUE (email)
+);
+CREATE TABLE tags (
+    id INTEGER NOT NULL, name VARCHAR(50) NOT NULL, PRIMARY KEY (id), UNIQUE (name)
+);
+CREATE TABLE follows (
+    follower_id INTEGER NOT NULL, followed_id INTEGER NOT NULL,
+    PRIMARY KEY (follower_id, followed_id),
+    FOREIGN KEY(follower_id) REFERENCES users (id), FOREIGN KEY(followed_id) REFERENCES users (id)
+);
+CREATE TABLE posts (
+    id INTEGER NOT NULL, title VARCHAR(255) NOT NULL, body TEXT NOT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL, is_published BOOLEAN,
+    slug VARCHAR(255), user_id INTEGER NOT NULL,
+    PRIMARY KEY (id), UNIQUE (title), FOREIGN KEY(user_id) REFERENCES users (id)
+);
+CREATE TABLE post_tags (
+    post_id INTEGER NOT NULL, tag_id INTEGER NOT NULL, PRIMARY KEY (post_id, tag_id),
+    FOREIGN KEY(post_id) REFERENCES posts (id), FOREIGN KEY(tag_id) REFERENCES tags (id)
+);
+CREATE TABLE comments (
+    id INTEGER NOT NULL, body TEXT NOT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    user_id INTEGER NOT NULL, post_id INTEGER NOT NULL, PRIMARY KEY (id),
+    FOREIGN KEY(user_id) REFERENCES users (id), FOREIGN KEY(post_id) REFERENCES posts (id)
+);
+INSERT INTO users (id, username, email, password) VALUES (1, 'alice', 'a@x', 'p'), (2, 'bobby', 'b@x', 'p');
+INSERT INTO posts (id, title, body, user_id, created_at) VALUES (1, 'one', 'b', 1, '2025-01-01 10:00:00');
+INSERT INTO tags (id, name) VALUES (1, 'flask');
+INSERT INTO post_tags (post_id, tag_id) VALUES (1, 1);
+INSERT INTO follows (follower_id, followed_id) VALUES (2, 1);
+INSERT INTO comments (id, body, user_id, post_id) VALUES (1, 'kept', 2, 1), (2, 'orphan', 2, 99);
+"""
+
+
+def _schema(path):
+    # {table: (columns, indexes, on delete actions)}
+    with sqlite3.connect(path) as connection:
+        tables = connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'search_index_%'"
+        ).fetchall()
+        return {
+            name: (
+                {row[1] for row in connection.execute(f"PRAGMA table_info({name})")},
+                {row[1] for row in connection.execute(f"PRAGMA index_list({name})")
+                 if not row[1].startswith("sqlite_autoindex")},
+                {row[6] for row in connection.execute(f"PRAGMA foreign_key_list({name})")},
+            )
+            for name, in tables
+        }
+
+
+def test_upgrading_the_original_schema_gives_the_current_one(tmp_path):
+    old = tmp_path / "old.db"
+    with sqlite3.connect(old) as connection:
+        connection.executescript(ORIGINAL_SCHEMA)
+    engine = create_engine(f"sqlite:///{old}")
+    ran = upgrade(engine)
+    assert [version for version, _ in ran] == [version for version, _, _ in MIGRATIONS]
+    assert upgrade(engine) == []
+    engine.dispose()
+
+    # an empty database gets the models as they are
+    new = tmp_path / "new.db"
+    engine = create_engine(f"sqlite:///{new}")
+    assert upgrade(engine) == []
+    assert applied_versions(engine) == {version for version, _, _ in MIGRATIONS}
+    engine.dispose()
+    assert set(db.metadata.tables) <= set(_schema(new))
+    assert _schema(old) == _schema(new)
+
+    with sqlite3.connect(old) as connection:
+        # the comment whose post was long gone went with the cascade
+        assert connection.execute("SELECT body FROM comments").fetchall() == [("kept",)]
+        assert connection.execute("SELECT follower_count FROM users WHERE id = 1").fetchone() == (1,)
+        assert connection.execute("SELECT post_count FROM tags").fetchone() == (1,)
+        assert connection.execute("SELECT created_at FROM post_tags").fetchone() == ("2025-01-01 10:00:00",)
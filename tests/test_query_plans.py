@@ -0,0 +1,44 @@
+import pytest
+
+from app import create_app
+from config import TestingConfig
+from extensions import db
+from migrations import upgrade
+from query_plans import _drive_routes, explain, full_scans
+
+
+@pytest.fixture
+def app():
+    # small pages, so the "next page" links (and their queries) show up
+    app = create_app(TestingConfig)
+    app.config.update(POSTS_PER_PAGE=2, PROFILE_LIST_PER_PAGE=2, COMMENTS_PER_PAGE=2)
+    with app.app_context():
+        upgrade()
+    yield app
+    with app.app_context():
+        db.engine.dispose()
+
+
+def test_no_statement_behind_a_route_scans_a_whole_table(app):
+    statements = _drive_routes(app)
+    assert statements
+    with app.app_context():
+        tables = set(db.metadata.tables) | {"search_index"}
+        with db.engine.connect() as connection:
+            failures = {}
+            for statement in statements:
+                if statement.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")):
+                    scans = full_scans(explain(connection, statement), tables)
+                    if scans:
+                        failures[" ".join(statement.split())] = scans
+    assert failures == {}
+
+
+def test_full_scans_tells_a_scan_from_an_index_walk():
+    assert full_scans(["SCAN posts"], {"posts"}) == ["SCAN posts"]
+    assert full_scans(["SCAN users AS users_1"], {"users"}) == ["SCAN users AS users_1"]
+    assert full_scans(["SCAN users_2"], {"users"}) == ["SCAN users_2"]
+    assert full_scans(["SCAN posts USING INDEX ix_posts_created_at_id"], {"posts"}) == []
+    assert full_scans(["SEARCH posts USING INTEGER PRIMARY KEY (rowid=?)"], {"posts"}) == []
+    # a subquery or a temp b-tree isn't a table
+    assert full_scans(["SCAN anon_1"], {"posts"}) == []
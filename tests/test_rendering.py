@@ -0,0 +1,47 @@
+import pytest
+
+from rendering import render_body, sanitize
+
+
+@pytest.mark.parametrize("dirty", [
+    '<a href="javascript:alert(1)">x</a>',
+    '<a href="java&#9;script:alert(1)">x</a>',
+    '<a href="jav&#x0A;ascript:alert(1)">x</a>',
+    '<a href="java&#13;script:alert(1)">x</a>',
+    '<a href="&#1;javascript:alert(1)">x</a>',
+    '<a href=" JavaScript:alert(1)">x</a>',
+    '<a href="data:text/html,<script>alert(1)</script>">x</a>',
+    '<a href="vbscript:msgbox(1)">x</a>',
+    '<a href="evil.html">x</a>',
+])
+def test_unsafe_links_lose_their_href(dirty):
+    clean, _ = sanitize(dirty)
+    assert clean == "<a>x</a>"
+
+
+@pytest.mark.parametrize("body", [
+    "[x](java&#9;script:alert(1))",
+    "[x](jav&#x0A;ascript:alert(1))",
+    "[x](javascript:alert(1))",
+])
+def test_unsafe_markdown_links_lose_their_href(body):
+    assert "href" not in render_body(body)["body_html"]
+
+
+@pytest.mark.parametrize("href", [
+    "https://example.com/a?b=c",
+    "http://example.com",
+    "mailto:someone@example.com",
+    "/post/1",
+    "#comments",
+    "?after=abc",
+])
+def test_safe_links_keep_their_href(href):
+    clean, _ = sanitize(f'<a href="{href}">x</a>')
+    assert clean == f'<a href="{href.replace("&", "&amp;")}">x</a>'
+
+
+def test_disallowed_tags_and_attributes_are_dropped():
+    clean, text = sanitize('<p onclick="x()">hi<script>alert(1)</script><img src=x></p>')
+    assert clean == "<p>hi</p>"
+    assert text == "hi"
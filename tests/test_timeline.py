@@ -0,0 +1,155 @@
+import datetime
+
+from sqlalchemy import delete, func, insert, select
+
+from extensions import db
+from models import Post, TimelineEntry, User
+from tests.conftest import sign_up
+from timeline import backfill_all, read_timeline
+
+
+def _user_id(name):
+    return db.session.execute(select(User.id).where(User.username == name)).scalar_one()
+
+
+def _timeline(name, per_page=20, **cursor):
+    return [post.title for post in read_timeline(_user_id(name), per_page, **cursor)]
+
+
+def _entries(name):
+    return db.session.execute(
+        select(func.count()).select_from(TimelineEntry).where(TimelineEntry.user_id == _user_id(name))
+    ).scalar_one()
+
+
+def _post(client, title):
+    client.post("/create_post", data={"title": title, "body": "words", "tags": "flask"})
+
+
+def test_a_followed_authors_posts_show_up(app):
+    alice, bobby = sign_up(app, "alice"), sign_up(app, "bobby")
+    sign_up(app, "carol")
+    bobby.get("/follow/alice")
+    _post(alice, "first")
+    _post(alice, "second")
+    with app.app_context():
+        assert _timeline("bobby") == ["second", "first"]
+        assert _entries("bobby") == 2
+        # nobody else's
+        assert _timeline("carol") == []
+    assert "second" in bobby.get("/timeline").get_data(as_text=True)
+
+
+def test_a_follow_brings_in_the_authors_recent_posts(app):
+    app.config["TIMELINE_BACKFILL_POSTS"] = 2
+    alice, bobby = sign_up(app, "alice"), sign_up(app, "bobby")
+    for number in range(3):
+        _post(alice, f"post {number}")
+    bobby.get("/follow/alice")
+    with app.app_context():
+        assert _timeline("bobby") == ["post 2", "post 1"]
+
+
+def test_a_popular_authors_posts_are_merged_in_at_read_time(app):
+    app.config["TIMELINE_FANOUT_THRESHOLD"] = 1
+    alice, bobby, carol = sign_up(app, "alice"), sign_up(app, "bobby"), sign_up(app, "carol")
+    dave = sign_up(app, "dave")
+    # alice has two followers, over the threshold. dave has one.
+    bobby.get("/follow/alice")
+    carol.get("/follow/alice")
+    bobby.get("/follow/dave")
+    _post(alice, "popular 1")
+    _post(dave, "normal")
+    _post(alice, "popular 2")
+    with app.app_context():
+        # only dave's post was copied, alice's are read from posts
+        assert _entries("bobby") == 1
+        assert _entries("carol") == 0
+        assert _timeline("bobby") == ["popular 2", "normal", "popular 1"]
+        assert _timeline("carol") == ["popular 2", "popular 1"]
+
+
+def test_a_post_in_both_parts_is_listed_once(app):
+    # alice's posts were copied before she crossed the threshold
+    alice, bobby, carol = sign_up(app, "alice"), sign_up(app, "bobby"), sign_up(app, "carol")
+    bobby.get("/follow/alice")
+    carol.get("/follow/alice")
+    _post(alice, "before")
+    app.config["TIMELINE_FANOUT_THRESHOLD"] = 1
+    _post(alice, "after")
+    with app.app_context():
+        assert _entries("bobby") == 1
+        assert _timeline("bobby") == ["after", "before"]
+
+
+def test_unfollowing_removes_the_authors_entries(app):
+    alice, bobby, carol = sign_up(app, "alice"), sign_up(app, "bobby"), sign_up(app, "carol")
+    bobby.get("/follow/alice")
+    bobby.get("/follow/carol")
+    _post(alice, "alice's")
+    _post(carol, "carol's")
+    bobby.get("/unfollow/alice")
+    with app.app_context():
+        assert _timeline("bobby") == ["carol's"]
+        assert _entries("bobby") == 1
+
+
+def test_pages_follow_the_cursor_without_repeating_a_post(app):
+    app.config["TIMELINE_FANOUT_THRESHOLD"] = 1
+    alice, bobby, carol = sign_up(app, "alice"), sign_up(app, "bobby"), sign_up(app, "carol")
+    bobby.get("/follow/alice")
+    bobby.get("/follow/carol")
+    carol.get("/follow/alice")
+    with app.app_context():
+        # in bulk, with ties on created_at: alice is read at read time,
+        # carol from the entries
+        authors = {"alice": _user_id("alice"), "carol": _user_id("carol")}
+        db.session.execute(insert(Post), [
+            {"title": f"{name} {number}", "body": "words", "user_id": user_id,
+             "created_at": datetime.datetime(2025, 1, 1, 10, 0, number // 3)}
+            for number in range(20) for name, user_id in authors.items()
+        ])
+        db.session.commit()
+    with app.app_context():
+        backfill = list(backfill_all())
+        assert backfill
+
+        newest_first = _timeline("bobby", per_page=100)
+        assert len(newest_first) == 40
+
+        seen = []
+        page = read_timeline(_user_id("bobby"), 7)
+        while True:
+            seen += [post.title for post in page]
+            if not page.has_next:
+                break
+            page = read_timeline(_user_id("bobby"), 7, after=page.next_cursor)
+        assert seen == newest_first
+
+        # and back again from the last page
+        back = [post.title for post in page]
+        while page.has_prev:
+            page = read_timeline(_user_id("bobby"), 7, before=page.prev_cursor)
+            back = [post.title for post in page] + back
+        assert back == newest_first
+
+
+def test_backfill_all_fills_timelines_from_existing_follows(app):
+    app.config["TIMELINE_BACKFILL_POSTS"] = 3
+    alice, bobby, carol = sign_up(app, "alice"), sign_up(app, "bobby"), sign_up(app, "carol")
+    bobby.get("/follow/alice")
+    carol.get("/follow/alice")
+    bobby.get("/follow/carol")
+    for number in range(5):
+        _post(alice, f"alice {number}")
+    _post(carol, "carol 0")
+    with app.app_context():
+        db.session.execute(delete(TimelineEntry))
+        db.session.commit()
+        assert list(backfill_all(batch_size=2)) == [2, 3]
+        assert _timeline("bobby") == ["carol 0", "alice 4", "alice 3", "alice 2"]
+        assert _timeline("carol") == ["alice 4", "alice 3", "alice 2"]
+        assert _timeline("alice") == []
+        # running it again adds nothing
+        list(backfill_all())
+        assert _entries("bobby") == 4
@@ -0,0 +1,231 @@
+from functools import lru_cache
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import bindparam, delete, func, insert, select, tuple_, union
+from sqlalchemy.orm import selectinload
+
+from extensions import db
+from jobs import job_queue
+from models import Post, TimelineEntry, User, follows, post_summary_options
+from pagination import cursor_keys, keyset_query, page_from_rows
+
+
+# personal "following" feed.
+#
+# normal authors: when they post we copy one row per follower into
+# timeline_entries (fan-out-on-write). reading a feed is then one index
+# range scan, no matter how many accounts the reader follows.
+#
+# popular authors (more followers than TIMELINE_FANOUT_THRESHOLD): copying a
+# post to every follower would make posting very slow, so their posts are
+# pulled in at read time instead (fan-out-on-read) and merged in.
+#
+# both copies (on a new post, and the backfill after a follow) run as
+# background jobs, posting or following doesn't wait for them.
+
+timeline_cli = AppGroup("timeline", help="Maintain the materialized following timelines.")
+
+ENTRY_COLUMNS = ["user_id", "post_id", "author_id", "created_at"]
+
+
+def fanout_threshold():
+    return current_app.config["TIMELINE_FANOUT_THRESHOLD"]
+
+
+def is_fanned_out_on_read(author_id):
+    follower_count = db.session.execute(
+        select(User.follower_count).where(User.id == author_id)
+    ).scalar()
+    return follower_count > fanout_threshold()
+
+
+def read_time_authors(user_id):
+    # the accounts this user follows whose posts are merged in at read time
+    return (
+        select(follows.c.followed_id)
+        .join(User, User.id == follows.c.followed_id)
+        .where(follows.c.follower_id == user_id,
+               User.follower_count > bindparam("threshold", type_=db.Integer))
+    )
+
+
+def _insert_entries(rows_select):
+    stmt = insert(TimelineEntry.__table__).prefix_with("OR IGNORE")
+    db.session.execute(stmt.from_select(ENTRY_COLUMNS, rows_select))
+
+
+def fan_out_post(post):
+    # copy a freshly written post into its author's followers' timelines.
+    # created_at is copied in sql so it keeps the exact stored format.
+    if is_fanned_out_on_read(post.user_id):
+        return
+    _insert_entries(
+        select(follows.c.follower_id, Post.id, Post.user_id, Post.created_at)
+        .where(Post.id == post.id, follows.c.followed_id == Post.user_id)
+    )
+
+
+def fan_out_posts(post_ids):
+    # fan_out_post() for a batch of new posts in one statement (bulk imports)
+    popular = select(User.id).where(User.follower_count > fanout_threshold())
+    _insert_entries(
+        select(follows.c.follower_id, Post.id, Post.user_id, Post.created_at)
+        .join(follows, follows.c.followed_id == Post.user_id)
+        .where(Post.id.in_(post_ids), Post.user_id.not_in(popular))
+    )
+
+
+def _recent_posts(author_ids):
+    # each author's TIMELINE_BACKFILL_POSTS newest posts, the ones
+    # add_author() copies after a follow
+    rank = func.row_number().over(
+        partition_by=Post.user_id, order_by=(Post.created_at.desc(), Post.id.desc())
+    ).label("rank")
+    ranked = select(Post.id, Post.user_id, Post.created_at, rank) \
+        .where(Post.user_id.in_(author_ids)).subquery()
+    return select(ranked.c.id, ranked.c.user_id, ranked.c.created_at) \
+        .where(ranked.c.rank <= current_app.config["TIMELINE_BACKFILL_POSTS"]).subquery()
+
+
+def _backfill_edges(edge_filter, author_ids):
+    # add_author() for every follow edge matching edge_filter, in one
+    # statement. author_ids (the edges' followed ids, a list or a select)
+    # limits which authors' posts are ranked.
+    popular = select(User.id).where(User.follower_count > fanout_threshold())
+    recent = _recent_posts(author_ids)
+    _insert_entries(
+        select(follows.c.follower_id, recent.c.id, recent.c.user_id, recent.c.created_at)
+        .join(recent, recent.c.user_id == follows.c.followed_id)
+        .where(edge_filter, follows.c.followed_id.not_in(popular))
+    )
+
+
+def backfill_follows(edges):
+    # timelines for a batch of new (follower_id, followed_id) edges, like
+    # backfill_all() does for every edge
+    _backfill_edges(tuple_(follows.c.follower_id, follows.c.followed_id).in_(edges),
+                    list({followed_id for _, followed_id in edges}))
+
+
+def add_author(user_id, author_id):
+    # after a follow, seed the timeline with the author's most recent posts
+    if is_fanned_out_on_read(author_id):
+        return
+    recent = (
+        select(db.literal(user_id), Post.id, Post.user_id, Post.created_at)
+        .where(Post.user_id == author_id)
+        .order_by(Post.created_at.desc(), Post.id.desc())
+        .limit(current_app.config["TIMELINE_BACKFILL_POSTS"])
+    )
+    _insert_entries(recent)
+
+
+@job_queue.handler("post_created")
+def fan_out_created_post(post_id):
+    post = db.session.get(Post, post_id)
+    # deleted before the job ran
+    if post is not None:
+        fan_out_post(post)
+
+
+@job_queue.handler("user_followed")
+def backfill_followed_author(follower_id, followed_id):
+    # an unfollow may have come in before the job ran
+    still_following = db.session.execute(
+        select(follows.c.follower_id).where(follows.c.follower_id == follower_id,
+                                            follows.c.followed_id == followed_id)
+    ).first()
+    if still_following:
+        add_author(follower_id, followed_id)
+
+
+def remove_author(user_id, author_id):
+    # after an unfollow, trim that author's posts out of the timeline
+    db.session.execute(
+        delete(TimelineEntry).where(
+            TimelineEntry.user_id == user_id, TimelineEntry.author_id == author_id
+        )
+    )
+
+
+# a page of a timeline is one statement. it is built once per direction
+# (first page, after a cursor, before a cursor) and run with bound values,
+# putting it together takes longer than running it.
+PAGE_KEY = (bindparam("sort_key", type_=db.String), bindparam("row_id", type_=db.Integer))
+
+
+@lru_cache(maxsize=None)
+def _page_statement(direction):
+    after_key = PAGE_KEY if direction == "after" else None
+    before_key = PAGE_KEY if direction == "before" else None
+    user_id = bindparam("user_id", type_=db.Integer)
+    limit = bindparam("limit", type_=db.Integer)
+
+    # the materialized part (one range scan on ix_timeline_user_created) and
+    # the fan-out-on-read part (the same window from each popular author)
+    entries = keyset_query(
+        select(TimelineEntry.post_id.label("id")).where(TimelineEntry.user_id == user_id),
+        TimelineEntry.created_at, TimelineEntry.post_id, limit, after_key, before_key,
+    ).subquery()
+    popular = keyset_query(
+        select(Post.id.label("id")).where(Post.user_id.in_(read_time_authors(user_id))),
+        Post.created_at, Post.id, limit, after_key, before_key,
+    ).subquery()
+    # an author who crossed the threshold can be in both, the union keeps
+    # one copy (created_at is copied into the entries as stored)
+    window = union(select(entries.c.id, entries.c.sort_key),
+                   select(popular.c.id, popular.c.sort_key)).subquery()
+
+    # the page of posts out of the two, with their owners and tags
+    posts = select(Post).options(*post_summary_options(), selectinload(Post.owner),
+                                 selectinload(Post.tags)) \
+        .join(window, window.c.id == Post.id)
+    return keyset_query(posts, window.c.sort_key, window.c.id, limit, after_key, before_key)
+
+
+def read_timeline(user_id, per_page, after=None, before=None):
+    after_key, before_key = cursor_keys(after, before)
+    params = {"user_id": user_id, "threshold": fanout_threshold(), "limit": per_page + 1}
+    if after_key is not None:
+        statement = _page_statement("after")
+        params["sort_key"], params["row_id"] = after_key
+    elif before_key is not None:
+        statement = _page_statement("before")
+        params["sort_key"], params["row_id"] = before_key
+    else:
+        statement = _page_statement(None)
+    rows = [tuple(row) for row in db.session.execute(statement, params)]
+    return page_from_rows(rows, per_page, after_key, before_key)
+
+
+def backfill_all(batch_size=500):
+    # fill timelines from the follow edges that already exist, in batches of
+    # followers. yields the running total after each batch.
+    last_id = 0
+    total = 0
+    while True:
+        follower_ids = db.session.execute(
+            select(User.id).where(User.id > last_id).order_by(User.id).limit(batch_size)
+        ).scalars().all()
+        if not follower_ids:
+            break
+        _backfill_edges(
+            follows.c.follower_id.in_(follower_ids),
+            select(follows.c.followed_id).where(follows.c.follower_id.in_(follower_ids)),
+        )
+        db.session.commit()
+        total += len(follower_ids)
+        last_id = follower_ids[-1]
+        yield total
+
+
+@timeline_cli.command("backfill")
+@click.option("--batch-size", default=500, show_default=True,
+              help="How many followers to backfill per transaction.")
+def backfill_command(batch_size):
+    """Build timelines for follow edges that already exist."""
+    for total in backfill_all(batch_size):
+        click.echo(f"backfilled timelines for {total} users")
+    click.echo("done.")
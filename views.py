@@ -0,0 +1,437 @@
+import datetime
+
+from flask import Blueprint, current_app, render_template, url_for, redirect, flash, request, abort
+from forms import RegisterForm, LoginForm, PostForm, CommentForm
+from extensions import db, cache
+from models import User, Post, Tag, Comment, follows, post_tags, post_summary_options
+from pagination import keyset_paginate
+from database import use_primary
+from jobs import job_queue
+import timeline
+import counters
+from tags import hour_bucket, parse_tag_names, record_tag_changes, set_post_tags, trending_tags
+import search
+from accounts import delete_accounts
+from rendering import render_post
+from templating import format_datetime
+from sqlalchemy import delete, insert
+from sqlalchemy.orm import joinedload, selectinload
+from flask_login import login_user, logout_user, current_user, login_required
+
+
+# all the pages of the blog, registered on the app by create_app()
+bp = Blueprint("main", __name__)
+
+
+# everything a change to `post` (written by `username`) can show up on
+def post_cache_dependencies(post, username, tag_names):
+    return (["posts", "tags", f"post:{post.id}", f"user:{username}"]
+            + [f"tag:{name}" for name in tag_names])
+
+
+# the trending tags widget (trending_tags.html), rendered inside a fragment
+# cached per hour
+@bp.app_template_global("trending_tags")
+def trending_tags_global():
+    return trending_tags(current_app.config["TRENDING_TAGS_LIMIT"],
+                         current_app.config["TRENDING_TAGS_HOURS"])
+
+
+@bp.app_template_global()
+def current_hour():
+    return hour_bucket(datetime.datetime.utcnow())
+
+
+@bp.route("/")
+@cache.cached_page(lambda: ["posts"])
+def home():
+    # one page at a time, with owner and tags loaded in batches
+    # (two extra queries per page instead of two per post), and without the
+    # post bodies
+    query = Post.query.options(*post_summary_options(), selectinload(Post.owner),
+                               selectinload(Post.tags))
+    page = keyset_paginate(
+        query, Post.created_at, Post.id,
+        per_page=current_app.config["POSTS_PER_PAGE"],
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+    )
+    return render_template("home.html", title="New Post", posts=page.items, page=page)
+
+
+# posts from the people the current user follows
+@bp.route("/timeline")
+@login_required
+def following_timeline():
+    page = timeline.read_timeline(
+        current_user.id,
+        per_page=current_app.config["POSTS_PER_PAGE"],
+        after=request.args.get("after"),
+        before=request.args.get("before"),
+    )
+    return render_template("home.html", title="Timeline", heading="Your Timeline",
+                           posts=page.items, page=page)
+
+
+@bp.route("/register", methods=["GET", "POST"])
+def register():
+    # if already logged in
+    if current_user.is_authenticated:
+        return redirect(url_for("main.home"))
+    
+    form = RegisterForm()
+    # it checks for [post request, validators, csrf tokens]
+    if form.validate_on_submit():
+        flash(f"{form.username.data}, Successfully registered.")
+        flash(f"Now Log In, To enjoy reading other posts")
+
+        # collecting data from flaskform
+        username = form.username.data
+        email = form.email.data
+        password = form.password.data
+
+        # create a user object and store it in db.
+        new_user = User(username=username, email=email)
+        new_user.set_password(password)
+
+        # add and commit it.
+        db.session.add(new_user)
+        db.session.commit()
+
+        return redirect(url_for("main.login"))
+
+    return render_template("register.html", title="Register", form=form)
+
+
+
+@bp.route("/login", methods=["GET", "POST"])
+def login():
+    # if already logged in
+    if current_user.is_authenticated:
+        return redirect(url_for("main.home"))
+    
+
+    form = LoginForm()
+    # it checks for [post request, validators, csrf tokens]
+    if form.validate_on_submit():
+        #collecting data from flaskform
+        email = form.email.data
+        password = form.password.data
+        remember_me = form.remember_me.data
+
+        # check is user exist.
+        existing_user = User.query.filter_by(email=email).first()
+
+        if existing_user and existing_user.check_password(password):
+            # a hash made under an older hashing policy was just redone
+            db.session.commit()
+            login_user(existing_user, remember=remember_me)
+            flash(f"Successfully Logged In as {existing_user.username}.", "success")
+            next_page = request.args.get("next")
+            if next_page:
+                return redirect(next_page)
+            else:
+                return redirect(url_for("main.home"))
+        else:
+            flash("Invalid email or password. Please try again.", "danger")
+        
+    return render_template("login.html", title="Log In", form=form)
+
+
+@bp.route("/logout")
+@login_required
+def logout():
+    logout_user()
+    return redirect(url_for("main.home"))
+
+
+@bp.route("/create_post", methods=["GET", "POST"])
+@login_required
+def create_post():
+    form = PostForm()
+
+    if form.validate_on_submit():
+        title = form.title.data
+        
+        # --- IMPROVEMENT 1: Better Error Handling ---
+        existing_title = Post.query.filter_by(title=title).first()
+        if existing_title:
+            flash("A post with this title already exists. Please choose a different title.", "danger")
+            # Re-render the form so the user doesn't lose their work
+            return render_template("post.html", title="Create Post", form=form)
+        # ----------------------------------------------
+
+        # If the title is unique, proceed with creating the post
+        # created_at is set here rather than left to the column default, the
+        # tag_usage bucket is taken from it before the post is flushed.
+        # whole seconds, like CURRENT_TIMESTAMP
+        new_post = Post(
+            title=title,
+            body=form.body.data,
+            user_id=current_user.id,
+            created_at=datetime.datetime.utcnow().replace(microsecond=0),
+        )
+        # markdown -> sanitized html, excerpt and reading time, once
+        render_post(new_post)
+
+        # all the tags are looked up (and the new ones created) in two queries
+        set_post_tags(new_post, parse_tag_names(form.tags.data))
+
+        db.session.add(new_post)
+        db.session.flush()
+        counters.adjust(current_user.id, post_count=1)
+
+        # timelines and the search index are filled in the background, the
+        # job commits with the post
+        job_queue.enqueue("post_created", {"post_id": new_post.id}, key=new_post.id)
+        db.session.commit()
+        cache.invalidate(*post_cache_dependencies(new_post, current_user.username,
+                                                  [tag.name for tag in new_post.tags]))
+
+        # --- IMPROVEMENT 2: Format the Timestamp ---
+        creation_time = format_datetime(new_post.created_at)
+        flash(f"Post '{new_post.title}' created successfully at {creation_time}", "success")
+        # -----------------------------------------
+
+        return redirect(url_for("main.home"))
+
+    return render_template("post.html", title="Create Post", form=form)
+
+# view post
+@bp.route("/post/<int:post_id>", methods=["GET", "POST"])
+@cache.cached_page(lambda post_id: [f"post:{post_id}"])
+def view_post(post_id):
+    post = Post.query.options(joinedload(Post.owner)).get_or_404(post_id)
+    form = CommentForm()
+
+    # form on submit
+    if form.validate_on_submit():
+        new_comment = Comment(body=form.body.data,
+                            user_id=current_user.id,
+                            post = post,
+
+
+        )
+        db.session.add(new_comment)
+        db.session.flush()
+        job_queue.enqueue("comment_added", {"comment_id": new_comment.id, "post_id": post.id},
+                          key=new_comment.id)
+        db.session.commit()
+        cache.invalidate(f"post:{post.id}")
+        flash("Your comment has been posted.", "success")
+        
+        # Redirect back to the same page to see the new comment
+        return redirect(url_for('main.view_post', post_id=post.id))
+
+    # one page of comments, oldest first, with the authors loaded in one query
+    comments = keyset_paginate(
+        Comment.query.options(selectinload(Comment.author)).filter(Comment.post_id == post.id),
+        Comment.created_at, Comment.id,
+        per_page=current_app.config["COMMENTS_PER_PAGE"],
+        after=request.args.get("comments_after"),
+        before=request.args.get("comments_before"),
+        descending=False,
+    )
+
+    return render_template("view_post.html", post=post, title=post.title, form=form,
+                           comments=comments)
+
+
+@bp.route("/search")
+def search_posts():
+    query = request.args.get("q", "").strip()
+    page = min(max(request.args.get("page", 1, type=int), 1), current_app.config["SEARCH_MAX_PAGE"])
+    results, has_more = search.search(query, current_app.config["SEARCH_RESULTS_PER_PAGE"], page)
+    return render_template("search.html", title="Search", query=query, results=results,
+                           page=page, has_more=has_more)
+
+
+# every tag, most used first
+@bp.route("/tags")
+@cache.cached_page(lambda: ["tags"])
+def tag_directory():
+    page = keyset_paginate(Tag.query.filter(Tag.post_count > 0), Tag.post_count, Tag.id,
+                           per_page=current_app.config["TAGS_PER_PAGE"],
+                           after=request.args.get("after"),
+                           before=request.args.get("before"))
+    return render_template("tags.html", title="Tags", tags=page.items, page=page)
+
+
+@bp.route('/tag/<string:tag_name>')
+@cache.cached_page(lambda tag_name: [f"tag:{tag_name}"])
+def posts_by_tag(tag_name):
+    # Find the tag object from the database, or return a 404 error
+    tag = Tag.query.filter_by(name=tag_name).first_or_404()
+
+    # newest first, like the home feed, one page at a time walking
+    # ix_post_tags_tag_created backwards, so a tag on a million posts costs
+    # the same as a tag on ten. only the summary columns, with owners and
+    # tags loaded in batches.
+    query = Post.query.options(*post_summary_options(), selectinload(Post.owner),
+                               selectinload(Post.tags)) \
+        .join(post_tags, post_tags.c.post_id == Post.id) \
+        .filter(post_tags.c.tag_id == tag.id)
+    page = keyset_paginate(query, post_tags.c.created_at, post_tags.c.post_id,
+                           per_page=current_app.config["POSTS_PER_PAGE"],
+                           after=request.args.get("after"),
+                           before=request.args.get("before"))
+
+    return render_template('home.html', posts=page.items, page=page, tag_name=tag_name,
+                           tag=tag)
+
+
+@bp.route("/post/<int:post_id>/edit", methods=["GET", "POST"])
+@login_required
+def edit_post(post_id):
+    post = Post.query.get_or_404(post_id)
+    
+    if post.user_id != current_user.id:
+        abort(403)
+        
+    form = PostForm()
+    
+    if form.validate_on_submit():
+        # Update the post's simple fields
+        post.title = form.title.data
+        post.body = form.body.data
+        render_post(post)
+        
+        # --- TAG UPDATE LOGIC ---
+        # only the tags that were added or removed touch post_tags
+        added, removed = set_post_tags(post, parse_tag_names(form.tags.data))
+        # --- END OF TAG UPDATE LOGIC ---
+
+        job_queue.enqueue("post_edited", {"post_id": post.id})
+        db.session.commit()
+        # pages for the removed tags need to drop the post too
+        tag_names = [tag.name for tag in post.tags] + [tag.name for tag in removed]
+        cache.invalidate(*post_cache_dependencies(post, current_user.username, tag_names))
+        flash("Your post has been updated!", "success")
+        return redirect(url_for('main.view_post', post_id=post.id))
+        
+    elif request.method == 'GET':
+        # Pre-populate the form with existing data
+        form.title.data = post.title
+        form.body.data = post.body
+        form.tags.data = ", ".join([tag.name for tag in post.tags])
+        
+    return render_template('post.html', title='Edit Post', form=form)
+
+     
+    
+
+# delete post
+@bp.route("/post/<int:post_id>/delete", methods = ["POST"])
+@login_required
+def delete_post(post_id):
+    # get the post from the db.
+    post = Post.query.get_or_404(post_id)
+
+    # if it is not the owner
+    if post.user_id != current_user.id:
+        abort(403)
+
+    dependencies = post_cache_dependencies(post, current_user.username,
+                                           [tag.name for tag in post.tags])
+    counters.adjust(post.user_id, post_count=-1)
+    record_tag_changes(post, removed=post.tags)
+    # comments, tags and timeline entries go with it (ON DELETE CASCADE)
+    db.session.delete(post)
+    db.session.commit()
+    cache.invalidate(*dependencies)
+    
+    flash("Your post has been deleted.", "success")
+    return redirect(url_for('main.home'))
+
+
+@bp.route('/follow/<string:username>')
+@login_required
+@use_primary
+def follow(username):
+    user_to_follow = User.query.filter_by(username=username).first_or_404()
+
+    if user_to_follow == current_user:
+        flash("You cannot follow yourself!", "warning")
+        return redirect(url_for('main.home'))
+
+    # following twice would break the primary key (and the counters)
+    if current_user.is_following(user_to_follow):
+        flash(f"You are already following {username}.", "info")
+        return redirect(request.referrer or url_for('main.home'))
+    
+    db.session.execute(insert(follows).values(follower_id=current_user.id,
+                                              followed_id=user_to_follow.id))
+    current_user.forget_follow_state(user_to_follow)
+    counters.adjust(current_user.id, following_count=1)
+    counters.adjust(user_to_follow.id, follower_count=1)
+    # their recent posts are copied into our timeline in the background
+    job_queue.enqueue("user_followed", {"follower_id": current_user.id,
+                                        "followed_id": user_to_follow.id})
+    db.session.commit()
+    cache.invalidate(f"user:{current_user.username}", f"user:{username}")
+    flash(f"You are now following {username}.", "success")
+    return redirect(request.referrer or url_for('main.home'))
+
+
+
+@bp.route('/unfollow/<string:username>')
+@login_required
+@use_primary
+def unfollow(username):
+    user_to_unfollow = User.query.filter_by(username=username).first_or_404()
+    if user_to_unfollow == current_user:
+        flash("You cannot unfollow yourself!", "warning")
+        return redirect(url_for('main.home'))
+
+    if not current_user.is_following(user_to_unfollow):
+        flash(f"You are not following {username}.", "info")
+        return redirect(request.referrer or url_for('main.home'))
+        
+    db.session.execute(delete(follows).where(follows.c.follower_id == current_user.id,
+                                             follows.c.followed_id == user_to_unfollow.id))
+    current_user.forget_follow_state(user_to_unfollow)
+    counters.adjust(current_user.id, following_count=-1)
+    counters.adjust(user_to_unfollow.id, follower_count=-1)
+    timeline.remove_author(current_user.id, user_to_unfollow.id)
+    db.session.commit()
+    cache.invalidate(f"user:{current_user.username}", f"user:{username}")
+    flash(f"You have unfollowed {username}.", "info")
+    return redirect(request.referrer or url_for('main.home'))
+
+
+# delete your own account, with all your posts and comments
+@bp.route("/account/delete", methods=["POST"])
+@login_required
+def delete_account():
+    user_id = current_user.id
+    logout_user()
+    delete_accounts([user_id])
+    flash("Your account has been deleted.", "info")
+    return redirect(url_for("main.home"))
+
+
+# user profile
+@bp.route("/user/<string:username>")
+@cache.cached_page(lambda username: [f"user:{username}"])
+def user_profile(username):
+    # get the user
+    user = User.query.filter_by(username=username).first_or_404()
+    per_page = current_app.config["PROFILE_LIST_PER_PAGE"]
+    args = request.args
+
+    # each list is one page of a dynamic relationship, the totals come from
+    # the counter columns, so a popular profile costs the same as any other.
+    # following/followers are ordered by the follows columns so the pages
+    # walk the follows indexes instead of sorting.
+    following = keyset_paginate(user.following, None, follows.c.followed_id, per_page,
+                                after=args.get("following_after"),
+                                before=args.get("following_before"))
+    followers = keyset_paginate(user.followers, None, follows.c.follower_id, per_page,
+                                after=args.get("followers_after"),
+                                before=args.get("followers_before"))
+    posts = keyset_paginate(user.posts.options(*post_summary_options()), Post.created_at, Post.id, per_page,
+                            after=args.get("posts_after"),
+                            before=args.get("posts_before"))
+
+    return render_template("profile.html", user=user, following=following,
+                           followers=followers, posts=posts)